@@ -3,6 +3,8 @@
 clear
 
 model_path="/mnt/c/MMD/mmd-auto-trace-4/data/pmx/v4_trace_model.pmx"
+queue_path="./queue.sqlite3"
+workers=$(nproc)
 
 output_dirs=(
     "/mnt/e/MMD_E/201805_auto/02/baka/baka_mp4_20240531_223747"
@@ -37,7 +39,12 @@ for i in "${!output_dirs[@]}"; do
     cp ${output_dirs[i]}/*.pkl "${dir_path}"
     # cp ${output_dirs[i]}/end_of_frame "${dir_path}"
 
-    echo "convert -----------------"
-    python py/exec_cpu_local.py "${dir_path}"
+    echo "enqueue -----------------"
+    python py/exec_queue.py enqueue --db "${queue_path}" "${dir_path}"
 
 done
+
+echo "=================================="
+echo "convert -----------------"
+python py/exec_queue.py work --db "${queue_path}" --workers ${workers}
+python py/exec_queue.py status --db "${queue_path}"
@@ -4,9 +4,11 @@ import (
 	"flag"
 	"os"
 	"path/filepath"
+	"sync"
 	"time"
 
 	"github.com/miu200521358/mlib_go/pkg/mutils/mlog"
+	"github.com/miu200521358/mmd-auto-trace-4/pkg/model"
 	"github.com/miu200521358/mmd-auto-trace-4/pkg/usecase"
 	"github.com/miu200521358/mmd-auto-trace-4/pkg/utils"
 )
@@ -15,12 +17,22 @@ var logLevel string
 var modelPath string
 var dirPath string
 var limitMinutes int
+var throughputPath string
+var workers int
+
+// 間引きの許容値 (reduce_wide を完了したモーションとして記録する)
+var reduceProfiles = []usecase.ReduceProfile{
+	{Name: "narrow", LogPrefix: "Narrow Reduce", MoveTolerance: 0.05, RotTolerance: 0.00001, Space: 0},
+	{Name: "wide", LogPrefix: "Wide Reduce", MoveTolerance: 0.07, RotTolerance: 0.00005, Space: 2},
+}
 
 func init() {
 	flag.StringVar(&logLevel, "logLevel", "INFO", "set log level")
 	flag.StringVar(&modelPath, "modelPath", "", "set model path")
 	flag.StringVar(&dirPath, "dirPath", "", "set directory path")
 	flag.IntVar(&limitMinutes, "limitMinutes", 30, "set directory path")
+	flag.StringVar(&throughputPath, "throughputPath", "", "set throughput history path")
+	flag.IntVar(&workers, "workers", 1, "set number of motions converted in parallel")
 	flag.Parse()
 
 	switch logLevel {
@@ -37,87 +49,202 @@ func main() {
 		os.Exit(1)
 	}
 
+	models, err := usecase.LoadModelRegistry(modelPath)
+	if err != nil {
+		mlog.E("Failed to load models: %v", err)
+		return
+	}
+
 	mlog.I("Unpack json ================")
-	allFrames, err := usecase.Unpack(dirPath)
+	sources, err := usecase.Unpack(dirPath)
 	if err != nil {
 		mlog.E("Failed to unpack: %v", err)
 		return
 	}
 
-	startTime := time.Now()
+	if throughputPath == "" {
+		throughputPath = utils.GetThroughputPath(modelPath)
+	}
+	throughput := utils.LoadThroughput(throughputPath)
 
-	allNum := len(allFrames)
-	for i, frames := range allFrames {
+	frameCounts := make([]int, len(sources))
+	for i, source := range sources {
+		frameCounts[i] = source.FrameNum
+	}
+
+	if workers < 1 {
+		workers = 1
+	}
+
+	// 変形中のモデルを複数のワーカーで共有しないよう、ワーカーごとにモデルを読み込んでおく (トラックごとには読み込まない)
+	registries := make(chan *usecase.ModelRegistry, workers)
+	registries <- models
+	for n := 1; n < min(workers, countIncomplete(sources)); n++ {
+		workerModels, err := models.Clone()
+		if err != nil {
+			mlog.E("Failed to load models for worker %d: %v", n+1, err)
+			break
+		}
+		registries <- workerModels
+	}
+
+	startTime := time.Now()
+	limitDuration := time.Duration(limitMinutes) * time.Minute
+	isAllComplete := true
+	// 制限時間の全体を使っても終わらない見込みのモーション数
+	neverFitNum := 0
+
+	// 実績と集計は複数のワーカーから更新するのでロックを取る
+	var mu sync.Mutex
+	var wg sync.WaitGroup
+
+	allNum := len(sources)
+	// 長いモーションから順に処理する
+	for _, i := range utils.SortByFramesDesc(frameCounts) {
 		motionNum := i + 1
 
-		if _, err := os.Stat(filepath.Join(filepath.Dir(frames.Path), utils.GetCompleteName(frames.Path))); err == nil {
+		if sources[i].IsComplete {
 			mlog.I("[%d/%d] Finished Convert Motion ===========================", motionNum, allNum)
 			continue
 		}
 
-		mlog.I("[%d/%d] Convert Motion ===========================", motionNum, allNum)
-
-		moveMotion := usecase.Move(frames, motionNum, allNum)
-
-		if mlog.IsDebug() {
-			utils.WriteVmdMotions(frames, moveMotion, dirPath, "1_move", "Move", motionNum, allNum)
+		// ワーカーが空いてから、開始時点の残り時間で判定する
+		workerModels := <-registries
+
+		// 残り時間内に終わらない見込みのモーションは開始しない(1件目も同じ)
+		mu.Lock()
+		remaining := limitDuration - time.Since(startTime)
+		estimate, ok := throughput.Estimate("mat4", frameCounts[i])
+		estimateDuration := time.Duration(estimate * float64(time.Second))
+		if ok && estimateDuration > limitDuration {
+			mlog.E("[%d/%d] Motion can never finish within -limitMinutes=%d (estimate: %.0fs, frames: %d)",
+				motionNum, allNum, limitMinutes, estimate, frameCounts[i])
+			neverFitNum++
+			isAllComplete = false
+			mu.Unlock()
+			registries <- workerModels
+			continue
+		}
+		if remaining <= 0 || (ok && estimateDuration > remaining) {
+			mlog.I("[%d/%d] Skip Convert Motion (estimate: %.0fs, remaining: %.0fs) ===========================",
+				motionNum, allNum, estimate, remaining.Seconds())
+			isAllComplete = false
+			mu.Unlock()
+			registries <- workerModels
+			continue
 		}
+		mu.Unlock()
+
+		wg.Add(1)
+		go func(i int, workerModels *usecase.ModelRegistry) {
+			defer wg.Done()
+			defer func() { registries <- workerModels }()
+
+			motionStartTime := time.Now()
+
+			// jsonはワーカーが処理を始めるときに読み込む
+			frames, err := sources[i].Load()
+			if err != nil {
+				mlog.E("[%d/%d] Failed to unpack: %v", i+1, allNum, err)
+				mu.Lock()
+				isAllComplete = false
+				mu.Unlock()
+				return
+			}
+
+			convertMotion(frames, workerModels, i+1, allNum)
+
+			mu.Lock()
+			defer mu.Unlock()
+			if err := throughput.Record(throughputPath, "mat4", frameCounts[i], time.Since(motionStartTime).Seconds()); err != nil {
+				mlog.E("Failed to record throughput: %v", err)
+			}
+		}(i, workerModels)
+	}
 
-		rotateMotion := usecase.Rotate(moveMotion, modelPath, motionNum, allNum)
+	wg.Wait()
 
-		if mlog.IsDebug() {
-			utils.WriteVmdMotions(frames, rotateMotion, dirPath, "2_rotate", "Rotate", motionNum, allNum)
-		}
+	if neverFitNum > 0 {
+		mlog.E("%d motions exceed -limitMinutes=%d on their own, raise -limitMinutes to convert them", neverFitNum, limitMinutes)
+		os.Exit(1)
+	}
 
-		legIkMotion := usecase.ConvertLegIk(rotateMotion, modelPath, motionNum, allNum)
+	if !isAllComplete {
+		return
+	}
 
-		if mlog.IsDebug() {
-			utils.WriteVmdMotions(frames, legIkMotion, dirPath, "3_legIk", "LegIK", motionNum, allNum)
+	// complete ファイルを出力する
+	{
+		completePath := filepath.Join(dirPath, "all_complete")
+		mlog.I("Output Complete File %s", completePath)
+		f, err := os.Create(completePath)
+		if err != nil {
+			mlog.E("Failed to create complete file: %v", err)
+			return
 		}
+		defer f.Close()
+	}
 
-		groundMotion := usecase.FixGround(legIkMotion, modelPath, motionNum, allNum)
+	mlog.I("Done!")
+}
 
-		if mlog.IsDebug() {
-			utils.WriteVmdMotions(frames, groundMotion, dirPath, "4_ground", "Ground", motionNum, allNum)
+// countIncomplete 変換が終わっていないトラック数
+func countIncomplete(sources []*usecase.FramesSource) int {
+	num := 0
+	for _, source := range sources {
+		if !source.IsComplete {
+			num++
 		}
+	}
+	return num
+}
 
-		heelMotion := usecase.FixHeel(frames, groundMotion, modelPath, motionNum, allNum)
+// convertMotion 1トラック分のモーションを変換して出力する
+func convertMotion(frames *model.Frames, models *usecase.ModelRegistry, motionNum, allNum int) {
+	mlog.I("[%d/%d] Convert Motion ===========================", motionNum, allNum)
 
-		if mlog.IsDebug() {
-			utils.WriteVmdMotions(frames, heelMotion, dirPath, "5_heel", "Heel", motionNum, allNum)
-		}
+	moveMotion := usecase.Move(frames, motionNum, allNum)
 
-		armIkMotion := usecase.ConvertArmIk(heelMotion, modelPath, motionNum, allNum)
+	if mlog.IsDebug() {
+		utils.WriteVmdMotions(frames, moveMotion, dirPath, "1_move", "Move", motionNum, allNum)
+	}
 
-		utils.WriteVmdMotions(frames, armIkMotion, dirPath, "full", "Full", motionNum, allNum)
+	rotateMotion := usecase.Rotate(moveMotion, models.Base, motionNum, allNum)
 
-		narrowReduceMotion := usecase.Reduce(armIkMotion, modelPath, 0.05, 0.00001, 0, "narrow", motionNum, allNum)
+	if mlog.IsDebug() {
+		utils.WriteVmdMotions(frames, rotateMotion, dirPath, "2_rotate", "Rotate", motionNum, allNum)
+	}
 
-		utils.WriteVmdMotions(frames, narrowReduceMotion, dirPath, "reduce_narrow", "Narrow Reduce", motionNum, allNum)
+	legIkMotion := usecase.ConvertLegIk(rotateMotion, models.LegIk, models.ToeIk, motionNum, allNum)
 
-		wideReduceMotions := usecase.Reduce(armIkMotion, modelPath, 0.07, 0.00005, 2, "wide", motionNum, allNum)
+	if mlog.IsDebug() {
+		utils.WriteVmdMotions(frames, legIkMotion, dirPath, "3_legIk", "LegIK", motionNum, allNum)
+	}
 
-		utils.WriteVmdMotions(frames, wideReduceMotions, dirPath, "reduce_wide", "Wide Reduce", motionNum, allNum)
+	groundMotion := usecase.FixGround(legIkMotion, models.Base, motionNum, allNum)
 
-		utils.WriteComplete(dirPath, frames.Path)
+	if mlog.IsDebug() {
+		utils.WriteVmdMotions(frames, groundMotion, dirPath, "4_ground", "Ground", motionNum, allNum)
+	}
 
-		// 開始時間から指定時間過ぎてたら終了
-		if time.Since(startTime) > time.Duration(limitMinutes)*time.Minute {
-			return
-		}
+	heelMotion := usecase.FixHeel(frames, groundMotion, modelPath, motionNum, allNum)
+
+	if mlog.IsDebug() {
+		utils.WriteVmdMotions(frames, heelMotion, dirPath, "5_heel", "Heel", motionNum, allNum)
 	}
 
-	// complete ファイルを出力する
-	{
-		completePath := filepath.Join(dirPath, "all_complete")
-		mlog.I("Output Complete File %s", completePath)
-		f, err := os.Create(completePath)
-		if err != nil {
-			mlog.E("Failed to create complete file: %v", err)
-			return
-		}
-		defer f.Close()
+	armIkMotion := usecase.ConvertArmIk(heelMotion, models.ArmIk, motionNum, allNum)
+
+	utils.WriteVmdMotions(frames, armIkMotion, dirPath, "full", "Full", motionNum, allNum)
+
+	reduceMotions := usecase.ReduceMotions(armIkMotion, reduceProfiles, motionNum, allNum)
+
+	for i, profile := range reduceProfiles {
+		utils.WriteVmdMotions(frames, reduceMotions[i], dirPath, "reduce_"+profile.Name, profile.LogPrefix, motionNum, allNum)
 	}
 
-	mlog.I("Done!")
+	utils.WriteComplete(dirPath, frames.Path)
+	if err := utils.SetTrackStage(dirPath, frames.Path, "mat4", "done", utils.GetVmdName(frames, "reduce_wide")); err != nil {
+		mlog.E("Failed to update track index: %v", err)
+	}
 }
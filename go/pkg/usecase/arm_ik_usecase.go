@@ -3,7 +3,6 @@ package usecase
 import (
 	"fmt"
 	"math"
-	"strings"
 
 	"github.com/miu200521358/mlib_go/pkg/mmath"
 	"github.com/miu200521358/mlib_go/pkg/mutils/mlog"
@@ -12,18 +11,9 @@ import (
 	"github.com/miu200521358/mmd-auto-trace-4/pkg/utils"
 )
 
-func ConvertArmIk(prevMotion *vmd.VmdMotion, modelPath string, motionNum, allNum int) *vmd.VmdMotion {
+func ConvertArmIk(prevMotion *vmd.VmdMotion, armIkModel *pmx.PmxModel, motionNum, allNum int) *vmd.VmdMotion {
 	mlog.D("[%d/%d] Convert Arm Ik ...", motionNum, allNum)
 
-	pr := &pmx.PmxReader{}
-
-	// 腕捩IK用モデルを読み込み
-	armIkData, err := pr.ReadByFilepath(strings.Replace(modelPath, ".pmx", "_arm_ik.pmx", -1))
-	if err != nil {
-		mlog.E("Failed to read pmx: %v", err)
-	}
-	armIkModel := armIkData.(*pmx.PmxModel)
-
 	minFrame := prevMotion.BoneFrames.Get(pmx.CENTER.String()).GetMinFrame()
 	maxFrame := prevMotion.BoneFrames.Get(pmx.CENTER.String()).GetMaxFrame()
 
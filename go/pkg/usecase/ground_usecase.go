@@ -12,17 +12,9 @@ import (
 	"github.com/miu200521358/mmd-auto-trace-4/pkg/utils"
 )
 
-func FixGround(prevMotion *vmd.VmdMotion, modelPath string, motionNum, allNum int) *vmd.VmdMotion {
+func FixGround(prevMotion *vmd.VmdMotion, model *pmx.PmxModel, motionNum, allNum int) *vmd.VmdMotion {
 	mlog.I("[%d/%d] Fix Ground ...", motionNum, allNum)
 
-	// モデル読み込み
-	pr := &pmx.PmxReader{}
-	data, err := pr.ReadByFilepath(modelPath)
-	if err != nil {
-		mlog.E("Failed to read pmx: %v", err)
-	}
-	model := data.(*pmx.PmxModel)
-
 	motion := fixGroundMotion(prevMotion)
 	return fixGroundFootMotion(model, motion)
 }
@@ -3,7 +3,6 @@ package usecase
 import (
 	"fmt"
 	"math"
-	"strings"
 
 	"github.com/miu200521358/mlib_go/pkg/mmath"
 	"github.com/miu200521358/mlib_go/pkg/mutils/mlog"
@@ -12,25 +11,9 @@ import (
 	"github.com/miu200521358/mmd-auto-trace-4/pkg/utils"
 )
 
-func ConvertLegIk(prevMotion *vmd.VmdMotion, modelPath string, motionNum, allNum int) *vmd.VmdMotion {
+func ConvertLegIk(prevMotion *vmd.VmdMotion, legIkModel, toeIkModel *pmx.PmxModel, motionNum, allNum int) *vmd.VmdMotion {
 	mlog.D("[%d/%d] Convert Leg Ik ...", motionNum, allNum)
 
-	pr := &pmx.PmxReader{}
-
-	// 足IK用モデルを読み込み
-	legIkData, err := pr.ReadByFilepath(strings.Replace(modelPath, ".pmx", "_leg_ik.pmx", -1))
-	if err != nil {
-		mlog.E("Failed to read pmx: %v", err)
-	}
-	legIkModel := legIkData.(*pmx.PmxModel)
-
-	// 足首IK用モデル読み込み
-	toeIkData, err := pr.ReadByFilepath(strings.Replace(modelPath, ".pmx", "_toe_ik.pmx", -1))
-	if err != nil {
-		mlog.E("Failed to read pmx: %v", err)
-	}
-	toeIkModel := toeIkData.(*pmx.PmxModel)
-
 	minFrame := prevMotion.BoneFrames.Get(pmx.CENTER.String()).GetMinFrame()
 	maxFrame := prevMotion.BoneFrames.Get(pmx.CENTER.String()).GetMaxFrame()
 
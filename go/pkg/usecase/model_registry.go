@@ -0,0 +1,50 @@
+package usecase
+
+import (
+	"strings"
+
+	"github.com/miu200521358/mlib_go/pkg/mutils/mlog"
+	"github.com/miu200521358/mlib_go/pkg/pmx"
+)
+
+// ModelRegistry 変換で使うモデル。ワーカーごとに1回だけ読み込み、そのワーカーが変換する全トラックで使う
+// (変形でモデルの状態が変わる可能性があるので、複数のワーカーで共有しない)
+type ModelRegistry struct {
+	Base  *pmx.PmxModel // 回転・接地
+	LegIk *pmx.PmxModel // 足IK
+	ToeIk *pmx.PmxModel // 足首IK
+	ArmIk *pmx.PmxModel // 腕IK
+
+	modelPath string
+}
+
+// LoadModelRegistry モデルと各IK用モデル (_leg_ik.pmx, _toe_ik.pmx, _arm_ik.pmx) を読み込む
+func LoadModelRegistry(modelPath string) (*ModelRegistry, error) {
+	mlog.I("Load Models ================")
+
+	registry := &ModelRegistry{modelPath: modelPath}
+	for _, m := range []struct {
+		model **pmx.PmxModel
+		path  string
+	}{
+		{&registry.Base, modelPath},
+		{&registry.LegIk, strings.Replace(modelPath, ".pmx", "_leg_ik.pmx", -1)},
+		{&registry.ToeIk, strings.Replace(modelPath, ".pmx", "_toe_ik.pmx", -1)},
+		{&registry.ArmIk, strings.Replace(modelPath, ".pmx", "_arm_ik.pmx", -1)},
+	} {
+		pr := &pmx.PmxReader{}
+		data, err := pr.ReadByFilepath(m.path)
+		if err != nil {
+			mlog.E("Failed to read pmx: %s: %v", m.path, err)
+			return nil, err
+		}
+		*m.model = data.(*pmx.PmxModel)
+	}
+
+	return registry, nil
+}
+
+// Clone 同じモデルを読み込み直す (ワーカーを増やすときに使う)
+func (r *ModelRegistry) Clone() (*ModelRegistry, error) {
+	return LoadModelRegistry(r.modelPath)
+}
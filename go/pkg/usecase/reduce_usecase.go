@@ -2,6 +2,7 @@ package usecase
 
 import (
 	"strings"
+	"sync"
 
 	"github.com/miu200521358/mlib_go/pkg/mmath"
 	"github.com/miu200521358/mlib_go/pkg/mutils/mlog"
@@ -10,16 +11,54 @@ import (
 	"github.com/miu200521358/mmd-auto-trace-4/pkg/utils"
 )
 
-func Reduce(prevMotion *vmd.VmdMotion, modelPath string, moveTolerance, rotTolerance float64, space int, reduceName string, motionNum, allNum int) *vmd.VmdMotion {
-	mlog.I("[%d/%d] Reduce ...", motionNum, allNum)
+// ReduceProfile 間引きの許容値
+type ReduceProfile struct {
+	Name          string // 出力ファイル名 (reduce_{Name})
+	LogPrefix     string
+	MoveTolerance float64
+	RotTolerance  float64
+	Space         int
+}
+
+// ReduceSeries 間引きの元になる各ボーンの値。1回だけ求めて各プロファイルで共有する (変更しないこと)
+type ReduceSeries struct {
+	path      string
+	minFno    int
+	fnoCounts int
+	moveXs    map[string][]float64
+	moveYs    map[string][]float64
+	moveZs    map[string][]float64
+	rots      map[string][]float64
+	quats     map[string][]*mmath.MQuaternion
+}
 
-	motion := vmd.NewVmdMotion(strings.Replace(prevMotion.Path, "_heel.vmd", "_fix.vmd", -1))
+// ReduceMotions 値を1回だけ取り出して、各プロファイルの間引きを並列に行う
+func ReduceMotions(prevMotion *vmd.VmdMotion, profiles []ReduceProfile, motionNum, allNum int) []*vmd.VmdMotion {
+	series := NewReduceSeries(prevMotion, motionNum, allNum)
+
+	motions := make([]*vmd.VmdMotion, len(profiles))
+	var wg sync.WaitGroup
+	for i, profile := range profiles {
+		wg.Add(1)
+		go func(i int, profile ReduceProfile) {
+			defer wg.Done()
+			motions[i] = series.Reduce(profile, motionNum, allNum)
+		}(i, profile)
+	}
+	wg.Wait()
+
+	return motions
+}
+
+// NewReduceSeries 移動・回転の値とフレーム間の回転の内積を取り出す
+func NewReduceSeries(prevMotion *vmd.VmdMotion, motionNum, allNum int) *ReduceSeries {
+	mlog.I("[%d/%d] Reduce Series ...", motionNum, allNum)
 
 	minFno := prevMotion.BoneFrames.Get(pmx.CENTER.String()).GetMinFrame()
 	maxFno := prevMotion.BoneFrames.Get(pmx.CENTER.String()).GetMaxFrame()
 	fnoCounts := maxFno - minFno + 1
 
-	bar := utils.NewProgressBar(fnoCounts * 2)
+	bar := utils.NewProgressBar(fnoCounts)
 
 	// 移動
 	moveXs := make(map[string][]float64)
@@ -64,6 +103,36 @@ func Reduce(prevMotion *vmd.VmdMotion, modelPath string, moveTolerance, rotToler
 		}
 	}
 
+	bar.Finish()
+
+	return &ReduceSeries{
+		path:      prevMotion.Path,
+		minFno:    minFno,
+		fnoCounts: fnoCounts,
+		moveXs:    moveXs,
+		moveYs:    moveYs,
+		moveZs:    moveZs,
+		rots:      rots,
+		quats:     quats,
+	}
+}
+
+// Reduce 変曲点だけをキーフレとして残したモーションを作る
+func (s *ReduceSeries) Reduce(profile ReduceProfile, motionNum, allNum int) *vmd.VmdMotion {
+	mlog.I("[%d/%d] Reduce %s ...", motionNum, allNum, profile.Name)
+
+	moveTolerance := profile.MoveTolerance
+	rotTolerance := profile.RotTolerance
+	space := profile.Space
+	minFno := s.minFno
+	fnoCounts := s.fnoCounts
+	moveXs, moveYs, moveZs := s.moveXs, s.moveYs, s.moveZs
+	rots, quats := s.rots, s.quats
+
+	motion := vmd.NewVmdMotion(strings.Replace(s.path, "_heel.vmd", "_fix.vmd", -1))
+
+	bar := utils.NewProgressBar(fnoCounts)
+
 	moveXInflections := make(map[string]map[int]int)
 	moveYInflections := make(map[string]map[int]int)
 	moveZInflections := make(map[string]map[int]int)
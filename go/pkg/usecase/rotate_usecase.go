@@ -10,17 +10,9 @@ import (
 	"github.com/miu200521358/mmd-auto-trace-4/pkg/utils"
 )
 
-func Rotate(prevMotion *vmd.VmdMotion, modelPath string, motionNum, allNum int) *vmd.VmdMotion {
+func Rotate(prevMotion *vmd.VmdMotion, pmxModel *pmx.PmxModel, motionNum, allNum int) *vmd.VmdMotion {
 	mlog.I("[%d/%d] Convert Rotate ...", motionNum, allNum)
 
-	// モデル読み込み
-	pr := &pmx.PmxReader{}
-	data, err := pr.ReadByFilepath(modelPath)
-	if err != nil {
-		mlog.E("Failed to read pmx: %v", err)
-	}
-	pmxModel := data.(*pmx.PmxModel)
-
 	bar := utils.NewProgressBar(len(boneConfigs))
 
 	rotMotion := vmd.NewVmdMotion(strings.Replace(prevMotion.Path, "_move.vmd", "_rotate.vmd", -1))
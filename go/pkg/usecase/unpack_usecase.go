@@ -1,7 +1,9 @@
 package usecase
 
 import (
+	"compress/gzip"
 	"encoding/json"
+	"io"
 	"os"
 	"path/filepath"
 	"strings"
@@ -12,8 +14,16 @@ import (
 	"github.com/miu200521358/mmd-auto-trace-4/pkg/utils"
 )
 
-// Unpack jsonデータを読み込んで、構造体に展開する
-func Unpack(dirPath string) ([]*model.Frames, error) {
+// FramesSource 変換対象のトラック。フレームは Load したときに読み込む
+type FramesSource struct {
+	Path       string // 出力ファイル名を求める .json のパス
+	FilePath   string // 実際のファイル (.json / .json.gz)
+	FrameNum   int    // フレーム数 (処理順と所要時間の見込みに使う)
+	IsComplete bool   // 変換済み (complete ファイルがある)
+}
+
+// Unpack 変換対象のトラックを列挙する。jsonの展開は各トラックの Load で行う
+func Unpack(dirPath string) ([]*FramesSource, error) {
 	mlog.I("Start: Unpack =============================")
 
 	jsonPaths, err := getJSONFilePaths(dirPath)
@@ -22,42 +32,85 @@ func Unpack(dirPath string) ([]*model.Frames, error) {
 		return nil, err
 	}
 
-	allFrames := make([]*model.Frames, len(jsonPaths))
-
-	// 全体のタスク数をカウント
-	totalFrames := len(jsonPaths)
-	bar := utils.NewProgressBar(totalFrames)
+	// インデックスがあればフレーム数はそこから取る
+	index, _ := utils.LoadTrackIndex(dirPath)
 
+	sources := make([]*FramesSource, len(jsonPaths))
 	for i, path := range jsonPaths {
-		bar.Increment()
-		mlog.I("[%d/%d] Unpack ...", i+1, len(jsonPaths))
+		source := &FramesSource{Path: strings.TrimSuffix(path, ".gz"), FilePath: path}
+		sources[i] = source
 
-		// JSONデータを読み込んで展開
-		file, err := os.Open(path)
-		if err != nil {
-			mlog.E("[%s] Failed to open file: %v", path, err)
-			break
+		if _, err := os.Stat(filepath.Join(filepath.Dir(path), utils.GetCompleteName(path))); err == nil {
+			// 変換済みのトラックは読まない
+			source.IsComplete = true
+			continue
 		}
-		defer file.Close()
 
-		frames := new(model.Frames)
-		frames.Path = path
-		decoder := json.NewDecoder(file)
-		err = decoder.Decode(frames)
-		if err != nil {
-			mlog.E("[%s] Failed to decode json: %v", path, err)
-			break
+		if index != nil {
+			if track, ok := index.Tracks[utils.GetTrackName(path)]; ok && track.Frames > 0 {
+				source.FrameNum = track.Frames
+				continue
+			}
 		}
 
-		// Send the frames to the result channel
-		allFrames[i] = frames
+		if source.FrameNum, err = countFrames(path); err != nil {
+			mlog.E("[%s] Failed to count frames: %v", path, err)
+		}
 	}
 
-	bar.Finish()
-
 	mlog.I("End: Unpack =============================")
 
-	return allFrames, nil
+	return sources, nil
+}
+
+// Load jsonデータを読み込んで、構造体に展開する
+func (s *FramesSource) Load() (*model.Frames, error) {
+	frames := new(model.Frames)
+	if err := decodeJSON(s.FilePath, frames); err != nil {
+		return nil, err
+	}
+	// 出力ファイル名は .json のパスから求める
+	frames.Path = s.Path
+
+	return frames, nil
+}
+
+// countFrames フレームの中身は展開せずにフレーム数を数える
+func countFrames(path string) (int, error) {
+	data := struct {
+		Frames map[string]json.RawMessage `json:"frames"`
+	}{}
+	if err := decodeJSON(path, &data); err != nil {
+		return 0, err
+	}
+	return len(data.Frames), nil
+}
+
+func decodeJSON(path string, v interface{}) error {
+	file, err := os.Open(path)
+	if err != nil {
+		mlog.E("[%s] Failed to open file: %v", path, err)
+		return err
+	}
+	defer file.Close()
+
+	// .json.gz は展開しながら読む
+	var reader io.Reader = file
+	if strings.HasSuffix(path, ".gz") {
+		gzipReader, err := gzip.NewReader(file)
+		if err != nil {
+			mlog.E("[%s] Failed to open gzip: %v", path, err)
+			return err
+		}
+		defer gzipReader.Close()
+		reader = gzipReader
+	}
+
+	if err := json.NewDecoder(reader).Decode(v); err != nil {
+		mlog.E("[%s] Failed to decode json: %v", path, err)
+		return err
+	}
+	return nil
 }
 
 func getJSONFilePaths(dirPath string) ([]string, error) {
@@ -70,7 +123,7 @@ func getJSONFilePaths(dirPath string) ([]string, error) {
 			// 直下だけ参照
 			return filepath.SkipDir
 		}
-		if !info.IsDir() && (strings.HasSuffix(info.Name(), "_smooth.json")) {
+		if !info.IsDir() && (strings.HasSuffix(info.Name(), "_smooth.json") || strings.HasSuffix(info.Name(), "_smooth.json.gz")) {
 			paths = append(paths, path)
 		}
 		return nil
@@ -78,5 +131,10 @@ func getJSONFilePaths(dirPath string) ([]string, error) {
 	if err != nil {
 		return nil, err
 	}
+
+	// インデックスは順番にだけ使う (ファイルがないトラックは含めない)
+	if index, err := utils.LoadTrackIndex(dirPath); err == nil {
+		paths = index.SortPaths(paths)
+	}
 	return paths, nil
 }
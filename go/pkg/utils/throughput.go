@@ -0,0 +1,144 @@
+package utils
+
+import (
+	"encoding/json"
+	"os"
+	"path/filepath"
+	"sort"
+	"syscall"
+)
+
+// ステージ別に保持する実績数
+const maxThroughputSamples = 50
+
+// 見積もりに対する安全率
+const throughputSafetyFactor = 1.2
+
+// Throughput ステージ別の実行実績 ([フレーム数, 秒数])。py/scheduler.py と同じ形式
+type Throughput map[string][][2]float64
+
+// GetThroughputPath モデルパスから既定の実績ファイルパスを求める (data/throughput.json)
+func GetThroughputPath(modelPath string) string {
+	return filepath.Join(filepath.Dir(filepath.Dir(modelPath)), "throughput.json")
+}
+
+func LoadThroughput(path string) Throughput {
+	throughput := make(Throughput)
+
+	data, err := os.ReadFile(path)
+	if err != nil {
+		return throughput
+	}
+	if err := json.Unmarshal(data, &throughput); err != nil {
+		return make(Throughput)
+	}
+
+	return throughput
+}
+
+// Record 実績を追加してファイルに書き出す
+func (t Throughput) Record(path, stage string, frames int, seconds float64) error {
+	if frames <= 0 {
+		return nil
+	}
+
+	// py/scheduler.py のワーカーと同時に書き込まないようロックを取る
+	lock, err := os.Create(path + ".lock")
+	if err != nil {
+		return err
+	}
+	defer lock.Close()
+	if err := syscall.Flock(int(lock.Fd()), syscall.LOCK_EX); err != nil {
+		return err
+	}
+	defer syscall.Flock(int(lock.Fd()), syscall.LOCK_UN)
+
+	// 他プロセスの追記分を取り込んでから追加する
+	latest := LoadThroughput(path)
+	samples := append(latest[stage], [2]float64{float64(frames), seconds})
+	if len(samples) > maxThroughputSamples {
+		samples = samples[len(samples)-maxThroughputSamples:]
+	}
+	latest[stage] = samples
+
+	data, err := json.Marshal(latest)
+	if err != nil {
+		return err
+	}
+
+	// 一時ファイルは同じディレクトリに一意な名前で作る
+	tmp, err := os.CreateTemp(filepath.Dir(path), filepath.Base(path)+".*.tmp")
+	if err != nil {
+		return err
+	}
+	tmpPath := tmp.Name()
+	if _, err := tmp.Write(data); err != nil {
+		tmp.Close()
+		os.Remove(tmpPath)
+		return err
+	}
+	if err := tmp.Close(); err != nil {
+		os.Remove(tmpPath)
+		return err
+	}
+	if err := os.Chmod(tmpPath, 0644); err != nil {
+		os.Remove(tmpPath)
+		return err
+	}
+	if err := os.Rename(tmpPath, path); err != nil {
+		os.Remove(tmpPath)
+		return err
+	}
+
+	t[stage] = samples
+	return nil
+}
+
+// Estimate 実績から 秒数 = 固定費 + フレーム数 * 単価 で見積もる。実績がない場合は false
+func (t Throughput) Estimate(stage string, frames int) (float64, bool) {
+	samples := t[stage]
+	if len(samples) == 0 {
+		return 0, false
+	}
+
+	n := float64(len(samples))
+	sumX, sumY, sumXX, sumXY := 0.0, 0.0, 0.0, 0.0
+	distinct := make(map[float64]struct{})
+	for _, s := range samples {
+		sumX += s[0]
+		sumY += s[1]
+		sumXX += s[0] * s[0]
+		sumXY += s[0] * s[1]
+		distinct[s[0]] = struct{}{}
+	}
+
+	if sumX <= 0 {
+		return 0, false
+	}
+
+	// フレーム数が1種類しかない場合は単価のみ
+	rate := sumY / sumX
+	overhead := 0.0
+
+	if len(distinct) >= 2 {
+		fitRate := (n*sumXY - sumX*sumY) / (n*sumXX - sumX*sumX)
+		if fitRate > 0 {
+			rate = fitRate
+			overhead = max(0, (sumY-fitRate*sumX)/n)
+		}
+	}
+
+	return (overhead + rate*float64(frames)) * throughputSafetyFactor, true
+}
+
+// SortByFramesDesc フレーム数の多い順に並べたインデックスを返す
+func SortByFramesDesc(frameCounts []int) []int {
+	indexes := make([]int, len(frameCounts))
+	for i := range indexes {
+		indexes[i] = i
+	}
+	sort.SliceStable(indexes, func(a, b int) bool {
+		return frameCounts[indexes[a]] > frameCounts[indexes[b]]
+	})
+	return indexes
+}
@@ -0,0 +1,129 @@
+package utils
+
+import (
+	"encoding/json"
+	"os"
+	"path/filepath"
+	"sort"
+	"strings"
+	"syscall"
+)
+
+// TrackIndexName 出力ディレクトリのトラック一覧 (py/track_index.py と同じ形式)
+const TrackIndexName = "tracks.json"
+
+// TrackEntry トラックの情報
+type TrackEntry struct {
+	TrackedId      int               `json:"tracked_id"`
+	StartTime      int               `json:"start_time"`
+	StartFno       int               `json:"start_fno"`
+	EndFno         int               `json:"end_fno"`
+	Frames         int               `json:"frames"`
+	ObservedFrames int               `json:"observed_frames"`
+	MeanConf       float64           `json:"mean_conf"`
+	Stages         map[string]string `json:"stages"`
+	Paths          map[string]string `json:"paths"`
+}
+
+// TrackIndex トラック名ごとの情報
+type TrackIndex struct {
+	Tracks map[string]*TrackEntry `json:"tracks"`
+}
+
+// LoadTrackIndex インデックスを読み込む。ない場合はエラー
+func LoadTrackIndex(dirPath string) (*TrackIndex, error) {
+	data, err := os.ReadFile(filepath.Join(dirPath, TrackIndexName))
+	if err != nil {
+		return nil, err
+	}
+
+	index := new(TrackIndex)
+	if err := json.Unmarshal(data, index); err != nil {
+		return nil, err
+	}
+
+	return index, nil
+}
+
+// SortPaths 出力パスをインデックスのフレーム数の多い順に並べる (インデックスにないトラックは元の順で後ろに回す)
+func (idx *TrackIndex) SortPaths(paths []string) []string {
+	sorted := append([]string{}, paths...)
+	sort.SliceStable(sorted, func(i, j int) bool {
+		return idx.frames(sorted[i]) > idx.frames(sorted[j])
+	})
+	return sorted
+}
+
+func (idx *TrackIndex) frames(path string) int {
+	if track, ok := idx.Tracks[GetTrackName(path)]; ok {
+		return track.Frames
+	}
+	return -1
+}
+
+// GetTrackName 出力パスからトラック名 ({start_time:05d}_{tracked_id:02d}) を求める
+func GetTrackName(path string) string {
+	parts := strings.SplitN(filepath.Base(path), "_", 3)
+	if len(parts) < 2 {
+		return filepath.Base(path)
+	}
+	return parts[0] + "_" + parts[1]
+}
+
+// SetTrackStage トラックのステージの状態と出力を記録する
+func SetTrackStage(dirPath, framePath, stage, status, outputPath string) error {
+	indexPath := filepath.Join(dirPath, TrackIndexName)
+
+	// Python のワーカーと同時に書き込まないようロックを取る
+	lock, err := os.Create(indexPath + ".lock")
+	if err != nil {
+		return err
+	}
+	defer lock.Close()
+	if err := syscall.Flock(int(lock.Fd()), syscall.LOCK_EX); err != nil {
+		return err
+	}
+	defer syscall.Flock(int(lock.Fd()), syscall.LOCK_UN)
+
+	// 知らない項目も残すため、汎用の形で読み書きする
+	index := map[string]interface{}{}
+	if data, err := os.ReadFile(indexPath); err == nil {
+		if err := json.Unmarshal(data, &index); err != nil {
+			index = map[string]interface{}{}
+		}
+	}
+
+	tracks, ok := index["tracks"].(map[string]interface{})
+	if !ok {
+		tracks = map[string]interface{}{}
+		index["tracks"] = tracks
+	}
+
+	name := GetTrackName(framePath)
+	track, ok := tracks[name].(map[string]interface{})
+	if !ok {
+		track = map[string]interface{}{}
+		tracks[name] = track
+	}
+
+	for _, key := range []string{"stages", "paths"} {
+		if _, ok := track[key].(map[string]interface{}); !ok {
+			track[key] = map[string]interface{}{}
+		}
+	}
+	track["stages"].(map[string]interface{})[stage] = status
+	if outputPath != "" {
+		track["paths"].(map[string]interface{})[stage] = filepath.Base(outputPath)
+	}
+
+	data, err := json.MarshalIndent(index, "", "    ")
+	if err != nil {
+		return err
+	}
+
+	tmpPath := indexPath + ".tmp"
+	if err := os.WriteFile(tmpPath, data, 0644); err != nil {
+		return err
+	}
+	return os.Rename(tmpPath, indexPath)
+}
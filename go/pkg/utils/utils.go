@@ -75,11 +75,11 @@ func WriteVmdMotions(frames *model.Frames, motion *vmd.VmdMotion, dirPath, fileS
 }
 
 func GetVmdName(frames *model.Frames, fileSuffix string) string {
-	return strings.Replace(filepath.Base(frames.Path), "smooth.json", fmt.Sprintf("%s.vmd", fileSuffix), -1)
+	return strings.Replace(strings.TrimSuffix(filepath.Base(frames.Path), ".gz"), "smooth.json", fmt.Sprintf("%s.vmd", fileSuffix), -1)
 }
 
 func GetCompleteName(framePath string) string {
-	return strings.Replace(filepath.Base(framePath), "smooth.json", "complete", -1)
+	return strings.Replace(strings.TrimSuffix(filepath.Base(framePath), ".gz"), "smooth.json", "complete", -1)
 }
 
 func WriteComplete(dirPath, framePath string) {
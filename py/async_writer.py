@@ -0,0 +1,74 @@
+import os
+import queue
+import threading
+
+from phalp.utils import get_pylogger
+
+log = get_pylogger(__name__)
+
+# 書き出し待ちの最大数 (これを超えると計算側が待つ)
+WRITER_QUEUE_SIZE = int(os.environ.get("MAT4_WRITER_QUEUE_SIZE", 2))
+
+
+def replace_file(tmp_path: str, path: str):
+    """書き終えた一時ファイルをディスクに書き込んでから置き換える (途中で止まっても壊れたファイルが残らない)"""
+    fd = os.open(tmp_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    os.replace(tmp_path, path)
+
+    # 置き換え(リネーム)自体もディスクに書き込む
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class AsyncWriter:
+    """書き出しを別スレッドで順番に行う。with を抜けるときに全て書き終わるまで待つ"""
+
+    def __init__(self, max_size: int = WRITER_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize=max(1, max_size))
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+
+            func, args, kwargs = task
+            if self.error is None:
+                try:
+                    func(*args, **kwargs)
+                except Exception as e:
+                    log.exception(f"Failed to write: {e}")
+                    # 以降の書き出しはせず、計算側で例外にする
+                    self.error = e
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, func, *args, **kwargs):
+        """func(*args, **kwargs) を書き出しスレッドで実行する (キューが一杯の場合は空くまで待つ)"""
+        self.raise_error()
+        self.queue.put((func, args, kwargs))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if exc_type is None:
+            self.raise_error()
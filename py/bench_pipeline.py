@@ -0,0 +1,319 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import exec_pkl2json
+import exec_smooth
+import json_io
+import result_cache
+
+BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "bench", "baseline.npz"
+)
+
+
+def make_lib_data(
+    track_num: int,
+    frame_num: int,
+    gap_every: int = 0,
+    gap_length: int = 0,
+    drop_rate: float = 0.0,
+    seed: int = 0,
+) -> dict:
+    """exec_pkl2json.convert に渡すトラッカーのブロック(1pkl分)を合成する"""
+    rng = np.random.default_rng(seed)
+
+    joint_num = 45
+    # トラックごとの骨格(基準姿勢)
+    base_joints = [rng.normal(0, 0.3, (joint_num, 3)) for _ in range(track_num)]
+
+    lib_data = {}
+    for fno in range(frame_num):
+        t = fno / 30
+        tracked_ids = []
+        for tid in range(1, track_num + 1):
+            # 先頭と末尾は必ず検出する(トラックの範囲を固定するため)
+            if 0 < fno < frame_num - 1:
+                if gap_every and gap_length and (fno + tid) % gap_every < gap_length:
+                    continue
+                if drop_rate and rng.random() < drop_rate:
+                    continue
+            tracked_ids.append(tid)
+
+        lib_data[fno] = {
+            "time": fno,
+            "tracked_ids": tracked_ids,
+            "tracked_bbox": [
+                np.array([100.0 * tid + 10 * np.sin(t), 50.0, 200.0, 400.0]) for tid in tracked_ids
+            ],
+            "conf": [np.float64(0.9 + 0.05 * np.sin(t * tid)) for tid in tracked_ids],
+            "camera": [
+                np.array([tid + 0.3 * np.sin(t), 0.2 + 0.05 * np.cos(t), 50 + 2 * np.sin(t / 3)])
+                + rng.normal(0, 0.005, 3)
+                for tid in tracked_ids
+            ],
+            "3d_joints": [
+                (
+                    base_joints[tid - 1]
+                    + 0.1 * np.sin(t * 2 + np.arange(joint_num)[:, np.newaxis])
+                    + rng.normal(0, 0.01, (joint_num, 3))
+                ).astype(np.float32)
+                for tid in tracked_ids
+            ],
+            "2d_joints": [rng.random(joint_num * 2).astype(np.float32) for _ in tracked_ids],
+        }
+
+    return lib_data
+
+
+def measure(func, *args, trace_memory: bool = False):
+    # tracemalloc は平滑化が数倍遅くなるので指定時のみ
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    peak = 0
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def collect_series(smooth_json_path: str) -> np.ndarray:
+    """比較用に平滑化結果を (フレーム, 値) の配列にする"""
+    frames = json_io.load(smooth_json_path)["frames"]
+
+    values = []
+    for fno in sorted(frames.keys(), key=int):
+        frame = frames[fno]
+        row = [frame["camera"][axis] for axis in ("x", "y", "z")]
+        for type_name in ("3d_joints", "global_3d_joints"):
+            for jname in sorted(frame[type_name].keys()):
+                row.extend(frame[type_name][jname][axis] for axis in ("x", "y", "z"))
+        values.append(row)
+
+    return np.array(values, dtype=np.float64)
+
+
+def compare_chunked(json_path: str, chunk_size: int, chunk_overlap: int) -> dict:
+    """区間に分けたUKFと系列全体のUKFの差 (トラックのローカル関節)"""
+    frames = json_io.load(json_path)["frames"]
+
+    fnos = sorted(frames.keys(), key=int)
+    jnames = sorted(frames[fnos[0]]["3d_joints"].keys())
+
+    whole_seconds, chunked_seconds, diffs = 0.0, 0.0, []
+    for jname in jnames:
+        joint_poses = np.array([[frames[fno]["3d_joints"][jname][axis] for axis in "xyz"] for fno in fnos])
+
+        start = time.perf_counter()
+        whole_poses = exec_smooth.smooth_series("3d_joints", jname, joint_poses, chunk_size=0)
+        whole_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        chunked_poses = exec_smooth.smooth_series(
+            "3d_joints", jname, joint_poses, chunk_size=chunk_size, chunk_overlap=chunk_overlap
+        )
+        chunked_seconds += time.perf_counter() - start
+
+        diffs.append(np.abs(whole_poses - chunked_poses))
+
+    diffs = np.concatenate(diffs)
+    print(
+        f"chunked ukf (size {chunk_size}, overlap {chunk_overlap}, {len(fnos)} frames x {len(jnames)} joints): "
+        f"whole {whole_seconds:.3f}s, chunked {chunked_seconds:.3f}s, "
+        f"max diff {np.max(diffs):.3e}, mean diff {np.mean(diffs):.3e}"
+    )
+    return {
+        "whole_seconds": whole_seconds,
+        "chunked_seconds": chunked_seconds,
+        "max_diff": float(np.max(diffs)),
+        "mean_diff": float(np.mean(diffs)),
+    }
+
+
+def despike_loop(values: np.ndarray) -> np.ndarray:
+    """exec_smooth.despike の元の逐次処理 (1フレームずつ、置き換えた後の値で判定する)"""
+    window = exec_smooth.CAMERA_DESPIKE["window"]
+    same_threshold = exec_smooth.CAMERA_DESPIKE["same_threshold"]
+    spike_threshold = exec_smooth.CAMERA_DESPIKE["spike_threshold"]
+
+    despiked = []
+    for value in values:
+        for length in range(1, window + 1):
+            if (
+                len(despiked) > length
+                and abs(despiked[-length - 1] - value) < same_threshold
+                and all(abs(despiked[-m] - value) > spike_threshold for m in range(1, length + 1))
+            ):
+                despiked[-length:] = [value] * length
+        despiked.append(value)
+    return np.array(despiked)
+
+
+def compare_despike(seed: int, trial_num: int = 2000) -> int:
+    """連続・交互に跳ねる系列で、exec_smooth.despike と元の逐次処理が一致するかを確認する (不一致の系列数)"""
+    rng = np.random.default_rng(seed)
+    mismatch_num = 0
+    for trial in range(trial_num):
+        frame_num = int(rng.integers(3, 40))
+        if trial % 2:
+            # 交互に跳ねる
+            values = np.where(np.arange(frame_num) % 2, 0.02, 0.0)
+            values += (rng.random(frame_num) < 0.2) * 0.01
+        else:
+            # ゆっくり動きながら、連続して跳ねる
+            values = np.cumsum(rng.normal(0, 0.0003, frame_num))
+            spikes = rng.random(frame_num) < rng.choice([0.02, 0.3, 0.6])
+            values[spikes] += rng.choice([-1, 1], spikes.sum()) * rng.uniform(0.003, 0.03, spikes.sum())
+        if not np.array_equal(exec_smooth.despike(values), despike_loop(values)):
+            mismatch_num += 1
+    return mismatch_num
+
+
+def report(name: str, frame_num: int, seconds: float, peak: int):
+    fps = frame_num / seconds if seconds > 0 else 0.0
+    # プロセス開始からのピーク (Linuxでは KB 単位)
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"{name:<12} {seconds:10.3f}s {fps:12.1f} frames/s "
+        f"{peak / 1024 / 1024:10.1f} MB traced {peak_rss_mb:10.1f} MB rss"
+    )
+    return {"seconds": seconds, "fps": fps, "peak_traced_mb": peak / 1024 / 1024, "peak_rss_mb": peak_rss_mb}
+
+
+def run(args) -> int:
+    # キャッシュから復元すると計測にならないので使わない
+    result_cache.CACHE_DIR = ""
+
+    lib_data = make_lib_data(
+        args.tracks, args.frames, args.gap_every, args.gap_length, args.drop_rate, args.seed
+    )
+
+    results = {}
+    with tempfile.TemporaryDirectory() as output_dir_path:
+        _, seconds, peak = measure(
+            exec_pkl2json.convert, [lib_data], output_dir_path, trace_memory=args.trace_memory
+        )
+        original_json_paths = json_io.glob_json(os.path.join(output_dir_path, "*_original.json"))
+        frame_num = sum(exec_smooth.count_frames(json_path) for json_path in original_json_paths)
+
+        print(f"tracks: {len(original_json_paths)}, frames: {frame_num}")
+        results["convert"] = report("convert", frame_num, seconds, peak)
+
+        smooth_seconds, smooth_peak = 0.0, 0
+        for i, json_path in enumerate(original_json_paths):
+            _, seconds, peak = measure(
+                exec_smooth.smooth_frames,
+                i,
+                len(original_json_paths),
+                json_path,
+                trace_memory=args.trace_memory,
+            )
+            smooth_seconds += seconds
+            smooth_peak = max(smooth_peak, peak)
+        results["smooth"] = report("smooth", frame_num, smooth_seconds, smooth_peak)
+
+        # 平滑化結果のjson入出力のみ (比較のため従来の indent=4 の出力も計測)
+        load_seconds, dump_seconds, indent_seconds, serialize_peak = 0.0, 0.0, 0.0, 0
+        dump_bytes, indent_bytes = 0, 0
+        all_series = {}
+        for json_path in original_json_paths:
+            smooth_json_path = json_path.replace("_original.json", "_smooth.json")
+            track_name = os.path.basename(json_path).replace("_original.json", "")
+
+            data, seconds, peak = measure(json_io.load, smooth_json_path, trace_memory=args.trace_memory)
+            load_seconds += seconds
+            serialize_peak = max(serialize_peak, peak)
+
+            dump_path, seconds, peak = measure(
+                json_io.dump_frames,
+                os.path.join(output_dir_path, "dump.json"),
+                data["frames"],
+                trace_memory=args.trace_memory,
+            )
+            dump_seconds += seconds
+            dump_bytes += os.path.getsize(dump_path)
+            serialize_peak = max(serialize_peak, peak)
+
+            with open(os.path.join(output_dir_path, "indent.json"), "w") as f:
+                _, seconds, peak = measure(
+                    lambda: json.dump(data, f, indent=4), trace_memory=args.trace_memory
+                )
+            indent_seconds += seconds
+            indent_bytes += os.path.getsize(os.path.join(output_dir_path, "indent.json"))
+            serialize_peak = max(serialize_peak, peak)
+
+            all_series[track_name] = collect_series(smooth_json_path)
+
+        if args.chunk_size:
+            results["chunked"] = compare_chunked(original_json_paths[0], args.chunk_size, args.chunk_overlap)
+
+        results["json_load"] = report("json_load", frame_num, load_seconds, serialize_peak)
+        results["json_dump"] = report("json_dump", frame_num, dump_seconds, serialize_peak)
+        results["json_indent"] = report("json_indent", frame_num, indent_seconds, serialize_peak)
+        results["json_dump"]["bytes"] = dump_bytes
+        results["json_indent"]["bytes"] = indent_bytes
+        print(f"json size: {dump_bytes / 1024 / 1024:.2f} MB (indent=4: {indent_bytes / 1024 / 1024:.2f} MB)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        np.savez_compressed(args.baseline, **all_series)
+        print(f"Saved baseline: {args.baseline}")
+        return 0
+
+    mismatch_num = compare_despike(args.seed)
+    print(f"[{'NG' if mismatch_num else 'OK'}] despike: {mismatch_num} series differ from the sequential loop")
+
+    if not os.path.exists(args.baseline):
+        # 比較できないまま成功にしない
+        print(f"[NG] No baseline: {args.baseline} (run with --save-baseline)")
+        return 1
+
+    # 保存済みの平滑化結果と比較 (data/bench/baseline.npz は既定の引数で保存したもの)
+    baseline = np.load(args.baseline)
+    status = 1 if mismatch_num else 0
+    for track_name, series in all_series.items():
+        if track_name not in baseline or baseline[track_name].shape != series.shape:
+            print(f"[NG] {track_name}: shape mismatch")
+            status = 1
+            continue
+        diff = float(np.max(np.abs(baseline[track_name] - series)))
+        ok = diff <= args.tolerance
+        print(f"[{'OK' if ok else 'NG'}] {track_name}: max diff {diff:.3e}")
+        if not ok:
+            status = 1
+
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tracks", type=int, default=2)
+    parser.add_argument("--frames", type=int, default=120)
+    parser.add_argument("--gap-every", type=int, default=30, help="n フレームごとに欠損させる")
+    parser.add_argument("--gap-length", type=int, default=2, help="欠損させるフレーム数")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="ランダムに欠損させる確率")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=1e-6)
+    parser.add_argument("--chunk-size", type=int, default=0, help="区間に分けたUKFとの差を計測する区間のフレーム数")
+    parser.add_argument("--chunk-overlap", type=int, default=10)
+    parser.add_argument("--trace-memory", action="store_true", help="tracemalloc でステージ別のピークを計測する")
+    parser.add_argument("--output", help="計測結果のjson出力先")
+    args = parser.parse_args()
+
+    sys.exit(run(args))
@@ -5,6 +5,7 @@ import time
 
 import exec_smooth
 import exec_pkl2json
+import json_io
 
 
 if __name__ == "__main__":
@@ -18,7 +19,7 @@ if __name__ == "__main__":
 
     time.sleep(3)
 
-    original_json_paths = glob(os.path.join(output_dir_path, "*_original.json"))
+    original_json_paths = json_io.glob_json(os.path.join(output_dir_path, "*_original.json"))
     if not original_json_paths:
         # まだjson変換出来ていない場合、変換
         exec_pkl2json.main(output_dir_path)
@@ -28,8 +29,7 @@ if __name__ == "__main__":
 
     time.sleep(3)
 
-    smooth_json_paths = glob(os.path.join(output_dir_path, "*_smooth.json"))
-    if not smooth_json_paths or len(smooth_json_paths) < len(original_json_paths):
+    if exec_smooth.get_smooth_tasks(output_dir_path):
         # まだスムージング実行終わっていない場合、実行
         exec_smooth.smooth(output_dir_path, limit_minutes)
 
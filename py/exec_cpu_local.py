@@ -1,23 +1,16 @@
-from glob import glob
 import os
 import sys
-import time
 
-import exec_smooth
-import exec_pkl2json
+import exec_queue
 
 
 if __name__ == "__main__":
     output_dir_path = sys.argv[1]
-    limit_minutes = 24 * 60 * 60
 
-    exec_pkl2json.main(output_dir_path)
-    exec_smooth.smooth(output_dir_path, limit_minutes)
-
-    os.system(
-        f"./build/mat4 -modelPath='./data/pmx/v4_trace_model.pmx' -dirPath='{output_dir_path}' -limitMinutes={limit_minutes}"
-    )
-
-    time.sleep(3)
+    # 1ディレクトリ分をキューで実行する (途中で止めた場合は、同じコマンドで続きから実行する)
+    db_path = os.path.join(output_dir_path, "queue.sqlite3")
+    exec_queue.enqueue(db_path, [output_dir_path])
+    exec_queue.work_pool(db_path, os.cpu_count())
+    exec_queue.status(db_path)
 
     print("All CPU done!")
@@ -1,5 +1,3 @@
-from glob import glob
-import json
 import os
 import sys
 import cv2
@@ -9,6 +7,9 @@ from tqdm import tqdm
 
 from phalp.utils import get_pylogger
 
+import json_io
+import metrics
+
 log = get_pylogger(__name__)
 
 MP_JOINT_NAMES = [
@@ -73,8 +74,13 @@ HAND_JOINT_NAMES = [
 
 
 def exec_person_mediapipe(video_path: str, original_json_path: str):
-    with open(original_json_path) as f:
-        original_data = json.load(f)
+    metrics_record = metrics.start(
+        os.path.dirname(original_json_path),
+        "mediapipe",
+        os.path.basename(original_json_path).replace("_original.json", ""),
+    )
+
+    original_data = json_io.load(original_json_path)
 
     BaseOptions = mp.tasks.BaseOptions
     PoseLandmarker = mp.tasks.vision.PoseLandmarker
@@ -160,15 +166,20 @@ def exec_person_mediapipe(video_path: str, original_json_path: str):
                 }
             original_data["frames"][str(i)]["mediapipe"] = joints
 
-        with open(original_json_path.replace("_original", "_mp"), "w") as f:
-            json.dump(original_data, f, ensure_ascii=False, indent=4)
+        json_io.dump_frames(
+            original_json_path.replace("_original", "_mp"),
+            original_data["frames"],
+            {key: value for key, value in original_data.items() if key != "frames"},
+        )
+
+    metrics.finish(metrics_record, len(original_data["frames"]))
 
 
 def main(video_path: str, output_dir: str):
     log.info("Start: mediapipe =============================")
 
     # 該当ディレクトリ内のoriginal.jsonを探す
-    for json_fn in glob(os.path.join(output_dir, "*_original.json")):
+    for json_fn in json_io.glob_json(os.path.join(output_dir, "*_original.json")):
         exec_person_mediapipe(video_path, json_fn)
 
     log.info("End: mediapipe =============================")
@@ -7,8 +7,19 @@ import numpy as np
 from phalp.utils import get_pylogger
 from tqdm import tqdm
 
+import async_writer
+import frame_filter
+import joint_schema
+import json_io
+import metrics
+import result_cache
+import track_index
+
 log = get_pylogger(__name__)
 
+# 全トラックの出力を書き終えたら作る (途中で落ちた場合は作らない)
+COMPLETE_FILE_NAME = "pkl2json_complete"
+
 JOINT_NAMES = [
     # 25 OpenPose joints (in the order provided by OpenPose)
     "OP Nose",  # 0
@@ -65,10 +76,38 @@ JOINT_NAMES = [
 
 JOINT_INDEXES = dict([(j, i) for i, j in enumerate(JOINT_NAMES)])
 
+# トラックの選別 (いずれかを下回るトラックは、指定した場合に後続の処理をしない)
+# min_frames: 信頼度が frame_conf 以上のフレーム数 (go の usecase.Move は conf < 0.8 のフレームを使わない)
+# min_conf: 平均信頼度
+# min_bbox_ratio: 最も大きく映っているトラックに対する平均bbox面積の比
+# action: report (選別せずに結果だけ出力する) / defer (_deferred.json に出力して後で処理できるようにする) / exclude (出力しない)
+TRACK_QUALITY = {
+    "min_frames": int(os.environ.get("MAT4_TRACK_MIN_FRAMES", 30)),
+    "frame_conf": 0.8,
+    "min_conf": float(os.environ.get("MAT4_TRACK_MIN_CONF", 0.5)),
+    "min_bbox_ratio": float(os.environ.get("MAT4_TRACK_MIN_BBOX_RATIO", 0.05)),
+    "action": os.environ.get("MAT4_TRACK_PRUNE", "report"),
+}
+
+TRACK_QUALITY_FILE_NAME = "track_quality.json"
 
-def convert(all_lib_data: list[dict], output_dir_path):
-    all_data = {}
 
+def fuse_joints(joints: np.ndarray, joint_names: list[str]) -> dict:
+    """必要な関節だけを取り出す。MAT4_FUSE_JOINTS=1 の場合は同じ部位の重複定義を平均する"""
+    fused_joints = {}
+    for jname in joint_names:
+        indexes = [
+            JOINT_INDEXES[source_name]
+            for source_name in joint_schema.get_joint_sources(jname)
+            if JOINT_INDEXES[source_name] < len(joints)
+        ]
+        if indexes:
+            fused_joints[jname] = joints[indexes].mean(axis=0).tolist()
+    return fused_joints
+
+
+def get_start_z(all_lib_data: list[dict]) -> float:
+    # 最初に検出されたカメラのZ (グローバル位置のZの基準)
     start_z = 0
     for lib_data in all_lib_data:
         for k1 in sorted(lib_data.keys()):
@@ -79,80 +118,243 @@ def convert(all_lib_data: list[dict], output_dir_path):
                 break
         if start_z:
             break
+    return start_z
 
-    prev_last_key = 0
-    track_ids = []
 
-    for lib_data in all_lib_data:
-        start_time = -1
-        for k1 in tqdm(sorted(lib_data.keys())):
-            v1 = lib_data[k1]
-            time = v1["time"] + prev_last_key
-            if start_time == -1:
-                start_time = time
-
-            for t, tid in enumerate(v1["tracked_ids"]):
-                tracked_id = int(tid)
-
-                key = (tracked_id, start_time)
-                if key not in all_data:
-                    all_data[key] = {}
-
-                if tracked_id not in track_ids:
-                    track_ids.append(tracked_id)
-
-                all_data[key][time] = {}
-                if t < len(v1["tracked_bbox"]):
-                    all_data[key][time]["tracked_bbox"] = (
-                        v1["tracked_bbox"][t].astype(np.float64).tolist()
-                    )
-                if t < len(v1["conf"]):
-                    all_data[key][time]["conf"] = v1["conf"][t].astype(
-                        np.float64
-                    )
-
-                if t < len(v1["camera"]):
-                    cam_pos = v1["camera"][t].astype(np.float64).tolist()
-                    all_data[key][time]["camera"] = {
-                        "x": float(cam_pos[0]),
-                        "y": float(-cam_pos[1]),
-                        "z": float(cam_pos[2]),
+def convert_block(lib_data: dict, start_z: float, prev_last_key: int) -> dict:
+    """pkl 1ブロック分をトラック((tracked_id, start_time))ごとのフレームに変換する"""
+    block_data = {}
+
+    # 出力先で使う関節のみ出力する
+    joint_names_3d = joint_schema.get_joint_names("3d_joints")
+    joint_names_global_3d = joint_schema.get_joint_names("global_3d_joints")
+
+    start_time = -1
+    for k1 in tqdm(sorted(lib_data.keys())):
+        v1 = lib_data[k1]
+        time = v1["time"] + prev_last_key
+        if start_time == -1:
+            start_time = time
+
+        for t, tid in enumerate(v1["tracked_ids"]):
+            tracked_id = int(tid)
+
+            key = (tracked_id, start_time)
+            if key not in block_data:
+                block_data[key] = {}
+
+            block_data[key][time] = {}
+            if t < len(v1["tracked_bbox"]):
+                block_data[key][time]["tracked_bbox"] = (
+                    v1["tracked_bbox"][t].astype(np.float64).tolist()
+                )
+            if t < len(v1["conf"]):
+                block_data[key][time]["conf"] = v1["conf"][t].astype(
+                    np.float64
+                )
+
+            if t < len(v1["camera"]):
+                cam_pos = v1["camera"][t].astype(np.float64).tolist()
+                block_data[key][time]["camera"] = {
+                    "x": float(cam_pos[0]),
+                    "y": float(-cam_pos[1]),
+                    "z": float(cam_pos[2]),
+                }
+
+            if t < len(v1["3d_joints"]):
+                joints = v1["3d_joints"][t].astype(np.float64)
+
+                block_data[key][time]["3d_joints"] = {}
+                for jname, joint in fuse_joints(joints, joint_names_3d).items():
+                    block_data[key][time]["3d_joints"][jname] = {
+                        "x": float(joint[0]),
+                        "y": float(-joint[1]),
+                        "z": float(joint[2]),
                     }
 
-                if t < len(v1["3d_joints"]):
-                    joints = v1["3d_joints"][t].astype(np.float64).tolist()
-
-                    all_data[key][time]["3d_joints"] = {}
-                    for i, (joint, jname) in enumerate(zip(joints, JOINT_NAMES)):
-                        all_data[key][time]["3d_joints"][jname] = {
-                            "x": float(joint[0]),
-                            "y": float(-joint[1]),
-                            "z": float(joint[2]),
-                        }
-
-                    all_data[key][time]["global_3d_joints"] = {}
-                    for i, (joint, jname) in enumerate(zip(joints, JOINT_NAMES)):
-                        all_data[key][time]["global_3d_joints"][jname] = {
-                            "x": float(joint[0] + all_data[key][time]["camera"]["x"]),
-                            "y": float(-(
-                                joint[1] + all_data[key][time]["camera"]["y"]
-                            )),
-                            "z": float(joint[2]
-                            + (all_data[key][time]["camera"]["z"] - start_z)
-                            * 0.05),
-                        }
-
-                if t < len(v1["2d_joints"]):
-                    joints = (
-                        v1["2d_joints"][t].reshape(-1, 2).astype(np.float64).tolist()
-                    )
-
-                    all_data[key][time]["2d_joints"] = {}
-                    for i, (joint, jname) in enumerate(zip(joints, JOINT_NAMES)):
-                        all_data[key][time]["2d_joints"][jname] = {
-                            "x": float(joint[0]),
-                            "y": float(joint[1]),
-                        }
+                block_data[key][time]["global_3d_joints"] = {}
+                for jname, joint in fuse_joints(joints, joint_names_global_3d).items():
+                    block_data[key][time]["global_3d_joints"][jname] = {
+                        "x": float(joint[0] + block_data[key][time]["camera"]["x"]),
+                        "y": float(-(
+                            joint[1] + block_data[key][time]["camera"]["y"]
+                        )),
+                        "z": float(joint[2]
+                        + (block_data[key][time]["camera"]["z"] - start_z)
+                        * 0.05),
+                    }
+
+            if t < len(v1["2d_joints"]):
+                joints = v1["2d_joints"][t].reshape(-1, 2).astype(np.float64)
+
+                block_data[key][time]["2d_joints"] = {}
+                for joint, jname in zip(joints.tolist(), JOINT_NAMES):
+                    block_data[key][time]["2d_joints"][jname] = {
+                        "x": float(joint[0]),
+                        "y": float(joint[1]),
+                    }
+
+    return block_data
+
+
+def get_original_json_path(output_dir_path: str, tracked_id: int, start_time: int, suffix: str = "original") -> str:
+    return os.path.join(output_dir_path, f"{start_time:05d}_{tracked_id:02d}_{suffix}.json")
+
+
+def write_original_json(
+    output_dir_path: str,
+    tracked_id: int,
+    start_time: int,
+    frames: dict,
+    start_z: float,
+    suffix: str = "original",
+    writer: async_writer.AsyncWriter = None,
+    skipped_fnos: set = None,
+):
+    header = {"camera_start_z": float(start_z)}
+    # トラックの途中で検出を飛ばしたフレームは、平滑化で前後から補間する
+    track_skipped_fnos = get_track_skipped_fnos(frames, skipped_fnos)
+    if track_skipped_fnos:
+        header["skipped_fnos"] = track_skipped_fnos
+
+    # 一時ファイルへはシリアライズしながら書き、ディスクへの書き込みと置き換えを次のトラックのシリアライズと重ねる
+    json_path = get_original_json_path(output_dir_path, tracked_id, start_time, suffix)
+    tmp_path = json_io.write_tmp_file(json_path, json_io.encode_frames(frames, header))
+    if writer:
+        writer.submit(save_original_json, output_dir_path, tracked_id, start_time, frames, tmp_path, suffix)
+    else:
+        save_original_json(output_dir_path, tracked_id, start_time, frames, tmp_path, suffix)
+
+
+def get_track_skipped_fnos(frames: dict, skipped_fnos: set) -> list[int]:
+    """トラックの最初と最後のフレームの間で、検出を飛ばしたフレーム番号"""
+    if not skipped_fnos or not frames:
+        return []
+    start_fno = min(frames.keys())
+    end_fno = max(frames.keys())
+    return sorted(fno for fno in skipped_fnos if start_fno < fno < end_fno and fno not in frames)
+
+
+def save_original_json(
+    output_dir_path: str, tracked_id: int, start_time: int, frames: dict, tmp_path: str, suffix: str = "original"
+):
+    json_path = get_original_json_path(output_dir_path, tracked_id, start_time, suffix)
+
+    with metrics.measure(output_dir_path, "pkl2json_write", f"{start_time:05d}_{tracked_id:02d}") as record:
+        record["frames"] = len(frames)
+        # 一時ファイルから置き換えるので、キャッシュとハードリンクしていても書き換わらない
+        output_path = json_io.replace_tmp_file(json_path, tmp_path)
+
+    track_index.register_track(
+        output_dir_path, tracked_id, start_time, frames, "done" if suffix == "original" else suffix, output_path
+    )
+    # log.info(f"Saved: {json_path}")
+
+
+def score_tracks(all_data: dict) -> dict:
+    """トラックごとの長さ、信頼度、bbox面積"""
+    scores = {}
+    for key, frames in all_data.items():
+        confs = np.array([frame_data.get("conf", 0.0) for frame_data in frames.values()], dtype=np.float64)
+        areas = [
+            frame_data["tracked_bbox"][2] * frame_data["tracked_bbox"][3]
+            for frame_data in frames.values()
+            if "tracked_bbox" in frame_data
+        ]
+        scores[key] = {
+            "frames": len(frames),
+            "usable_frames": int(np.sum(confs >= TRACK_QUALITY["frame_conf"])),
+            "mean_conf": float(np.mean(confs)) if len(confs) else 0.0,
+            "bbox_area": float(np.mean(areas)) if areas else 0.0,
+        }
+
+    max_area = max([score["bbox_area"] for score in scores.values()] + [0.0])
+    for score in scores.values():
+        score["bbox_ratio"] = score["bbox_area"] / max_area if max_area > 0 else 1.0
+
+    return scores
+
+
+def judge_track(score: dict) -> list[str]:
+    """閾値を下回った項目"""
+    reasons = []
+    if score["usable_frames"] < TRACK_QUALITY["min_frames"]:
+        reasons.append("frames")
+    if score["mean_conf"] < TRACK_QUALITY["min_conf"]:
+        reasons.append("conf")
+    if score["bbox_ratio"] < TRACK_QUALITY["min_bbox_ratio"]:
+        reasons.append("bbox")
+    return reasons
+
+
+def write_track_quality(output_dir_path: str, track_quality: dict):
+    # オンライン平滑化ではブロックごとに追記する
+    quality_path = os.path.join(output_dir_path, TRACK_QUALITY_FILE_NAME)
+    tracks = {}
+    if os.path.exists(quality_path):
+        with open(quality_path, "r") as f:
+            tracks = json.load(f)["tracks"]
+    tracks.update(track_quality)
+
+    tmp_path = f"{quality_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"thresholds": TRACK_QUALITY, "tracks": dict(sorted(tracks.items()))}, f, indent=4)
+    os.replace(tmp_path, quality_path)
+
+
+def prune_tracks(all_data: dict, output_dir_path: str, start_z: float, skipped_fnos: set = None) -> dict:
+    """品質の低いトラックを除いて返す。後回しにするトラックは _deferred.json に出力する"""
+    scores = score_tracks(all_data)
+
+    kept_data = {}
+    track_quality = {}
+    below_num = 0
+    for (tracked_id, start_time), score in sorted(scores.items()):
+        reasons = judge_track(score)
+        if reasons:
+            below_num += 1
+        if not reasons or TRACK_QUALITY["action"] == "report":
+            status = "kept"
+            kept_data[(tracked_id, start_time)] = all_data[(tracked_id, start_time)]
+        elif TRACK_QUALITY["action"] == "defer":
+            status = "deferred"
+            write_original_json(
+                output_dir_path,
+                tracked_id,
+                start_time,
+                all_data[(tracked_id, start_time)],
+                start_z,
+                "deferred",
+                skipped_fnos=skipped_fnos,
+            )
+        else:
+            status = "excluded"
+            track_index.register_track(
+                output_dir_path, tracked_id, start_time, all_data[(tracked_id, start_time)], status
+            )
+
+        track_quality[f"{start_time:05d}_{tracked_id:02d}"] = {**score, "status": status, "reasons": reasons}
+
+    if track_quality:
+        write_track_quality(output_dir_path, track_quality)
+
+    if TRACK_QUALITY["action"] == "report":
+        log.info(f"Track quality: {below_num} / {len(all_data)} below thresholds (report only)")
+    else:
+        log.info(f"Track quality: kept {len(kept_data)} / {len(all_data)} ({TRACK_QUALITY['action']} the rest)")
+
+    return kept_data
+
+
+def convert(all_lib_data: list[dict], output_dir_path):
+    all_data = {}
+
+    start_z = get_start_z(all_lib_data)
+    skipped_fnos = set(frame_filter.load_skipped_frames(output_dir_path).keys())
+
+    prev_last_key = 0
+    for lib_data in all_lib_data:
+        all_data.update(convert_block(lib_data, start_z, prev_last_key))
 
         # 終わったら最後のキーを保持
         prev_last_key = int(sorted(lib_data.keys())[-1])
@@ -161,24 +363,88 @@ def convert(all_lib_data: list[dict], output_dir_path):
         log.error("No data to convert!")
         return
 
-    for tracked_id, start_time in tqdm(sorted(all_data.keys())):
-        json_path = os.path.join(output_dir_path, f"{start_time:05d}_{tracked_id:02d}_original.json")
-        key = (tracked_id, start_time)
+    # 使われないトラックは後続の処理をしない
+    all_data = prune_tracks(all_data, output_dir_path, start_z, skipped_fnos)
+
+    with async_writer.AsyncWriter() as writer:
+        for tracked_id, start_time in tqdm(sorted(all_data.keys())):
+            write_original_json(
+                output_dir_path,
+                tracked_id,
+                start_time,
+                all_data[(tracked_id, start_time)],
+                start_z,
+                writer=writer,
+                skipped_fnos=skipped_fnos,
+            )
+
+
+def get_cache_key(pkl_paths: list[str], output_dir_path: str) -> str:
+    # 出力する関節と処理コードが変わった場合も別の結果として扱う
+    # 飛ばしたフレームの記録は header に出力するので入力に含める
+    return result_cache.get_key(
+        "pkl2json",
+        pkl_paths + glob(os.path.join(output_dir_path, frame_filter.SKIPPED_FRAMES_FILE_NAME)),
+        (
+            {
+                type_name: joint_schema.get_joint_names(type_name)
+                for type_name in ("3d_joints", "global_3d_joints")
+            },
+            joint_schema.FUSE_JOINTS,
+            TRACK_QUALITY,
+            json_io.JSON_FORMAT,
+        ),
+        [__file__, joint_schema.__file__, frame_filter.__file__],
+    )
 
-        with open(json_path, "w") as f:
-            json.dump({"frames": all_data[key]}, f, indent=4)
-        # log.info(f"Saved: {json_path}")
+
+def get_complete_path(output_dir_path: str) -> str:
+    return os.path.join(output_dir_path, COMPLETE_FILE_NAME)
+
+
+def write_complete(output_dir_path: str):
+    complete_path = get_complete_path(output_dir_path)
+    tmp_path = f"{complete_path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, complete_path)
 
 
 def main(output_dir_path):
     log.info("Start: pkl to json =============================")
 
-    all_lib_data = []
-    for pkl_path in sorted(glob(os.path.join(output_dir_path, "*.pkl"))):
-        with open(pkl_path, "rb") as f:
-            all_lib_data.append(joblib.load(f))
+    # やり直す場合は完了の印を消してから出力する
+    if os.path.exists(get_complete_path(output_dir_path)):
+        os.remove(get_complete_path(output_dir_path))
+
+    pkl_paths = sorted(glob(os.path.join(output_dir_path, "*.pkl")))
+
+    # 同じpklを変換済みならキャッシュから復元する
+    cache_key = get_cache_key(pkl_paths, output_dir_path)
+    if result_cache.restore(cache_key, output_dir_path):
+        write_complete(output_dir_path)
+        log.info("End: pkl to json (cached) =============================")
+        return
+
+    with metrics.measure(output_dir_path, "pkl2json") as record:
+        all_lib_data = []
+        for pkl_path in pkl_paths:
+            with open(pkl_path, "rb") as f:
+                all_lib_data.append(joblib.load(f))
+        record["frames"] = sum(len(lib_data) for lib_data in all_lib_data)
+
+        convert(all_lib_data, output_dir_path)
 
-    convert(all_lib_data, output_dir_path)
+    output_paths = [
+        json_io.find(json_path)
+        for json_path in json_io.glob_json(os.path.join(output_dir_path, "*_original.json"))
+        + json_io.glob_json(os.path.join(output_dir_path, "*_deferred.json"))
+    ]
+    output_paths += glob(os.path.join(output_dir_path, TRACK_QUALITY_FILE_NAME))
+    output_paths += glob(track_index.get_index_path(output_dir_path))
+    result_cache.store(cache_key, {os.path.basename(output_path): output_path for output_path in output_paths})
+    write_complete(output_dir_path)
 
     log.info("End: pkl to json =============================")
 
@@ -0,0 +1,313 @@
+import argparse
+import os
+import socket
+import sqlite3
+import subprocess
+import time
+from multiprocessing import Process
+
+from phalp.utils import get_pylogger
+
+import json_io
+
+log = get_pylogger(__name__)
+
+# ステージの実行順
+STAGES = ["pkl2json", "smooth", "mat4"]
+
+# 失敗時の最大試行回数
+MAX_ATTEMPTS = 3
+
+# 失敗したタスクを再実行するまでの待ち時間(秒)。失敗するたびに倍にする
+RETRY_DELAY_SECONDS = float(os.environ.get("MAT4_QUEUE_RETRY_DELAY", 30))
+
+# 空き待ちのポーリング間隔(秒)
+POLL_SECONDS = 5
+
+MODEL_PATH = "./data/pmx/v4_trace_model.pmx"
+MAT4_PATH = "./build/mat4"
+MAT4_LIMIT_MINUTES = 24 * 60 * 60
+# mat4 で並列に変換するトラック数
+MAT4_WORKERS = int(os.environ.get("MAT4_WORKERS", 1))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    directory TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    track TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    error TEXT,
+    updated_at REAL,
+    UNIQUE (directory, stage, track)
+)
+"""
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(SCHEMA)
+    return conn
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def add_task(conn: sqlite3.Connection, directory: str, stage: str, track: str = ""):
+    # 既に登録済みのタスクはそのまま(状態を引き継ぐ)
+    conn.execute(
+        "INSERT OR IGNORE INTO tasks (directory, stage, track, updated_at) VALUES (?, ?, ?, ?)",
+        (os.path.abspath(directory), stage, track, time.time()),
+    )
+
+
+def enqueue(db_path: str, output_dir_paths: list[str]):
+    conn = connect(db_path)
+    for output_dir_path in output_dir_paths:
+        add_task(conn, output_dir_path, "pkl2json")
+        log.info(f"Enqueued: {output_dir_path}")
+    conn.close()
+
+
+def recover(conn: sqlite3.Connection):
+    # 同じホストで実行中のまま落ちたタスクを未着手に戻す
+    host = socket.gethostname()
+    for row in conn.execute("SELECT id, worker FROM tasks WHERE status = 'running'").fetchall():
+        if not row["worker"]:
+            continue
+        worker_host, pid = row["worker"].rsplit(":", 1)
+        if worker_host != host:
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except (OSError, ValueError):
+            log.info(f"Recover task: {row['id']} ({row['worker']})")
+            conn.execute(
+                "UPDATE tasks SET status = 'pending', worker = NULL, updated_at = ? WHERE id = ?",
+                (time.time(), row["id"]),
+            )
+
+
+def claim(conn: sqlite3.Connection):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # 失敗したタスクは待ち時間が過ぎてから再実行する
+        row = conn.execute(
+            "SELECT * FROM tasks WHERE status = 'pending' "
+            "AND (attempts = 0 OR updated_at + ? * (1 << (attempts - 1)) <= ?) ORDER BY id LIMIT 1",
+            (RETRY_DELAY_SECONDS, time.time()),
+        ).fetchone()
+        if row:
+            conn.execute(
+                "UPDATE tasks SET status = 'running', worker = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (worker_name(), time.time(), row["id"]),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return row
+
+
+def count_unfinished(conn: sqlite3.Connection) -> int:
+    return conn.execute(
+        "SELECT COUNT(*) FROM tasks WHERE status IN ('pending', 'running')"
+    ).fetchone()[0]
+
+
+def complete(conn: sqlite3.Connection, task: sqlite3.Row):
+    json_paths = []
+    if task["stage"] == "pkl2json":
+        import exec_smooth
+        import scheduler
+
+        # exec_smooth.smooth と同じく、スケジューラの順 (長いものから) で平滑化する
+        json_paths = scheduler.order_tasks(
+            {
+                json_path: exec_smooth.count_frames(json_path)
+                for json_path in json_io.glob_json(os.path.join(task["directory"], "*_original.json"))
+            }
+        )
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "UPDATE tasks SET status = 'done', error = NULL, updated_at = ? WHERE id = ?",
+            (time.time(), task["id"]),
+        )
+
+        # 後続ステージのタスクを登録
+        if task["stage"] == "pkl2json":
+            for json_path in json_paths:
+                add_task(conn, task["directory"], "smooth", os.path.basename(json_path))
+        elif task["stage"] == "smooth":
+            add_mat4_task(conn, task["directory"])
+
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def add_mat4_task(conn: sqlite3.Connection, directory: str):
+    """smooth が全て終わったら(失敗したものを除いて) mat4 を登録する"""
+    counts = {
+        row["status"]: row["num"]
+        for row in conn.execute(
+            "SELECT status, COUNT(*) AS num FROM tasks WHERE directory = ? AND stage = 'smooth' GROUP BY status",
+            (directory,),
+        ).fetchall()
+    }
+    if counts.get("pending") or counts.get("running"):
+        return
+
+    if counts.get("failed"):
+        log.error(f"Smooth failed: {counts['failed']} tracks in {directory} (retry to convert them)")
+    if not counts.get("done"):
+        log.error(f"No smoothed track to convert: {directory}")
+        return
+
+    add_task(conn, directory, "mat4")
+    # 失敗したトラックを retry した場合は、変換済みのトラックを飛ばしてもう一度 mat4 を実行する
+    conn.execute(
+        "UPDATE tasks SET status = 'pending', attempts = 0, error = NULL, updated_at = ? "
+        "WHERE directory = ? AND stage = 'mat4' AND status IN ('done', 'failed')",
+        (time.time(), directory),
+    )
+
+
+def fail(conn: sqlite3.Connection, task: sqlite3.Row, error: str):
+    # 試行回数が残っていれば再実行待ちに戻す
+    status = "pending" if task["attempts"] + 1 < MAX_ATTEMPTS else "failed"
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "UPDATE tasks SET status = ?, worker = NULL, error = ?, updated_at = ? WHERE id = ?",
+            (status, error, time.time(), task["id"]),
+        )
+
+        # 失敗が確定したトラックで mat4 を止めない
+        if status == "failed" and task["stage"] == "smooth":
+            add_mat4_task(conn, task["directory"])
+
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def run_task(task: sqlite3.Row):
+    output_dir_path = task["directory"]
+
+    if task["stage"] == "pkl2json":
+        import exec_pkl2json
+
+        # 途中で落ちて一部のトラックだけ出力されている場合もやり直す
+        if not os.path.exists(exec_pkl2json.get_complete_path(output_dir_path)):
+            exec_pkl2json.main(output_dir_path)
+    elif task["stage"] == "smooth":
+        import exec_smooth
+
+        json_path = os.path.join(output_dir_path, task["track"])
+        if not json_io.exists(json_path.replace("_original.json", "_smooth.json")):
+            # 実績をスケジューラに記録して、exec_smooth.smooth と同じ見積もりに使う
+            exec_smooth.smooth_track(0, 1, json_path, exec_smooth.count_frames(json_path))
+    elif task["stage"] == "mat4":
+        result = subprocess.run(
+            [
+                MAT4_PATH,
+                f"-modelPath={MODEL_PATH}",
+                f"-dirPath={output_dir_path}",
+                f"-limitMinutes={MAT4_LIMIT_MINUTES}",
+                f"-workers={MAT4_WORKERS}",
+            ]
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"mat4 exited with {result.returncode}")
+        if not os.path.exists(os.path.join(output_dir_path, "all_complete")):
+            raise RuntimeError("mat4 did not complete all motions")
+    else:
+        raise ValueError(f"Unknown stage: {task['stage']}")
+
+
+def work(db_path: str):
+    conn = connect(db_path)
+
+    while True:
+        task = claim(conn)
+        if not task:
+            # 実行中のタスクが後続タスクを登録する可能性があるので、全部終わるまで待つ
+            if not count_unfinished(conn):
+                break
+            time.sleep(POLL_SECONDS)
+            continue
+
+        log.info(f"[{worker_name()}] Start: {task['stage']} {task['directory']} {task['track']}")
+        try:
+            run_task(task)
+        except Exception as e:
+            log.error(f"[{worker_name()}] Failed: {task['stage']} {task['directory']} {task['track']}: {e}")
+            fail(conn, task, repr(e))
+            continue
+
+        complete(conn, task)
+        log.info(f"[{worker_name()}] End: {task['stage']} {task['directory']} {task['track']}")
+
+    conn.close()
+
+
+def work_pool(db_path: str, workers: int):
+    conn = connect(db_path)
+    recover(conn)
+    conn.close()
+
+    processes = [Process(target=work, args=(db_path,)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def status(db_path: str):
+    conn = connect(db_path)
+    for row in conn.execute(
+        "SELECT directory, stage, status, COUNT(*) AS num FROM tasks GROUP BY directory, stage, status ORDER BY directory, stage"
+    ).fetchall():
+        print(f"{row['directory']}\t{row['stage']}\t{row['status']}\t{row['num']}")
+    for row in conn.execute("SELECT * FROM tasks WHERE status = 'failed'").fetchall():
+        print(f"FAILED: {row['directory']}\t{row['stage']}\t{row['track']}\t{row['error']}")
+    conn.close()
+
+
+def retry(db_path: str):
+    # 失敗したタスクを再実行待ちに戻す
+    conn = connect(db_path)
+    conn.execute(
+        "UPDATE tasks SET status = 'pending', attempts = 0, worker = NULL, updated_at = ? WHERE status = 'failed'",
+        (time.time(),),
+    )
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["enqueue", "work", "status", "retry"])
+    parser.add_argument("output_dirs", nargs="*")
+    parser.add_argument("--db", default="queue.sqlite3")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.command == "enqueue":
+        enqueue(args.db, args.output_dirs)
+    elif args.command == "work":
+        work_pool(args.db, args.workers)
+    elif args.command == "status":
+        status(args.db)
+    elif args.command == "retry":
+        retry(args.db)
@@ -1,19 +1,80 @@
-from glob import glob
+import hashlib
 import json
 import os
+import pickle
 import sys
 import time
 
 import numpy as np
 from pykalman import UnscentedKalmanFilter
+from scipy import signal
 from tqdm import tqdm
-from exec_pkl2json import JOINT_NAMES
+import async_writer
+import joint_schema
+import json_io
+import metrics
+import result_cache
+import scheduler
+import track_index
 # from exec_mediapipe import MP_JOINT_NAMES
 
 from phalp.utils import get_pylogger
 
 log = get_pylogger(__name__)
 
+# グローバル位置の求め方
+# smooth: グローバル位置も系列ごとに平滑化する
+# derive: ローカル位置とカメラのみ平滑化して、グローバル位置はそこから求める
+GLOBAL_JOINTS_MODE = os.environ.get("MAT4_GLOBAL_JOINTS", "smooth")
+
+# カメラの跳ね除去
+# window: 跳ねとみなす最大フレーム数
+# same_threshold: 跳ねる前後が同じ値とみなす差
+# spike_threshold: 跳ねたとみなす差
+CAMERA_DESPIKE = {
+    "window": 2,
+    "same_threshold": 0.001,
+    "spike_threshold": 0.002,
+}
+
+# 平滑化方法 (指定した場合は全トラック・全関節で使う)
+SMOOTHER = os.environ.get("MAT4_SMOOTHER", "")
+
+# 平滑化方法ごとのパラメータ
+SMOOTHER_PARAMS = {
+    "one_euro": {"min_cutoff": 1.0, "beta": 0.3, "d_cutoff": 1.0, "fps": 30},
+    "savgol": {"window_length": 9, "polyorder": 2},
+    "butterworth": {"order": 2, "cutoff": 6.0, "fps": 30},
+}
+
+# 関節グループ (ここにないものは body、カメラは camera)
+JOINT_GROUPS = {
+    "face": ["OP Nose", "OP REye", "OP LEye", "OP REar", "OP LEar", "Head (H36M)", "Top of Head (LSP)"],
+    "foot": ["OP LBigToe", "OP LSmallToe", "OP LHeel", "OP RBigToe", "OP RSmallToe", "OP RHeel"],
+}
+
+# トラックごとの平滑化方法 (上から順に条件に合うもの、グループの指定がなければ default)
+# min_conf/max_conf: トラックの平均信頼度, min_frames/max_frames: トラックのフレーム数
+# 既定は全トラックUKF。MAT4_SMOOTHER_RULES に同じ形式のjsonファイルを指定した場合はそれを使う。例:
+# [
+#     {"max_conf": 0.8, "smoothers": {"default": "savgol"}},
+#     {"min_frames": 18000, "smoothers": {"face": "one_euro", "foot": "one_euro", "default": "ukf"}},
+#     {"smoothers": {"default": "ukf"}}
+# ]
+SMOOTHER_RULES = [
+    {"smoothers": {"default": "ukf"}},
+]
+if os.environ.get("MAT4_SMOOTHER_RULES"):
+    with open(os.environ["MAT4_SMOOTHER_RULES"], "r", encoding="utf-8") as f:
+        SMOOTHER_RULES = json.load(f)
+
+# 長いトラックはUKFを区間ごとに分けて平滑化する (区間のフレーム数, 前後の区間と重ねるフレーム数)
+# size が 0 の場合は分けない (既定。系列全体の平滑化と結果が変わるので、使う場合は MAT4_UKF_CHUNK_SIZE=3000 などを指定する)
+UKF_CHUNK = {
+    "size": int(os.environ.get("MAT4_UKF_CHUNK_SIZE", 0)),
+    "overlap": 150,
+}
+
 JOINT_NOISE = {
     ("camera", "x"): 2.0,
     ("camera", "y"): 2.0,
@@ -106,9 +167,282 @@ JOINT_NOISE = {
 }
 
 
-def smooth_frames(i: int, all: int, json_path: str, start_camera_z: float = None):
-    with open(json_path, "r") as f:
-        data = json.load(f)
+def get_checkpoint_path(json_path: str) -> str:
+    return json_path.replace("_original.json", "_smooth.ckpt")
+
+
+def get_smooth_params(global_joints_mode: str = GLOBAL_JOINTS_MODE) -> tuple:
+    """平滑化結果に影響するパラメータ"""
+    return (
+        sorted(JOINT_NOISE.items(), key=str),
+        global_joints_mode,
+        (SMOOTHER, SMOOTHER_PARAMS, JOINT_GROUPS, SMOOTHER_RULES, UKF_CHUNK),
+    )
+
+
+def get_checkpoint_key(json_path: str, global_joints_mode: str = GLOBAL_JOINTS_MODE) -> str:
+    # 入力jsonの内容とパラメータが変わったらチェックポイントは無効
+    sha1 = hashlib.sha1()
+    result_cache.update_file_hash(sha1, json_io.find(json_path))
+    sha1.update(repr(get_smooth_params(global_joints_mode)).encode())
+    return sha1.hexdigest()
+
+
+def get_cache_key(json_path: str, global_joints_mode: str = GLOBAL_JOINTS_MODE) -> str:
+    # 処理コードが変わった場合も別の結果として扱う
+    return result_cache.get_key(
+        "smooth",
+        [json_io.find(json_path)],
+        (get_smooth_params(global_joints_mode), json_io.JSON_FORMAT),
+        [__file__, joint_schema.__file__],
+    )
+
+
+def load_checkpoint(checkpoint_path: str, checkpoint_key: str) -> dict:
+    """系列名ごとの平滑化済み位置を読み込む。キーが一致しない場合は空"""
+    if not os.path.exists(checkpoint_path):
+        return {}
+
+    smoothed_poses = {}
+    with open(checkpoint_path, "rb") as f:
+        try:
+            if pickle.load(f) != checkpoint_key:
+                log.info(f"Discard checkpoint: {checkpoint_path}")
+                return {}
+        except Exception:
+            return {}
+
+        valid_size = f.tell()
+        while True:
+            try:
+                series_name, poses = pickle.load(f)
+            except Exception:
+                # 末尾まで読んだ or 書き込み途中で落ちたレコード
+                break
+            smoothed_poses[series_name] = poses
+            valid_size = f.tell()
+
+    # 壊れた末尾を切り詰めてから追記する
+    with open(checkpoint_path, "r+b") as f:
+        f.truncate(valid_size)
+
+    log.info(f"Resume checkpoint: {checkpoint_path} ({len(smoothed_poses)} series)")
+
+    return smoothed_poses
+
+
+def open_checkpoint(checkpoint_path: str, checkpoint_key: str, is_resume: bool):
+    if is_resume:
+        return open(checkpoint_path, "ab")
+
+    f = open(checkpoint_path, "wb")
+    pickle.dump(checkpoint_key, f, protocol=pickle.HIGHEST_PROTOCOL)
+    f.flush()
+    return f
+
+
+def write_checkpoint(f, series_name: tuple, poses: np.ndarray):
+    pickle.dump((series_name, poses), f, protocol=pickle.HIGHEST_PROTOCOL)
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def despike_at(
+    values: np.ndarray, index: int, window: int, same_threshold: float, spike_threshold: float
+) -> bool:
+    """index のフレームで跳ねを判定して、跳ねたフレームを index の値にする (元の逐次処理と同じ判定)"""
+    value = values[index]
+    is_changed = False
+    for length in range(1, window + 1):
+        if index <= length or abs(values[index - length - 1] - value) >= same_threshold:
+            continue
+        if all(abs(values[index - m] - value) > spike_threshold for m in range(1, length + 1)):
+            values[index - length : index] = value
+            is_changed = True
+            log.debug(f"camera override {length}: {index}")
+    return is_changed
+
+
+def despike(
+    values: np.ndarray,
+    window: int = CAMERA_DESPIKE["window"],
+    same_threshold: float = CAMERA_DESPIKE["same_threshold"],
+    spike_threshold: float = CAMERA_DESPIKE["spike_threshold"],
+) -> np.ndarray:
+    """前後が同じ値で、間の window フレーム以内だけ跳ねている場合は、跳ねたフレームを後の値にする
+
+    先頭から1フレームずつ、置き換えた後の値で判定する。直前が書き換わっていないフレームは元の値で判定しても同じなので、
+    元の値で跳ねと判定したフレームから、直前 window + 1 フレームが元の値に戻るまでだけ逐次に判定する
+    """
+    source_values = values
+    values = values.copy()
+
+    # 元の値で跳ねと判定されるフレーム
+    candidate_mask = np.zeros(len(values), dtype=bool)
+    for length in range(1, window + 1):
+        indexes = np.arange(length + 1, len(values))
+        if not len(indexes):
+            break
+        current_values = source_values[indexes]
+
+        # 跳ねる前と同じ値に戻っている
+        mask = np.abs(source_values[indexes - length - 1] - current_values) < same_threshold
+        # 間のフレームはすべて跳ねている
+        for m in range(1, length + 1):
+            mask &= np.abs(source_values[indexes - m] - current_values) > spike_threshold
+        candidate_mask[indexes[mask]] = True
+
+    next_index = 0
+    for index in np.flatnonzero(candidate_mask):
+        index = max(int(index), next_index)
+        while index < len(values):
+            despike_at(values, index, window, same_threshold, spike_threshold)
+            index += 1
+            # 直前が元の値に戻ったら、次の候補まで判定は変わらない
+            start = max(0, index - window - 1)
+            if np.array_equal(values[start:index], source_values[start:index]):
+                break
+        next_index = index
+
+    return values
+
+
+def get_camera_start_z(data: dict) -> float:
+    """グローバル位置のZの基準にしているカメラZ (exec_pkl2json.convert の start_z)"""
+    if "camera_start_z" in data:
+        return data["camera_start_z"]
+
+    # 古いjsonは先頭フレームのローカル位置とグローバル位置の差から逆算する
+    for frame_data in data["frames"].values():
+        if "camera" not in frame_data or "global_3d_joints" not in frame_data:
+            continue
+        for jname, global_joint in frame_data["global_3d_joints"].items():
+            if jname in frame_data.get("3d_joints", {}):
+                return frame_data["camera"]["z"] - (global_joint["z"] - frame_data["3d_joints"][jname]["z"]) / 0.05
+        return frame_data["camera"]["z"]
+
+    return 0.0
+
+
+def add_local_joints(data: dict, joint_names: list[str], camera_start_z: float):
+    """グローバル位置しか出力されていない関節のローカル位置を求める"""
+    for frame_data in data["frames"].values():
+        if "camera" not in frame_data or "3d_joints" not in frame_data:
+            continue
+        camera = frame_data["camera"]
+        for jname in joint_names:
+            if jname in frame_data["3d_joints"] or jname not in frame_data.get("global_3d_joints", {}):
+                continue
+            global_joint = frame_data["global_3d_joints"][jname]
+            frame_data["3d_joints"][jname] = {
+                "x": global_joint["x"] - camera["x"],
+                "y": global_joint["y"] + camera["y"],
+                "z": global_joint["z"] - (camera["z"] - camera_start_z) * 0.05,
+            }
+
+
+def derive_global_joints(smoothed_data: dict, joint_names: dict, camera_start_z: float):
+    """平滑化後のローカル位置とカメラからグローバル位置を求める (exec_pkl2json.convert と同じ式)"""
+    for frame_data in smoothed_data["frames"].values():
+        camera = frame_data["camera"]
+        for jname in joint_names["global_3d_joints"]:
+            if jname not in frame_data["3d_joints"]:
+                continue
+            joint = frame_data["3d_joints"][jname]
+            frame_data["global_3d_joints"][jname] = {
+                "x": joint["x"] + camera["x"],
+                "y": joint["y"] - camera["y"],
+                "z": joint["z"] + (camera["z"] - camera_start_z) * 0.05,
+            }
+
+        # グローバル位置を求めるためだけに平滑化したローカル位置は出力しない
+        for jname in list(frame_data["3d_joints"].keys()):
+            if jname not in joint_names["3d_joints"]:
+                del frame_data["3d_joints"][jname]
+
+
+def get_smooth_joint_names(global_joints_mode: str = GLOBAL_JOINTS_MODE) -> tuple[dict, dict]:
+    """平滑化する関節名と出力する関節名"""
+    # 出力先で使う関節のみ平滑化する
+    output_joint_names = {
+        "3d_joints": joint_schema.get_joint_names("3d_joints"),
+        "global_3d_joints": joint_schema.get_joint_names("global_3d_joints"),
+    }
+
+    if global_joints_mode != "derive":
+        return output_joint_names, output_joint_names
+
+    # グローバル位置で使う関節もローカル位置で平滑化する
+    joint_names = {
+        "3d_joints": output_joint_names["3d_joints"]
+        + [
+            jname
+            for jname in output_joint_names["global_3d_joints"]
+            if jname not in output_joint_names["3d_joints"]
+        ],
+        "global_3d_joints": [],
+    }
+    return joint_names, output_joint_names
+
+
+def get_skipped_mask(data: dict, start_fno: int, frame_mask: np.ndarray) -> np.ndarray:
+    """検出を飛ばしたフレーム (pkl2json の skipped_fnos) のうち、観測のないフレーム"""
+    skipped_fnos = np.array(data.get("skipped_fnos", []), dtype=np.int64)
+    skipped_fnos = skipped_fnos[(start_fno <= skipped_fnos) & (skipped_fnos < start_fno + len(frame_mask))]
+
+    skipped_mask = np.zeros(len(frame_mask), dtype=bool)
+    skipped_mask[skipped_fnos - start_fno] = True
+    return skipped_mask & ~frame_mask
+
+
+def fill_frames(
+    values: np.ndarray, frame_mask: np.ndarray, source_indexes: np.ndarray, skipped_mask: np.ndarray
+) -> np.ndarray:
+    """観測フレームの値から全フレームの値を作る。欠損は直前の観測で埋め、飛ばしたフレームは前後の観測から線形に補間する"""
+    filled_values = values[source_indexes]
+    if not skipped_mask.any():
+        return filled_values
+
+    observed_indexes = np.flatnonzero(frame_mask)
+    skipped_indexes = np.flatnonzero(skipped_mask)
+    flat_values = values.reshape(len(values), -1)
+    flat_filled_values = filled_values.reshape(len(filled_values), -1)
+    for n in range(flat_values.shape[1]):
+        flat_filled_values[skipped_indexes, n] = np.interp(skipped_indexes, observed_indexes, flat_values[:, n])
+    return filled_values
+
+
+def smooth_frames(
+    i: int,
+    all: int,
+    json_path: str,
+    start_camera_z: float = None,
+    global_joints_mode: str = GLOBAL_JOINTS_MODE,
+    writer: async_writer.AsyncWriter = None,
+) -> bool:
+    """トラックを平滑化する。キャッシュから復元した場合は True (writer を渡した場合、出力はそのスレッドで行う)"""
+    smooth_json_path = json_path.replace("_original.json", "_smooth.json")
+
+    # 同じ入力とパラメータで平滑化済みならキャッシュから復元する
+    cache_key = get_cache_key(json_path, global_joints_mode)
+    if result_cache.restore(
+        cache_key, os.path.dirname(json_path), {"smooth.json": os.path.basename(json_io.get_path(smooth_json_path))}
+    ):
+        track_index.set_stage(
+            os.path.dirname(json_path), json_path, "smooth", "done", json_io.get_path(smooth_json_path)
+        )
+        return True
+
+    metrics_record = metrics.start(
+        os.path.dirname(json_path), "smooth", os.path.basename(json_path).replace("_original.json", "")
+    )
+
+    data = json_io.load(json_path)
+
+    checkpoint_path = get_checkpoint_path(json_path)
+    checkpoint_key = get_checkpoint_key(json_path, global_joints_mode)
+    checkpoint_poses = load_checkpoint(checkpoint_path, checkpoint_key)
+    checkpoint_file = open_checkpoint(checkpoint_path, checkpoint_key, 0 < len(checkpoint_poses))
 
     smoothed_data = {"frames": {}}
 
@@ -118,377 +452,135 @@ def smooth_frames(i: int, all: int, json_path: str, start_camera_z: float = None
         ("camera", "z"): [],
     }
 
-    for jname in JOINT_NAMES[:45]:
-        joint_positions[("3d_joints", jname)] = []
-        joint_positions[("global_3d_joints", jname)] = []
-    # for jname in MP_JOINT_NAMES:
-    #     joint_positions[("mediapipe", jname)] = []
-
-    start_fno = -1
-    start_camera_z = 0.0
-    j = 0
-    for time, frame_data in tqdm(data["frames"].items(), desc=f"Prepare[{i:02d}/{all:02d}] ..."):
-        if start_fno == -1:
-            start_fno = int(time)
-            start_camera_z = frame_data["camera"]["z"]
-
-        for k in range(j, int(time)):
-            k2 = str(k)
-            if 0 < len(joint_positions[("camera", "x")]):
-                j2 = len(joint_positions[("camera", "x")]) - 1
-                joint_positions[("camera", "x")].append(
-                    np.array([0, 0, joint_positions[("camera", "x")][j2][0]])
-                )
-                joint_positions[("camera", "y")].append(
-                    np.array([0, 0, joint_positions[("camera", "y")][j2][1]])
-                )
-                joint_positions[("camera", "z")].append(
-                    np.array([0, 0, joint_positions[("camera", "z")][j2][2]])
-                )
-
-                prev_data = data["frames"][str(j - 1)]
-                smoothed_data["frames"][k2] = {
-                    "tracked_bbox": prev_data["tracked_bbox"],
-                    "conf": 0.0,
-                    "camera": {"x": 0.0, "y": 0.0, "z": 0.0},
-                    "3d_joints": {},
-                    "global_3d_joints": {},
-                    "2d_joints": prev_data["2d_joints"],
-                    # "mediapipe": {},
-                }
+    joint_names, output_joint_names = get_smooth_joint_names(global_joints_mode)
 
-                for jname in JOINT_NAMES[:45]:
-                    joint_positions[("3d_joints", jname)].append(
-                        np.array(
-                            [
-                                joint_positions[("3d_joints", jname)][j2][0],
-                                joint_positions[("3d_joints", jname)][j2][1],
-                                joint_positions[("3d_joints", jname)][j2][2],
-                            ]
-                        )
-                    )
-                    joint_positions[("global_3d_joints", jname)].append(
-                        np.array(
-                            [
-                                joint_positions[("global_3d_joints", jname)][j2][0],
-                                joint_positions[("global_3d_joints", jname)][j2][1],
-                                joint_positions[("global_3d_joints", jname)][j2][2],
-                            ]
-                        )
-                    )
-                    smoothed_data["frames"][k2]["3d_joints"][jname] = {
-                        "x": prev_data["3d_joints"][jname]["x"],
-                        "y": prev_data["3d_joints"][jname]["y"],
-                        "z": prev_data["3d_joints"][jname]["z"],
-                    }
-                    smoothed_data["frames"][k2]["global_3d_joints"][jname] = {
-                        "x": prev_data["global_3d_joints"][jname]["x"],
-                        "y": prev_data["global_3d_joints"][jname]["y"],
-                        "z": prev_data["global_3d_joints"][jname]["z"],
-                    }
-
-                # if 0 < len(joint_positions[("mediapipe", "left wrist")]):
-                #     j2 = len(joint_positions[("mediapipe", "left wrist")]) - 1
-
-                #     for jname in MP_JOINT_NAMES:
-                #         joint_positions[("mediapipe", jname)].append(
-                #             np.array(
-                #                 [
-                #                     joint_positions[("mediapipe", jname)][j2][0],
-                #                     joint_positions[("mediapipe", jname)][j2][1],
-                #                     joint_positions[("mediapipe", jname)][j2][2],
-                #                 ]
-                #             )
-                #         )
-                #         if "mediapipe" in prev_data and prev_data["mediapipe"]:
-                #             smoothed_data["frames"][k2]["mediapipe"][jname] = {
-                #                 "x": prev_data["mediapipe"][jname]["x"],
-                #                 "y": prev_data["mediapipe"][jname]["y"],
-                #                 "z": prev_data["mediapipe"][jname]["z"],
-                #                 "visibility": prev_data["mediapipe"][jname][
-                #                     "visibility"
-                #                 ],
-                #                 "presence": prev_data["mediapipe"][jname][
-                #                     "presence"
-                #                 ],
-                #             }
+    if global_joints_mode == "derive":
+        camera_start_z = get_camera_start_z(data)
+        add_local_joints(data, joint_names["3d_joints"], camera_start_z)
 
-                continue
+    # 観測のあるフレーム
+    fnos = np.array(
+        sorted(
+            int(fno)
+            for fno, frame_data in data["frames"].items()
+            if "camera" in frame_data
+            and not [type_name for type_name, jnames in joint_names.items() if jnames and type_name not in frame_data]
+        )
+    )
+    if not len(fnos):
+        # カメラと関節がそろったフレームがない
+        log.warning(f"[{os.path.basename(json_path)}] No frame to smooth, skip")
+        checkpoint_file.close()
+        os.remove(checkpoint_path)
+        metrics.finish(metrics_record, 0)
+        track_index.set_stage(os.path.dirname(json_path), json_path, "smooth", "skipped")
+        return False
+
+    start_fno = int(fnos[0])
+
+    # 欠損フレームは直前の観測フレームの値で埋める (検出を飛ばしたフレームは前後から線形に補間する)
+    frame_mask = np.zeros(fnos[-1] - start_fno + 1, dtype=bool)
+    frame_mask[fnos - start_fno] = True
+    source_indexes = np.cumsum(frame_mask) - 1
+    skipped_mask = get_skipped_mask(data, start_fno, frame_mask)
+
+    cameras = np.array(
+        [[data["frames"][str(fno)]["camera"][axis] for axis in "xyz"] for fno in fnos]
+    )
+    start_camera_z = cameras[0, 2]
+    cameras[:, 2] -= start_camera_z
+    cameras = fill_frames(cameras, frame_mask, source_indexes, skipped_mask)
+
+    for axis_index, axis in enumerate("xyz"):
+        # 1軸のみ値を入れる
+        camera_poses = np.zeros((len(cameras), 3))
+        camera_poses[:, axis_index] = despike(cameras[:, axis_index])
+        joint_positions[("camera", axis)] = camera_poses
+
+    for type_name, jnames in joint_names.items():
+        if not jnames:
+            continue
+        joints = fill_frames(
+            np.array(
+                [
+                    [[data["frames"][str(fno)][type_name][jname][axis] for axis in "xyz"] for jname in jnames]
+                    for fno in fnos
+                ]
+            ),
+            frame_mask,
+            source_indexes,
+            skipped_mask,
+        )
+        for n, jname in enumerate(jnames):
+            joint_positions[(type_name, jname)] = joints[:, n]
+    # for jname in MP_JOINT_NAMES:
+    #     joint_positions[("mediapipe", jname)] = []
 
-        smoothed_data["frames"][time] = {
-            "tracked_bbox": data["frames"][time]["tracked_bbox"],
-            "conf": data["frames"][time]["conf"],
+    for n, source_fno in enumerate(tqdm(fnos[source_indexes], desc=f"Prepare[{i:02d}/{all:02d}] ...")):
+        source_data = data["frames"][str(source_fno)]
+        smoothed_data["frames"][str(n + start_fno)] = {
+            "tracked_bbox": source_data["tracked_bbox"],
+            "conf": source_data["conf"] if frame_mask[n] else 0.0,
             "camera": {"x": 0.0, "y": 0.0, "z": 0.0},
             "3d_joints": {},
             "global_3d_joints": {},
-            "2d_joints": data["frames"][time]["2d_joints"],
+            "2d_joints": source_data["2d_joints"],
             # "mediapipe": {},
         }
 
-        if "camera" in frame_data:
-            # camera x ----------------------
-            if (
-                int(time) > 1
-                and len(joint_positions[("camera", "x")]) > 1
-                and abs(
-                    joint_positions[("camera", "x")][-2][0] - frame_data["camera"]["x"]
-                )
-                < 0.001
-                and abs(
-                    joint_positions[("camera", "x")][-1][0] - frame_data["camera"]["x"]
-                )
-                > 0.002
-            ):
-                # 1つ跳ねた場合は今回のを前回にも設定
-                log.debug(f"camera X override 1 {time}")
-                joint_positions[("camera", "x")][-1][0] = frame_data["camera"]["x"]
-
-            if (
-                int(time) > 2
-                and len(joint_positions[("camera", "x")]) > 2
-                and abs(
-                    joint_positions[("camera", "x")][-3][0] - frame_data["camera"]["x"]
-                )
-                < 0.001
-                and abs(
-                    joint_positions[("camera", "x")][-2][0] - frame_data["camera"]["x"]
-                )
-                > 0.002
-                and abs(
-                    joint_positions[("camera", "x")][-1][0] - frame_data["camera"]["x"]
-                )
-                > 0.002
-            ):
-                # 2つ跳ねた場合は今回のを前回にも設定
-                log.debug(f"camera X override 2 {time}")
-                joint_positions[("camera", "x")][-1][0] = frame_data["camera"]["x"]
-                joint_positions[("camera", "x")][-2][0] = frame_data["camera"]["x"]
-
-            joint_positions[("camera", "x")].append(
-                np.array([frame_data["camera"]["x"], 0, 0])
+    # トラックの信頼度と長さから平滑化方法を選ぶ
+    track_smoothers = select_smoothers(
+        float(np.mean([data["frames"][str(fno)]["conf"] for fno in fnos])), len(frame_mask)
+    )
+
+    series_smoothers = {}
+    for (type_name, joint_name), joint_poses in joint_positions.items():
+        if "camera" == type_name and global_joints_mode == "derive":
+            # 1軸にしか値が入っていないので、スカラーとして平滑化する
+            axis = "xyz".index(joint_name)
+            joint_positions[(type_name, joint_name)] = joint_poses[:, axis : axis + 1]
+
+        group_name = "camera" if "camera" == type_name else get_joint_group(joint_name)
+        series_smoothers[(type_name, joint_name)] = track_smoothers.get(group_name, track_smoothers["default"])
+
+    smoothed_positions = {}
+
+    # UKF以外は同じ方法の系列をまとめて平滑化する
+    for smoother_name in sorted(set(series_smoothers.values()) - {"ukf"}):
+        smoothed_positions.update(
+            smooth_batch(
+                smoother_name,
+                {
+                    series_name: joint_positions[series_name]
+                    for series_name, series_smoother in series_smoothers.items()
+                    if series_smoother == smoother_name
+                },
             )
-
-            # camera y ----------------------
-            if (
-                int(time) > 1
-                and len(joint_positions[("camera", "y")]) > 1
-                and abs(
-                    joint_positions[("camera", "y")][-2][1] - frame_data["camera"]["y"]
-                )
-                < 0.001
-                and abs(
-                    joint_positions[("camera", "y")][-1][1] - frame_data["camera"]["y"]
-                )
-                > 0.002
-            ):
-                # 1つ跳ねた場合は今回のを前回にも設定
-                log.debug(f"camera Y override 1 {time}")
-                joint_positions[("camera", "y")][-1][1] = frame_data["camera"]["y"]
-
-            if (
-                int(time) > 2
-                and len(joint_positions[("camera", "y")]) > 2
-                and abs(
-                    joint_positions[("camera", "y")][-3][1] - frame_data["camera"]["y"]
-                )
-                < 0.001
-                and abs(
-                    joint_positions[("camera", "y")][-2][1] - frame_data["camera"]["y"]
-                )
-                > 0.002
-                and abs(
-                    joint_positions[("camera", "y")][-1][1] - frame_data["camera"]["y"]
-                )
-                > 0.002
-            ):
-                # 2つ跳ねた場合は今回のを前回にも設定
-                log.debug(f"camera Y override 2 {time}")
-                joint_positions[("camera", "y")][-1][1] = frame_data["camera"]["y"]
-                joint_positions[("camera", "y")][-2][1] = frame_data["camera"]["y"]
-
-            joint_positions[("camera", "y")].append(
-                np.array([0, frame_data["camera"]["y"], 0])
-            )
-
-            # camera z ----------------------
-            if (
-                int(time) > 1
-                and len(joint_positions[("camera", "z")]) > 1
-                and abs(
-                    joint_positions[("camera", "z")][-2][2]
-                    - frame_data["camera"]["z"]
-                    - start_camera_z
-                )
-                < 0.001
-                and abs(
-                    joint_positions[("camera", "z")][-1][2]
-                    - frame_data["camera"]["z"]
-                    - start_camera_z
-                )
-                > 0.002
-            ):
-                # 1つ跳ねた場合は今回のを前回にも設定
-                log.debug(f"camera Z override 1 {time}")
-                joint_positions[("camera", "z")][-1][2] = (
-                    frame_data["camera"]["z"] - start_camera_z
-                )
-
-            if (
-                int(time) > 2
-                and len(joint_positions[("camera", "z")]) > 2
-                and abs(
-                    joint_positions[("camera", "z")][-3][2]
-                    - frame_data["camera"]["z"]
-                    - start_camera_z
-                )
-                < 0.001
-                and abs(
-                    joint_positions[("camera", "z")][-2][2]
-                    - frame_data["camera"]["z"]
-                    - start_camera_z
-                )
-                > 0.002
-                and abs(
-                    joint_positions[("camera", "z")][-1][2]
-                    - frame_data["camera"]["z"]
-                    - start_camera_z
-                )
-                > 0.002
-            ):
-                # 2つ跳ねた場合は今回のを前回にも設定
-                log.debug(f"camera Z override 2 {time}")
-                joint_positions[("camera", "z")][-1][2] = (
-                    frame_data["camera"]["z"] - start_camera_z
-                )
-                joint_positions[("camera", "z")][-2][2] = (
-                    frame_data["camera"]["z"] - start_camera_z
-                )
-
-            joint_positions[("camera", "z")].append(
-                np.array([0, 0, frame_data["camera"]["z"] - start_camera_z])
-            )
-
-        if "3d_joints" in frame_data:
-            for jname, joint in frame_data["3d_joints"].items():
-                joint_positions[("3d_joints", jname)].append(
-                    np.array([joint["x"], joint["y"], joint["z"]])
-                )
-                smoothed_data["frames"][time]["3d_joints"][jname] = {
-                    "x": frame_data["3d_joints"][jname]["x"],
-                    "y": frame_data["3d_joints"][jname]["y"],
-                    "z": frame_data["3d_joints"][jname]["z"],
-                }
-
-        if "global_3d_joints" in frame_data:
-            for jname, joint in frame_data["global_3d_joints"].items():
-                joint_positions[("global_3d_joints", jname)].append(
-                    np.array([joint["x"], joint["y"], joint["z"]])
-                )
-                smoothed_data["frames"][time]["global_3d_joints"][jname] = {
-                    "x": frame_data["global_3d_joints"][jname]["x"],
-                    "y": frame_data["global_3d_joints"][jname]["y"],
-                    "z": frame_data["global_3d_joints"][jname]["z"],
-                }
-
-        # if "mediapipe" in frame_data:
-        #     if mp_start_fno == -1:
-        #         mp_start_fno = int(time)
-
-        #     if frame_data["mediapipe"]:
-        #         for jname, joint in frame_data["mediapipe"].items():
-        #             joint_positions[("mediapipe", jname)].append(
-        #                 np.array([joint["x"], joint["y"], joint["z"]])
-        #             )
-        #             smoothed_data["frames"][time]["mediapipe"][jname] = {
-        #                 "x": frame_data["mediapipe"][jname]["x"],
-        #                 "y": frame_data["mediapipe"][jname]["y"],
-        #                 "z": frame_data["mediapipe"][jname]["z"],
-        #                 "visibility": frame_data["mediapipe"][jname]["visibility"],
-        #                 "presence": frame_data["mediapipe"][jname]["presence"],
-        #             }
-        #     else:
-        #         if 0 < len(joint_positions[("mediapipe", "left wrist")]):
-        #             j2 = len(joint_positions[("mediapipe", "left wrist")]) - 1
-        #             prev_data = data["frames"][str(j - 1)]
-        #             for jname in MP_JOINT_NAMES:
-        #                 joint_positions[("mediapipe", jname)].append(
-        #                     np.array(
-        #                         [
-        #                             joint_positions[("mediapipe", jname)][j2][0],
-        #                             joint_positions[("mediapipe", jname)][j2][1],
-        #                             joint_positions[("mediapipe", jname)][j2][2],
-        #                         ]
-        #                     )
-        #                 )
-        #                 if prev_data["mediapipe"]:
-        #                     smoothed_data["frames"][time]["mediapipe"][jname] = {
-        #                         "x": prev_data["mediapipe"][jname]["x"],
-        #                         "y": prev_data["mediapipe"][jname]["y"],
-        #                         "z": prev_data["mediapipe"][jname]["z"],
-        #                         "visibility": prev_data["mediapipe"][jname][
-        #                             "visibility"
-        #                         ],
-        #                         "presence": prev_data["mediapipe"][jname][
-        #                             "presence"
-        #                         ],
-        #                     }
-
-        j = int(time) + 1
-
-    def tf(state, noise):
-        # 加速度を考慮した動的モデル
-        pos = state[:3] + state[3:6] + 0.5 * state[6:9]
-        vel = state[3:6] + state[6:9]
-        acc = state[6:9] + noise[6:9]
-        return np.concatenate([pos, vel, acc])
-
-    def of(state, noise):
-        return state[:3] + noise
+        )
 
     for (type_name, joint_name), joint_poses in tqdm(
         joint_positions.items(), desc=f"Smoothing [{i:02d}/{all:02d}] ..."
     ):
-        if np.sum(joint_poses) == 0:
-            continue
-
-        # プロセスノイズの標準偏差
-        if (type_name, joint_name) in JOINT_NOISE:
-            process_noise_sd = JOINT_NOISE[(type_name, joint_name)]
+        if (type_name, joint_name) in smoothed_positions:
+            smoothed_poses = smoothed_positions[(type_name, joint_name)]
+        elif np.sum(joint_poses) == 0:
+            # 値がない系列はそのまま出力
+            smoothed_poses = joint_poses
+        elif (type_name, joint_name) in checkpoint_poses:
+            # 前回の実行で平滑化済み
+            smoothed_poses = checkpoint_poses[(type_name, joint_name)]
         else:
-            process_noise_sd = JOINT_NOISE[joint_name]
-
-        # 観測ノイズの標準偏差を計算
-        observation_noise_sd = np.std(np.array(joint_poses))
-
-        initial_state = np.concatenate(
-            [joint_poses[0], [0, 0, 0], [0, 0, 0]]
-        )  # 初期状態に速度0、加速度0を追加
-
-        ukf = UnscentedKalmanFilter(
-            transition_functions=tf,
-            observation_functions=of,
-            transition_covariance=process_noise_sd**2
-            * np.eye(9),  # 状態は位置、速度、加速度を含む
-            observation_covariance=observation_noise_sd**2 * np.eye(3),
-            initial_state_mean=initial_state,
-            initial_state_covariance=process_noise_sd * np.eye(9),
-            random_state=0,
-        )
-
-        # 平滑化
-        smoothed_state_means, _ = ukf.smooth(np.array(joint_poses))
+            smoothed_poses = smooth_series(type_name, joint_name, joint_poses)
+            write_checkpoint(checkpoint_file, (type_name, joint_name), smoothed_poses)
 
-        for j, joint_pose in enumerate(smoothed_state_means[:, :3]):
+        for j, joint_pose in enumerate(smoothed_poses):
             j2 = str(j + start_fno)
             if "camera" == type_name:
-                if joint_name == "x":
-                    smoothed_data["frames"][j2]["camera"]["x"] = joint_pose[0]
-                elif joint_name == "y":
-                    smoothed_data["frames"][j2]["camera"]["y"] = joint_pose[1]
-                elif joint_name == "z":
-                    smoothed_data["frames"][j2]["camera"]["z"] = (
-                        joint_pose[2] + start_camera_z
-                    )
+                # スカラーとして平滑化した場合は値は1つ
+                camera_pos = joint_pose[0] if len(joint_pose) == 1 else joint_pose["xyz".index(joint_name)]
+                if joint_name == "z":
+                    camera_pos += start_camera_z
+                smoothed_data["frames"][j2]["camera"][joint_name] = camera_pos
             # elif "mediapipe" == type_name:
             #     if joint_name not in smoothed_data["frames"][j2][type_name]:
             #         smoothed_data["frames"][mj][type_name][joint_name] = {
@@ -512,23 +604,298 @@ def smooth_frames(i: int, all: int, json_path: str, start_camera_z: float = None
                     "z": joint_pose[2],
                 }
 
-    smooth_json_path = json_path.replace("_original.json", "_smooth.json")
-    with open(smooth_json_path, "w") as f:
-        json.dump(smoothed_data, f, indent=4)
+    checkpoint_file.close()
+
+    if global_joints_mode == "derive":
+        derive_global_joints(smoothed_data, output_joint_names, camera_start_z)
+
+    # 一時ファイルへはシリアライズしながら書き、ディスクへの書き込みと置き換えを次のトラックの平滑化と重ねる
+    tmp_path = json_io.write_tmp_file(smooth_json_path, json_io.encode_frames(smoothed_data["frames"]))
+    if writer:
+        writer.submit(
+            write_smooth_json,
+            json_path,
+            smooth_json_path,
+            tmp_path,
+            len(smoothed_data["frames"]),
+            checkpoint_path,
+            cache_key,
+            metrics_record,
+        )
+    else:
+        write_smooth_json(
+            json_path, smooth_json_path, tmp_path, len(smoothed_data["frames"]), checkpoint_path, cache_key, metrics_record
+        )
+
+    return False
+
+
+def write_smooth_json(
+    json_path: str,
+    smooth_json_path: str,
+    tmp_path: str,
+    frame_num: int,
+    checkpoint_path: str,
+    cache_key: str,
+    metrics_record: dict,
+):
+    # 一時ファイルから置き換えるので、キャッシュとハードリンクしていても書き換わらない
+    output_path = json_io.replace_tmp_file(smooth_json_path, tmp_path)
+
+    # 出力できたらチェックポイントは不要
+    os.remove(checkpoint_path)
+
+    result_cache.store(cache_key, {"smooth.json": output_path})
+
+    track_index.set_stage(os.path.dirname(json_path), json_path, "smooth", "done", output_path)
+
+    metrics.finish(metrics_record, frame_num)
+
+
+def tf(state, noise):
+    # 加速度を考慮した動的モデル (状態は位置、速度、加速度の次元数ずつ)
+    d = len(state) // 3
+    pos = state[:d] + state[d : d * 2] + 0.5 * state[d * 2 :]
+    vel = state[d : d * 2] + state[d * 2 :]
+    acc = state[d * 2 :] + noise[d * 2 :]
+    return np.concatenate([pos, vel, acc])
+
+
+def of(state, noise):
+    return state[: len(noise)] + noise
+
+
+def get_process_noise_sd(type_name: str, joint_name: str) -> float:
+    # プロセスノイズの標準偏差
+    if (type_name, joint_name) in JOINT_NOISE:
+        return JOINT_NOISE[(type_name, joint_name)]
+    return JOINT_NOISE[joint_name]
+
+
+def smooth_series(
+    type_name: str,
+    joint_name: str,
+    joint_poses: list,
+    chunk_size: int = UKF_CHUNK["size"],
+    chunk_overlap: int = UKF_CHUNK["overlap"],
+) -> np.ndarray:
+    process_noise_sd = get_process_noise_sd(type_name, joint_name)
+
+    joint_poses = np.array(joint_poses)
+
+    # 観測ノイズの標準偏差を計算 (区間に分ける場合も系列全体から)
+    observation_noise_sd = np.std(joint_poses)
+
+    if chunk_size <= 0 or len(joint_poses) <= chunk_size:
+        return smooth_ukf(joint_poses, process_noise_sd, observation_noise_sd)
+
+    # 区間ごとに平滑化して、重なった部分は線形に切り替える
+    chunk_overlap = min(chunk_overlap, chunk_size // 2)
+    smoothed_poses = np.zeros(joint_poses.shape)
+    start = 0
+    prev_end = 0
+    while True:
+        end = min(start + chunk_size, len(joint_poses))
+        chunk_poses = smooth_ukf(joint_poses[start:end], process_noise_sd, observation_noise_sd)
+
+        overlap = prev_end - start
+        weights = np.linspace(0, 1, overlap + 2)[1:-1, np.newaxis]
+        smoothed_poses[start:prev_end] = (1 - weights) * smoothed_poses[start:prev_end] + weights * chunk_poses[:overlap]
+        smoothed_poses[prev_end:end] = chunk_poses[overlap:]
+
+        if end == len(joint_poses):
+            break
+        prev_end = end
+        start = end - chunk_overlap
+
+    return smoothed_poses
+
+
+def smooth_ukf(joint_poses: np.ndarray, process_noise_sd: float, observation_noise_sd: float) -> np.ndarray:
+    # 位置の次元数 (関節は3、カメラをスカラーで平滑化する場合は1)
+    d = len(joint_poses[0])
+
+    initial_state = np.concatenate(
+        [joint_poses[0], np.zeros(d), np.zeros(d)]
+    )  # 初期状態に速度0、加速度0を追加
+
+    ukf = UnscentedKalmanFilter(
+        transition_functions=tf,
+        observation_functions=of,
+        transition_covariance=process_noise_sd**2
+        * np.eye(d * 3),  # 状態は位置、速度、加速度を含む
+        observation_covariance=observation_noise_sd**2 * np.eye(d),
+        initial_state_mean=initial_state,
+        initial_state_covariance=process_noise_sd * np.eye(d * 3),
+        random_state=0,
+    )
+
+    # 平滑化
+    smoothed_state_means, _ = ukf.smooth(joint_poses)
+
+    return smoothed_state_means[:, :d]
+
+
+def get_joint_group(joint_name: str) -> str:
+    for group_name, joint_names in JOINT_GROUPS.items():
+        if joint_name in joint_names:
+            return group_name
+    return "body"
+
+
+def select_smoothers(conf: float, frames: int) -> dict:
+    """トラックの平均信頼度とフレーム数から、関節グループごとの平滑化方法を選ぶ"""
+    if SMOOTHER:
+        return {"default": SMOOTHER}
+
+    for rule in SMOOTHER_RULES:
+        if not rule.get("min_conf", -np.inf) <= conf < rule.get("max_conf", np.inf):
+            continue
+        if not rule.get("min_frames", 0) <= frames < rule.get("max_frames", np.inf):
+            continue
+        return rule["smoothers"]
+
+    return {"default": "ukf"}
 
 
-def smooth(output_dir_path: str, limit_minutes: int):
-    original_json_paths = glob(os.path.join(output_dir_path, "*_original.json"))
+def smooth_one_euro(
+    values: np.ndarray, min_cutoff: float, beta: float, d_cutoff: float, fps: float
+) -> np.ndarray:
+    # 1€ Filter (列ごとに独立して、時間方向に逐次計算)
+    def get_alpha(cutoff):
+        tau = 1.0 / (2 * np.pi * cutoff)
+        return 1.0 / (1.0 + tau * fps)
+
+    smoothed_values = np.empty_like(values)
+    smoothed_values[0] = values[0]
+    prev_dx = np.zeros(values.shape[1:])
+    d_alpha = get_alpha(d_cutoff)
+
+    for t in range(1, len(values)):
+        dx = d_alpha * (values[t] - smoothed_values[t - 1]) * fps + (1 - d_alpha) * prev_dx
+        alpha = get_alpha(min_cutoff + beta * np.abs(dx))
+        smoothed_values[t] = alpha * values[t] + (1 - alpha) * smoothed_values[t - 1]
+        prev_dx = dx
+
+    return smoothed_values
+
+
+def smooth_savgol(values: np.ndarray, window_length: int, polyorder: int) -> np.ndarray:
+    # 窓はフレーム数以下の奇数
+    window_length = min(window_length, len(values) - (1 - len(values) % 2))
+    if window_length <= polyorder:
+        return values.copy()
+    return signal.savgol_filter(values, window_length, polyorder, axis=0)
+
+
+def smooth_butterworth(values: np.ndarray, order: int, cutoff: float, fps: float) -> np.ndarray:
+    # 前後両方向にかけて位相ずれをなくす
+    b, a = signal.butter(order, cutoff, fs=fps)
+    if len(values) <= 3 * max(len(a), len(b)):
+        return values.copy()
+    return signal.filtfilt(b, a, values, axis=0)
+
+
+# 平滑化方法 (ukf は系列ごとに平滑化してチェックポイントに保存する)
+SMOOTHERS = {
+    "one_euro": smooth_one_euro,
+    "savgol": smooth_savgol,
+    "butterworth": smooth_butterworth,
+}
+
+
+def smooth_batch(smoother_name: str, joint_positions: dict) -> dict:
+    """複数の系列を (フレーム, 列) にまとめて一度に平滑化する"""
+    series_names = list(joint_positions.keys())
+    widths = [joint_positions[series_name].shape[1] for series_name in series_names]
+
+    values = np.concatenate([joint_positions[series_name] for series_name in series_names], axis=1)
+    smoothed_values = SMOOTHERS[smoother_name](values, **SMOOTHER_PARAMS[smoother_name])
+
+    smoothed_positions = {}
+    for series_name, smoothed_poses in zip(
+        series_names, np.split(smoothed_values, np.cumsum(widths)[:-1], axis=1)
+    ):
+        smoothed_positions[series_name] = smoothed_poses
+    return smoothed_positions
+
+
+def count_frames(json_path: str) -> int:
+    # インデックスに登録済みならjsonを開かない
+    track = track_index.load(os.path.dirname(json_path)).get(track_index.get_track_name(json_path), {})
+    if "frames" in track:
+        return track["frames"]
+
+    fnos = [int(fno) for fno in json_io.load(json_path)["frames"].keys()]
+    if not fnos:
+        return 0
+    return max(fnos) - min(fnos) + 1
+
+
+def smooth_track(
+    i: int, all: int, json_path: str, frame_num: int, writer: async_writer.AsyncWriter = None
+) -> bool:
+    """トラックを平滑化して、実績をスケジューラに記録する。キャッシュから復元した場合は True"""
+    track_start_time = time.time()
+
+    if smooth_frames(i, all, json_path, writer=writer):
+        # キャッシュから復元した場合は実績にしない
+        return True
+
+    # 書き出しと重なるので、実績は平滑化の時間
+    scheduler.record_throughput("smooth", frame_num, time.time() - track_start_time)
+    return False
+
+
+def get_smooth_tasks(output_dir_path: str) -> dict:
+    """まだ平滑化していないトラック (パス: フレーム数)。平滑化できずに飛ばしたトラックは除く"""
+    tracks = track_index.load(output_dir_path)
+
+    tasks = {}
+    for json_path in json_io.glob_json(os.path.join(output_dir_path, "*_original.json")):
+        if json_io.exists(json_path.replace("_original.json", "_smooth.json")):
+            continue
+        if tracks.get(track_index.get_track_name(json_path), {}).get("stages", {}).get("smooth") == "skipped":
+            continue
+        tasks[json_path] = count_frames(json_path)
+    return tasks
+
+
+def smooth(output_dir_path: str, limit_minutes: int = 24 * 60 * 60, order: str = "longest"):
+    original_json_paths = json_io.glob_json(os.path.join(output_dir_path, "*_original.json"))
     start_time = time.time()
 
-    for i, json_path in enumerate(original_json_paths):
-        if not os.path.exists(json_path.replace("_original.json", "_smooth.json")):
-            # まだ出来てないのだけ実行
-            smooth_frames(i, len(original_json_paths), json_path)
+    # まだ出来てないのだけ実行
+    tasks = get_smooth_tasks(output_dir_path)
+
+    throughput = scheduler.load_throughput()
+
+    # 制限時間の全体を使っても終わらないトラックは実行しない (残りのトラックは平滑化してから失敗にする)
+    oversized_tasks = scheduler.find_oversized_tasks(tasks, "smooth", limit_minutes * 60, throughput)
+    for json_path, seconds in oversized_tasks.items():
+        log.error(f"Track can never finish within {limit_minutes} minutes (estimate: {seconds:.0f}s): {json_path}")
+        tasks.pop(json_path)
+
+    with async_writer.AsyncWriter() as writer:
+        for i in range(len(tasks)):
+            remaining_seconds = limit_minutes * 60 - (time.time() - start_time)
+
+            # 残り時間内に終わる見込みのあるトラックだけ実行する
+            json_path = scheduler.next_task(tasks, "smooth", remaining_seconds, throughput, order)
+            if not json_path:
+                log.info(f"No track fits in remaining {remaining_seconds:.0f}s (left: {len(tasks)})")
+                break
+
+            frame_num = tasks.pop(json_path)
+            if not smooth_track(i, len(original_json_paths), json_path, frame_num, writer=writer):
+                throughput = scheduler.load_throughput()
+
+    if oversized_tasks:
+        raise RuntimeError(
+            f"{len(oversized_tasks)} tracks exceed the limit of {limit_minutes} minutes on their own "
+            "(raise the limit to smooth them)"
+        )
 
-            # 開始から30分過ぎてたら一旦終了
-            if limit_minutes * 60 < time.time() - start_time:
-                return
 
 if __name__ == "__main__":
     log.debug("Start: smooth =============================")
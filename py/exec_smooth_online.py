@@ -0,0 +1,596 @@
+import argparse
+from glob import glob
+import os
+import pickle
+import time
+
+import joblib
+import numpy as np
+from phalp.utils import get_pylogger
+
+import exec_pkl2json
+import exec_smooth
+import frame_filter
+import json_io
+import metrics
+import track_index
+
+log = get_pylogger(__name__)
+
+# トラッカーの出力(*.pkl)と区別するため拡張子を変える
+STATE_FILE_NAME = "smooth_online.state"
+# 状態の形式 (変わった場合は前回の状態を使わずに最初からやり直す)
+STATE_VERSION = 2
+
+# 確定したフレームを追記していくファイル ("fno":{...} を1行ずつ。トラックが終わったら _smooth.json にする)
+PART_SUFFIX = "_smooth_online.part"
+# 追記中のトラックで、それまでに確定したフレームを読めるjson (ブロックごとに置き換える。_smooth.json にしたら消す)
+ONLINE_SUFFIX = "_smooth_online.json"
+
+# 平滑化済みとして出力するまでに待つフレーム数
+LAG = int(os.environ.get("MAT4_SMOOTH_LAG", 30))
+
+# 新しいpklを待つ間隔(秒)。書き込み途中のpklを読まないよう、更新からこれより経っていないpklは次回に回す
+POLL_SECONDS = 10
+
+# 次のブロックの同じIDのトラックを続きとみなす、最後のbboxと最初のbboxの重なり (IoU)
+CARRY_MIN_IOU = float(os.environ.get("MAT4_SMOOTH_CARRY_IOU", 0.3))
+
+# 位置・速度・加速度の遷移 (exec_smooth.tf と同じ)
+TRANSITION = np.array(
+    [
+        [1.0, 1.0, 0.5],
+        [0.0, 1.0, 1.0],
+        [0.0, 0.0, 1.0],
+    ]
+)
+
+
+def get_state_path(output_dir_path: str) -> str:
+    return os.path.join(output_dir_path, STATE_FILE_NAME)
+
+
+def get_part_path(json_path: str) -> str:
+    return json_path.replace("_original.json", PART_SUFFIX)
+
+
+def get_online_path(json_path: str) -> str:
+    return json_path.replace("_original.json", ONLINE_SUFFIX)
+
+
+def restore_parts(state: dict) -> bool:
+    """状態を保存した後に追記した分を切り詰める (もう一度出力する)。追記中のファイルがない場合は False"""
+    for track in state["tracks"].values():
+        for json_path, output in track["outputs"].items():
+            part_path = get_part_path(json_path)
+            if not os.path.exists(part_path) or os.path.getsize(part_path) < output["part_size"]:
+                return False
+    for track in state["tracks"].values():
+        for json_path, output in track["outputs"].items():
+            with open(get_part_path(json_path), "r+b") as f:
+                f.truncate(output["part_size"])
+    return True
+
+
+def load_state(output_dir_path: str, global_joints_mode: str) -> dict:
+    state_path = get_state_path(output_dir_path)
+    if os.path.exists(state_path):
+        with open(state_path, "rb") as f:
+            state = pickle.load(f)
+        if state.get("version") != STATE_VERSION:
+            log.warning(f"Discard online state (format changed): {state_path}")
+        elif state["global_joints_mode"] != global_joints_mode:
+            log.warning(f"Discard online state (mode changed): {state_path}")
+        elif not restore_parts(state):
+            log.warning(f"Discard online state (output missing): {state_path}")
+        else:
+            return state
+
+    return {
+        "version": STATE_VERSION,
+        "global_joints_mode": global_joints_mode,
+        # 読み込み済みのpkl
+        "pkl_names": [],
+        # exec_pkl2json.convert と同じ変換のための値
+        "start_z": None,
+        "prev_last_key": 0,
+        # 確定していないトラック ((tracked_id, start_time): 平滑化の状態)
+        "tracks": {},
+    }
+
+
+def save_state(output_dir_path: str, state: dict):
+    state_path = get_state_path(output_dir_path)
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, state_path)
+
+
+def get_series_layout(global_joints_mode: str) -> list[tuple[tuple[str, str], int]]:
+    """系列名と列数 (smooth_frames と同じく、カメラは derive の場合はスカラー、それ以外は1軸のみ値を入れた3列)"""
+    joint_names, _ = exec_smooth.get_smooth_joint_names(global_joints_mode)
+
+    camera_width = 1 if global_joints_mode == "derive" else 3
+    layout = [(("camera", axis), camera_width) for axis in "xyz"]
+    for type_name, jnames in joint_names.items():
+        layout.extend(((type_name, jname), 3) for jname in jnames)
+    return layout
+
+
+def get_observation(frame_data: dict, layout: list, start_camera_z: float) -> list[float]:
+    row = []
+    for (type_name, name), width in layout:
+        if "camera" == type_name:
+            value = frame_data["camera"][name] - (start_camera_z if name == "z" else 0.0)
+            if width == 1:
+                row.append(value)
+            else:
+                row.extend(value if axis == name else 0.0 for axis in "xyz")
+        else:
+            row.extend(frame_data[type_name][name][axis] for axis in "xyz")
+    return row
+
+
+def open_output(track: dict, json_path: str, start_fno: int):
+    """このフレーム以降の出力先のトラックjsonを追加する"""
+    open(get_part_path(json_path), "wb").close()
+    # end_fno: 出力する最後のフレーム (None は続いている)、part_size: 追記済みのバイト数
+    track["outputs"][json_path] = {"start_fno": start_fno, "end_fno": None, "part_size": 0}
+
+
+def close_outputs(track: dict):
+    """続いている出力先を、追加済みの最後の観測で閉じる"""
+    for output in track["outputs"].values():
+        if output["end_fno"] is None:
+            output["end_fno"] = (track["next_fno"] if track["next_fno"] is not None else output["start_fno"]) - 1
+
+
+def new_track(layout: list, start_camera_z: float, camera_start_z: float, json_path: str, start_fno: int) -> dict:
+    column_num = sum(width for _, width in layout)
+    series_indexes = np.repeat(np.arange(len(layout)), [width for _, width in layout])
+
+    track = {
+        # 出力先のトラックjson (ブロックをまたいで続く場合は複数)
+        "outputs": {},
+        "start_camera_z": start_camera_z,
+        "camera_start_z": camera_start_z,
+        # 列ごとの系列のインデックスとプロセスノイズ
+        "series_indexes": series_indexes,
+        "process_noise_sd": np.array(
+            [exec_smooth.get_process_noise_sd(*series_name) for series_name, _ in layout]
+        )[series_indexes],
+        # 系列ごとの観測値の個数、和、二乗和 (観測ノイズの計算用)
+        "stats": np.zeros((len(layout), 3)),
+        # 次に追加するフレーム番号と、欠損を埋めるための直前の観測
+        "next_fno": None,
+        "last_row": None,
+        "last_frame": None,
+        # フィルタにまだ入れていない観測 (跳ね除去で書き換わる可能性がある)
+        "pending_rows": np.zeros((0, column_num)),
+        "pending_frames": [],
+        # フィルタに入れた直近の観測 (跳ね除去の比較用)
+        "history_rows": np.zeros((0, column_num)),
+        # フィルタの状態
+        "x": None,
+        "P": None,
+        # 出力していないフレームのフィルタ結果
+        "buffer_fno": None,
+        "buffer_frames": [],
+        "xf": np.zeros((0, column_num, 3)),
+        "Pf": np.zeros((0, column_num, 3, 3)),
+        "xp": np.zeros((0, column_num, 3)),
+        "Pp": np.zeros((0, column_num, 3, 3)),
+    }
+    open_output(track, json_path, start_fno)
+    return track
+
+
+def get_bbox_iou(bbox1: list, bbox2: list) -> float:
+    """xywh のbboxの重なり"""
+    width = min(bbox1[0] + bbox1[2], bbox2[0] + bbox2[2]) - max(bbox1[0], bbox2[0])
+    height = min(bbox1[1] + bbox1[3], bbox2[1] + bbox2[3]) - max(bbox1[1], bbox2[1])
+    intersection = max(width, 0) * max(height, 0)
+    union = bbox1[2] * bbox1[3] + bbox2[2] * bbox2[3] - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def find_carried_track(state: dict, tracked_id: int, start_time: int, frames: dict, lag: int):
+    """前のブロックから続く同じ人物のトラックのキー (IDが同じで、間が空いておらず、bboxが重なる)。ない場合は None"""
+    first_frame = frames[min(frames.keys())]
+    for key, track in state["tracks"].items():
+        if key[0] != tracked_id or key[1] == start_time or track["last_frame"] is None:
+            continue
+        # ブロックは1フレーム重なるので、最初のフレームが最後の観測より前になることもある
+        if min(frames.keys()) - track["next_fno"] > lag:
+            continue
+        if get_bbox_iou(track["last_frame"]["tracked_bbox"], first_frame["tracked_bbox"]) < CARRY_MIN_IOU:
+            continue
+        return key
+    return None
+
+
+def add_frames(track: dict, frames: dict, layout: list, joint_names: dict):
+    """観測を欠損を埋めて追加する"""
+    fnos = np.array(
+        sorted(
+            int(fno)
+            for fno, frame_data in frames.items()
+            if "camera" in frame_data
+            and not [type_name for type_name, jnames in joint_names.items() if jnames and type_name not in frame_data]
+            and (track["next_fno"] is None or int(fno) >= track["next_fno"])
+        ),
+        dtype=np.int64,
+    )
+    if not len(fnos):
+        return
+
+    rows = [get_observation(frames[str(fno)], layout, track["start_camera_z"]) for fno in fnos]
+    source_frames = [frames[str(fno)] for fno in fnos]
+
+    # 前回の最後の観測も使って、欠損フレームは直前の観測で埋める
+    start_fno = int(fnos[0]) if track["next_fno"] is None else track["next_fno"]
+    frame_mask = np.zeros(fnos[-1] - start_fno + 1, dtype=bool)
+    frame_mask[fnos - start_fno] = True
+    source_indexes = np.cumsum(frame_mask) - 1
+    if track["last_row"] is not None:
+        rows.insert(0, track["last_row"])
+        source_frames.insert(0, track["last_frame"])
+        source_indexes += 1
+
+    filled_rows = np.array(rows)[source_indexes]
+    for n, source_index in enumerate(source_indexes):
+        source_data = source_frames[source_index]
+        track["pending_frames"].append(
+            {
+                "tracked_bbox": source_data["tracked_bbox"],
+                "conf": source_data["conf"] if frame_mask[n] else 0.0,
+                "2d_joints": source_data["2d_joints"],
+            }
+        )
+    track["pending_rows"] = np.concatenate([track["pending_rows"], filled_rows])
+
+    for series_index in range(len(layout)):
+        values = filled_rows[:, track["series_indexes"] == series_index]
+        track["stats"][series_index] += [values.size, np.sum(values), np.sum(values**2)]
+
+    track["next_fno"] = int(fnos[-1]) + 1
+    track["last_row"] = rows[-1]
+    track["last_frame"] = source_frames[-1]
+    if track["buffer_fno"] is None:
+        track["buffer_fno"] = start_fno
+
+
+def despike_pending(track: dict, layout: list):
+    window = exec_smooth.CAMERA_DESPIKE["window"]
+    history_num = len(track["history_rows"])
+
+    column = 0
+    for (type_name, name), width in layout:
+        if "camera" == type_name:
+            camera_column = column + (0 if width == 1 else "xyz".index(name))
+            values = np.concatenate(
+                [track["history_rows"][:, camera_column], track["pending_rows"][:, camera_column]]
+            )
+            track["pending_rows"][:, camera_column] = exec_smooth.despike(values, window)[history_num:]
+        column += width
+
+
+def feed(track: dict, row_num: int):
+    """観測をカルマンフィルタに入れる (exec_smooth.smooth_ukf と同じモデル)"""
+    stats = track["stats"]
+    mean = stats[:, 1] / np.maximum(stats[:, 0], 1)
+    observation_noise_sd = np.sqrt(np.maximum(stats[:, 2] / np.maximum(stats[:, 0], 1) - mean**2, 0))
+    r2 = (observation_noise_sd**2)[track["series_indexes"]]
+    q = track["process_noise_sd"]
+
+    # 加速度にのみノイズが入る
+    transition_noise = np.zeros((len(q), 3, 3))
+    transition_noise[:, 2, 2] = q**2
+
+    xf, Pf, xp, Pp = [], [], [], []
+    x, P = track["x"], track["P"]
+    for y in track["pending_rows"][:row_num]:
+        if x is None:
+            # 初期状態に速度0、加速度0
+            x_pred = np.stack([y, np.zeros(len(y)), np.zeros(len(y))], axis=1)
+            P_pred = q[:, np.newaxis, np.newaxis] * np.eye(3)
+        else:
+            x_pred = x @ TRANSITION.T
+            P_pred = TRANSITION @ P @ TRANSITION.T + transition_noise
+
+        gain = P_pred[:, :, 0] / (P_pred[:, 0, 0] + r2)[:, np.newaxis]
+        x = x_pred + gain * (y - x_pred[:, 0])[:, np.newaxis]
+        P = P_pred - gain[:, :, np.newaxis] * P_pred[:, np.newaxis, 0, :]
+
+        xf.append(x)
+        Pf.append(P)
+        xp.append(x_pred)
+        Pp.append(P_pred)
+
+    if not xf:
+        return
+
+    track["x"], track["P"] = x, P
+    track["xf"] = np.concatenate([track["xf"], xf])
+    track["Pf"] = np.concatenate([track["Pf"], Pf])
+    track["xp"] = np.concatenate([track["xp"], xp])
+    track["Pp"] = np.concatenate([track["Pp"], Pp])
+    track["buffer_frames"].extend(track["pending_frames"][:row_num])
+
+    window = exec_smooth.CAMERA_DESPIKE["window"]
+    track["history_rows"] = np.concatenate([track["history_rows"], track["pending_rows"][:row_num]])[
+        -(window + 1) :
+    ]
+    track["pending_rows"] = track["pending_rows"][row_num:]
+    track["pending_frames"] = track["pending_frames"][row_num:]
+
+
+def smooth_buffer(track: dict) -> np.ndarray:
+    """出力していないフレームを後ろから平滑化する (RTS)"""
+    xs = track["xf"].copy()
+    for k in range(len(xs) - 2, -1, -1):
+        # J = Pf[k] F^T Pp[k+1]^-1
+        gain = np.linalg.solve(
+            track["Pp"][k + 1], (track["Pf"][k] @ TRANSITION.T).transpose(0, 2, 1)
+        ).transpose(0, 2, 1)
+        xs[k] = track["xf"][k] + np.einsum("cij,cj->ci", gain, xs[k + 1] - track["xp"][k + 1])
+    return xs
+
+
+def write_outputs(track: dict, frames: dict):
+    """確定したフレームを、フレーム範囲の合う出力先に追記する (ブロックの重なりのフレームは両方に出力する)"""
+    for json_path, output in track["outputs"].items():
+        lines = [
+            json_io.encode_frame(fno, frame_data) + "\n"
+            for fno, frame_data in frames.items()
+            if output["start_fno"] <= int(fno) and (output["end_fno"] is None or int(fno) <= output["end_fno"])
+        ]
+        if not lines:
+            continue
+
+        with open(get_part_path(json_path), "ab") as f:
+            f.write("".join(lines).encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+            output["part_size"] = f.tell()
+
+
+def read_part(part_path: str):
+    """追記したフレームを json_io.encode_frames と同じ形式の断片で返す (ジェネレータ)"""
+    yield "{"
+    yield '"frames":{'
+    with open(part_path, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f):
+            yield f'{"," if n else ""}{line.rstrip()}'
+    yield "}}"
+
+
+def finalize_output(json_path: str):
+    output_dir_path = os.path.dirname(json_path)
+    part_path = get_part_path(json_path)
+    if not os.path.getsize(part_path):
+        # カメラと関節が揃ったフレームがない (exec_smooth.smooth_frames と同じく飛ばす)
+        log.warning(f"Skip smooth (no frame with camera and joints): {json_path}")
+        os.remove(part_path)
+        track_index.set_stage(output_dir_path, json_path, "smooth", "skipped")
+        return
+
+    smooth_json_path = json_io.write_chunks(json_path.replace("_original.json", "_smooth.json"), read_part(part_path))
+    os.remove(part_path)
+    remove_online_output(json_path)
+    track_index.set_stage(output_dir_path, json_path, "smooth", "done", smooth_json_path)
+    log.info(f"Finalized: {json_path}")
+
+
+def publish_outputs(state: dict):
+    """追記中の出力先ごとに、確定したフレームを _smooth_online.json に置き換えて出力する"""
+    for track in state["tracks"].values():
+        for json_path, output in track["outputs"].items():
+            if output["part_size"]:
+                json_io.write_chunks(get_online_path(json_path), read_part(get_part_path(json_path)))
+
+
+def remove_online_output(json_path: str):
+    online_path = json_io.find(get_online_path(json_path))
+    if online_path:
+        os.remove(online_path)
+
+
+def emit(track: dict, layout: list, output_joint_names: dict, global_joints_mode: str, lag: int, finalize: bool):
+    """ラグ分より古いフレームを確定して出力に追記する"""
+    emit_num = len(track["xf"]) if finalize else max(0, len(track["xf"]) - lag)
+    if emit_num:
+        xs = smooth_buffer(track)
+
+        smoothed_data = {"frames": {}}
+        for n in range(emit_num):
+            frame = track["buffer_frames"][n]
+            smoothed_frame = {
+                "tracked_bbox": frame["tracked_bbox"],
+                "conf": frame["conf"],
+                "camera": {"x": 0.0, "y": 0.0, "z": 0.0},
+                "3d_joints": {},
+                "global_3d_joints": {},
+                "2d_joints": frame["2d_joints"],
+            }
+
+            column = 0
+            for (type_name, name), width in layout:
+                values = xs[n, column : column + width, 0]
+                column += width
+                if "camera" == type_name:
+                    camera_pos = values[0] if width == 1 else values["xyz".index(name)]
+                    if name == "z":
+                        camera_pos += track["start_camera_z"]
+                    smoothed_frame["camera"][name] = float(camera_pos)
+                else:
+                    smoothed_frame[type_name][name] = {
+                        "x": float(values[0]),
+                        "y": float(values[1]),
+                        "z": float(values[2]),
+                    }
+
+            smoothed_data["frames"][str(track["buffer_fno"] + n)] = smoothed_frame
+
+        if global_joints_mode == "derive":
+            exec_smooth.derive_global_joints(smoothed_data, output_joint_names, track["camera_start_z"])
+
+        write_outputs(track, smoothed_data["frames"])
+
+        track["buffer_fno"] += emit_num
+        track["buffer_frames"] = track["buffer_frames"][emit_num:]
+        for name in ("xf", "Pf", "xp", "Pp"):
+            track[name] = track[name][emit_num:]
+
+    # 最後のフレームまで出力した出力先は _smooth.json にする
+    for json_path, output in list(track["outputs"].items()):
+        if output["end_fno"] is not None and (track["buffer_fno"] is None or output["end_fno"] < track["buffer_fno"]):
+            finalize_output(json_path)
+            del track["outputs"][json_path]
+
+
+def update_track(track: dict, frames: dict, global_joints_mode: str, lag: int, finalize: bool = False):
+    layout = get_series_layout(global_joints_mode)
+    joint_names, output_joint_names = exec_smooth.get_smooth_joint_names(global_joints_mode)
+
+    if frames:
+        add_frames(track, frames, layout, joint_names)
+    despike_pending(track, layout)
+
+    # 跳ね除去で書き換わる可能性のある末尾は、確定するまでフィルタに入れない
+    window = exec_smooth.CAMERA_DESPIKE["window"]
+    feed_num = len(track["pending_rows"]) if finalize else max(0, len(track["pending_rows"]) - window)
+
+    # ラグ分ずつフィルタに入れて出力し、保持するフィルタの結果をラグの2倍までにする
+    while 0 < feed_num:
+        row_num = min(max(lag, 1), feed_num)
+        feed(track, row_num)
+        feed_num -= row_num
+        emit(track, layout, output_joint_names, global_joints_mode, lag, finalize=False)
+
+    if finalize:
+        close_outputs(track)
+        emit(track, layout, output_joint_names, global_joints_mode, lag, finalize=True)
+
+
+def finalize_tracks(state: dict, lag: int, keep=lambda track: False):
+    for key in list(state["tracks"].keys()):
+        if keep(state["tracks"][key]):
+            continue
+        update_track(state["tracks"].pop(key), {}, state["global_joints_mode"], lag, finalize=True)
+
+
+def process_block(output_dir_path: str, pkl_path: str, state: dict, lag: int):
+    with metrics.measure(output_dir_path, "smooth_online", os.path.basename(pkl_path)) as record:
+        with open(pkl_path, "rb") as f:
+            lib_data = joblib.load(f)
+        record["frames"] = len(lib_data)
+
+        if lib_data:
+            if not state["start_z"]:
+                state["start_z"] = float(exec_pkl2json.get_start_z([lib_data]))
+
+            block_data = exec_pkl2json.convert_block(lib_data, state["start_z"], state["prev_last_key"])
+            block_end_fno = max(int(v["time"]) for v in lib_data.values()) + state["prev_last_key"]
+            state["prev_last_key"] = int(sorted(lib_data.keys())[-1])
+
+            # トラックはブロック内で完結しているので、ブロック単位で選別する
+            skipped_fnos = set(frame_filter.load_skipped_frames(output_dir_path).keys())
+            block_data = exec_pkl2json.prune_tracks(block_data, output_dir_path, state["start_z"], skipped_fnos)
+
+            for (tracked_id, start_time), frames in block_data.items():
+                # バッチ処理(exec_smooth, mat4)と同じoriginalも出力する
+                exec_pkl2json.write_original_json(
+                    output_dir_path, tracked_id, start_time, frames, state["start_z"], skipped_fnos=skipped_fnos
+                )
+
+                str_frames = {str(fno): frame_data for fno, frame_data in frames.items()}
+                if state["global_joints_mode"] == "derive":
+                    joint_names, _ = exec_smooth.get_smooth_joint_names(state["global_joints_mode"])
+                    exec_smooth.add_local_joints({"frames": str_frames}, joint_names["3d_joints"], state["start_z"])
+
+                key = (tracked_id, start_time)
+                json_path = exec_pkl2json.get_original_json_path(output_dir_path, tracked_id, start_time)
+                start_fno = min(frames.keys())
+                carried_key = find_carried_track(state, tracked_id, start_time, frames, lag)
+                if carried_key is not None:
+                    # 前のブロックの出力は最後の観測までで閉じて、フィルタはそのまま続ける
+                    state["tracks"][key] = state["tracks"].pop(carried_key)
+                    close_outputs(state["tracks"][key])
+                    open_output(state["tracks"][key], json_path, start_fno)
+                    log.info(f"Carry track: {carried_key} -> {key}")
+                elif key not in state["tracks"]:
+                    first_frame = str_frames[str(start_fno)]
+                    state["tracks"][key] = new_track(
+                        get_series_layout(state["global_joints_mode"]),
+                        first_frame["camera"]["z"] if "camera" in first_frame else 0.0,
+                        state["start_z"],
+                        json_path,
+                        start_fno,
+                    )
+
+                update_track(state["tracks"][key], str_frames, state["global_joints_mode"], lag)
+
+            # 次のブロックは今回の最後のフレームから始まるので、そこまで続いていないトラックは今確定する
+            finalize_tracks(
+                state,
+                lag,
+                keep=lambda track: track["next_fno"] is not None and block_end_fno - track["next_fno"] <= lag,
+            )
+
+    state["pkl_names"].append(os.path.basename(pkl_path))
+
+
+def smooth_online(
+    output_dir_path: str,
+    lag: int = LAG,
+    follow: bool = False,
+    poll_seconds: float = POLL_SECONDS,
+    global_joints_mode: str = exec_smooth.GLOBAL_JOINTS_MODE,
+):
+    state = load_state(output_dir_path, global_joints_mode)
+
+    while True:
+        new_pkl_paths = [
+            pkl_path
+            for pkl_path in sorted(glob(os.path.join(output_dir_path, "*.pkl")))
+            if os.path.basename(pkl_path) not in state["pkl_names"]
+            and time.time() - os.path.getmtime(pkl_path) >= poll_seconds
+        ]
+
+        for pkl_path in new_pkl_paths:
+            log.info(f"Smooth online: {pkl_path}")
+            process_block(output_dir_path, pkl_path, state, lag)
+            save_state(output_dir_path, state)
+            # 確定したフレームをトラックの終わりを待たずに読めるようにする
+            publish_outputs(state)
+
+        if new_pkl_paths:
+            continue
+
+        if os.path.exists(os.path.join(output_dir_path, "end_of_frame")):
+            # トラッキングが終わったら残りを確定する
+            finalize_tracks(state, lag)
+            save_state(output_dir_path, state)
+            break
+
+        if not follow:
+            break
+
+        time.sleep(poll_seconds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_dir")
+    parser.add_argument("--follow", action="store_true", help="トラッキングが終わるまで新しいpklを待つ")
+    parser.add_argument("--lag", type=int, default=LAG)
+    parser.add_argument("--poll-seconds", type=float, default=POLL_SECONDS)
+    args = parser.parse_args()
+
+    log.info("Start: smooth online =============================")
+
+    smooth_online(args.output_dir, args.lag, args.follow, args.poll_seconds)
+
+    log.info("End: smooth online =============================")
@@ -7,6 +7,7 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional, Tuple
 
+import cv2
 import hydra
 import joblib
 import torch
@@ -22,6 +23,10 @@ from phalp.configs.base import CACHE_DIR
 
 from hmr2.datasets.utils import expand_bbox_to_aspect_ratio
 
+import frame_filter
+import frame_stream
+import metrics
+
 warnings.filterwarnings("ignore")
 
 log = get_pylogger(__name__)
@@ -177,30 +182,83 @@ class HMR2_4dhuman(PHALP):
 
         # 出力ディレクトリ内にpklがある場合、開始フレームを調整する
         prev_pkl_files = sorted(glob(os.path.join(cfg.video.output_dir, "*.pkl")))
+        prev_last_key = 0
         if prev_pkl_files:
             last_pkl_file = prev_pkl_files[-1]
             with open(last_pkl_file, "rb") as f:
                 lib_data = joblib.load(f)
                 last_frame = sorted(lib_data.keys())[-1]
                 log.info(f"Prev Last Frame: {last_frame}")
+                prev_last_key = int(last_frame)
                 cfg.phalp.start_frame = last_frame - 1
         else:
             # まだpklファイルが出ていない場合、end_of_frameファイルを削除
             cfg.phalp.start_frame = -1
             if os.path.exists(os.path.join(cfg.video.output_dir, "end_of_frame")):
                 os.remove(os.path.join(cfg.video.output_dir, "end_of_frame"))
+            # 前回の実行で飛ばしたフレームの記録も消す
+            skipped_path = os.path.join(cfg.video.output_dir, frame_filter.SKIPPED_FRAMES_FILE_NAME)
+            if os.path.exists(skipped_path):
+                os.remove(skipped_path)
 
         # 単位で区切る
         cfg.phalp.end_frame = cfg.phalp.start_frame + cfg.block_frame_num + 1
 
         super().__init__(cfg)
 
+        if cfg.video_stream and os.path.isfile(cfg.video.source):
+            # フレーム画像を書き出さずに、動画から直接読み込む
+            self.io_manager = frame_stream.StreamIOManager(cfg, self.io_manager)
+
+        # 人物のいない無地や変化のないフレームは検出とHMR2を飛ばす (飛ばしたフレームは平滑化で補間するため記録する)
+        self.frame_filter = frame_filter.FrameFilter() if cfg.skip_static else None
+        self.skipped_frames = {}
+        # pkl2json と同じく、前のブロックの最後のキーからフレーム番号を数える
+        self.prev_last_key = prev_last_key
+
     def setup_hmr(self):
         self.HMAR = HMR2023TextureSampler(self.cfg)
 
+    def get_detection_scale(self, image, frame_name, additional_data=None) -> float:
+        """検出に使う画像の縮小率 (縮小しない場合は1)"""
+        if self.cfg.detect_long_side <= 0:
+            return 1.0
+        if additional_data is not None and frame_name in additional_data:
+            # 外部の検出結果は元の解像度
+            return 1.0
+        return min(1.0, self.cfg.detect_long_side / max(image.shape[:2]))
+
+    def get_empty_detections(self, image):
+        """人物がいない場合の検出結果 (HMR2は人数0で呼ばれないので重い処理は走らない)"""
+        height, width = image.shape[:2]
+        return (
+            np.zeros((0, 4), dtype=np.float32),
+            np.zeros((0, 4), dtype=np.float32),
+            np.zeros((0, height, width), dtype=bool),
+            np.zeros(0, dtype=np.float32),
+            np.zeros(0, dtype=np.int64),
+            [],
+            [],
+        )
+
     def get_detections(
         self, image, frame_name, t_, additional_data=None, measurments=None
     ):
+        if self.frame_filter is not None and (additional_data is None or frame_name not in additional_data):
+            reason = self.frame_filter.check(image)
+            if reason:
+                self.skipped_frames[t_ + self.prev_last_key] = reason
+                return self.get_empty_detections(image)
+
+        scale = self.get_detection_scale(image, frame_name, additional_data)
+        detect_image = image
+        if scale < 1.0:
+            # 検出だけ縮小した画像で行う
+            height, width = image.shape[:2]
+            detect_image = cv2.resize(
+                image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA
+            )
+
         (
             pred_bbox,
             pred_bbox,
@@ -209,7 +267,22 @@ class HMR2_4dhuman(PHALP):
             pred_classes,
             ground_truth_track_id,
             ground_truth_annotations,
-        ) = super().get_detections(image, frame_name, t_, additional_data, measurments)
+        ) = super().get_detections(detect_image, frame_name, t_, additional_data, measurments)
+
+        if scale < 1.0:
+            # bboxとマスクを元の解像度に戻す (HMR2の切り出しは元の画像から行う)
+            pred_bbox = pred_bbox / scale
+            pred_masks = np.array(
+                [
+                    cv2.resize(mask.astype(np.uint8), (width, height), interpolation=cv2.INTER_NEAREST).astype(
+                        mask.dtype
+                    )
+                    for mask in pred_masks
+                ]
+            ).reshape(len(pred_masks), height, width)
+
+        if self.frame_filter is not None:
+            self.frame_filter.update(len(pred_scores))
 
         # Pad bounding boxes
         pred_bbox_padded = expand_bbox_to_aspect_ratio(
@@ -232,6 +305,12 @@ class Human4DConfig(FullConfig):
     # override defaults if needed
     expand_bbox_shape: Optional[Tuple[int]] = (192, 256)
     block_frame_num: int = 1000
+    # 検出は長辺をこのサイズに縮小した画像で行う (0の場合は縮小しない)
+    detect_long_side: int = int(os.environ.get("MAT4_DETECT_LONG_SIDE", 0))
+    # 動画をフレーム画像に書き出さず、別スレッドでデコードしながら読み込む
+    video_stream: bool = os.environ.get("MAT4_VIDEO_STREAM", "") == "1"
+    # 人物のいない無地や変化のないフレームで検出とHMR2を飛ばす
+    skip_static: bool = os.environ.get("MAT4_SKIP_STATIC", "") == "1"
     pass
 
 cs = ConfigStore.instance()
@@ -243,9 +322,20 @@ def main(cfg: DictConfig) -> Optional[float]:
     """Main function for running the PHALP tracker."""
     log.info("Start: 4D-Humans =============================")
 
-    phalp_tracker = HMR2_4dhuman(cfg)
+    with metrics.measure(cfg.video.output_dir, "track") as record:
+        phalp_tracker = HMR2_4dhuman(cfg)
+
+        phalp_tracker.track()
+
+        if phalp_tracker.frame_filter is not None:
+            frame_filter.save_skipped_frames(cfg.video.output_dir, phalp_tracker.skipped_frames)
+            record["skipped"] = len(phalp_tracker.skipped_frames)
 
-    phalp_tracker.track()
+        # 今回のブロックで読み取ったフレーム数
+        prev_pkl_files = sorted(glob(os.path.join(cfg.video.output_dir, "*.pkl")))
+        if prev_pkl_files:
+            with open(prev_pkl_files[-1], "rb") as f:
+                record["frames"] = len(joblib.load(f))
 
     log.info("End: 4D-Humans =============================")
 
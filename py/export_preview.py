@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import struct
+
+import numpy as np
+from phalp.utils import get_pylogger
+
+import joint_schema
+import json_io
+
+log = get_pylogger(__name__)
+
+# data/vis/visualize.html で再生するプレビュー
+# 先頭 MAGIC (8byte) + ヘッダ長 (uint32 LE) + ヘッダ(json) のあとに
+# float32 LE の global_3d_joints が [フレーム][関節][xyz] の順で並ぶ (ないものは NaN)
+MAGIC = b"MAT4PRV1"
+PREVIEW_SUFFIX = "_preview.bin"
+
+# 何フレームごとに出力するか
+PREVIEW_STEP = int(os.environ.get("MAT4_PREVIEW_STEP", 2))
+
+
+def get_preview_path(json_path: str) -> str:
+    """.json / .json.gz の拡張子を _preview.bin にしたパス"""
+    for suffix in (".json" + json_io.GZIP_SUFFIX, ".json"):
+        if json_path.endswith(suffix):
+            return json_path[: -len(suffix)] + PREVIEW_SUFFIX
+    return json_path + PREVIEW_SUFFIX
+
+
+def export_preview(json_path: str, step: int = PREVIEW_STEP) -> str:
+    """トラックjsonからプレビューを出力して、そのパスを返す"""
+    frames = json_io.load(json_path)["frames"]
+    joint_names = joint_schema.get_joint_names("global_3d_joints", ["visualizer"])
+
+    fnos = sorted(int(fno) for fno in frames.keys())
+    start_fno = fnos[0] if fnos else 0
+    end_fno = fnos[-1] if fnos else -1
+    sample_fnos = range(start_fno, end_fno + 1, step)
+
+    joints = np.full((len(sample_fnos), len(joint_names), 3), np.nan, dtype=np.float32)
+    for i, fno in enumerate(sample_fnos):
+        global_joints = frames.get(str(fno), {}).get("global_3d_joints", {})
+        for j, jname in enumerate(joint_names):
+            if jname in global_joints:
+                joints[i, j] = [global_joints[jname][axis] for axis in ("x", "y", "z")]
+
+    header = {
+        "version": 1,
+        "source": os.path.basename(json_path),
+        "start_fno": start_fno,
+        "step": step,
+        "frame_count": len(sample_fnos),
+        "joints": joint_names,
+        # 表示範囲の初期値
+        "min": np.nan_to_num(np.nanmin(joints, axis=(0, 1)) if joints.size else np.zeros(3)).tolist(),
+        "max": np.nan_to_num(np.nanmax(joints, axis=(0, 1)) if joints.size else np.zeros(3)).tolist(),
+    }
+    header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    # Float32Array で読めるよう、データの開始位置を4byte境界にそろえる
+    header_bytes += b" " * (-(len(MAGIC) + 4 + len(header_bytes)) % 4)
+
+    preview_path = get_preview_path(json_path)
+    tmp_path = f"{preview_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+        f.write(joints.astype("<f4").tobytes())
+    os.replace(tmp_path, preview_path)
+
+    log.info(
+        f"[{os.path.basename(preview_path)}] {len(sample_fnos)} frames, {os.path.getsize(preview_path) / 1024 / 1024:.2f} MB"
+    )
+
+    return preview_path
+
+
+def export_previews(target_path: str, step: int = PREVIEW_STEP) -> list[str]:
+    """ディレクトリの場合は平滑化済みのトラックをすべて出力する"""
+    if not os.path.isdir(target_path):
+        return [export_preview(target_path, step)]
+
+    return [
+        export_preview(json_path, step)
+        for json_path in json_io.glob_json(os.path.join(target_path, "*_smooth.json"))
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("target", help="トラックjson (.json / .json.gz のどちらも可) または出力ディレクトリ")
+    parser.add_argument("--step", type=int, default=PREVIEW_STEP, help="何フレームごとに出力するか")
+    args = parser.parse_args()
+
+    log.info("Start: export preview =============================")
+
+    export_previews(args.target, max(1, args.step))
+
+    log.info("End: export preview =============================")
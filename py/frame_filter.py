@@ -0,0 +1,96 @@
+import json
+import os
+
+import cv2
+import numpy as np
+from phalp.utils import get_pylogger
+
+log = get_pylogger(__name__)
+
+# 判定に使う縮小画像の長辺
+THUMB_LONG_SIDE = 64
+# 輝度の標準偏差がこれ未満の場合は暗転などの無地のフレームとみなす (0-255)
+SKIP_BLANK_STD = float(os.environ.get("MAT4_SKIP_BLANK_STD", 3.0))
+# 最後に検出したフレームとの輝度差が全画素でこれ未満の場合は変化なしとみなす (0-255)
+# 平均ではなく最大で見るので、小さく映った人物が入ってきた場合も検出する
+SKIP_STATIC_DIFF = float(os.environ.get("MAT4_SKIP_STATIC_DIFF", 8.0))
+# 続けてこのフレーム数だけ人物を検出しなかった後にだけ飛ばす (検出が途切れたトラックのフレームは飛ばさない)
+SKIP_MIN_EMPTY_RUN = int(os.environ.get("MAT4_SKIP_MIN_EMPTY_RUN", 5))
+
+SKIPPED_FRAMES_FILE_NAME = "skipped_frames.json"
+
+
+class FrameFilter:
+    """人物のいないフレーム (人物のいないフレームが続いた後の、無地のフレームと変化のないフレーム) を判定する"""
+
+    def __init__(
+        self,
+        blank_std: float = SKIP_BLANK_STD,
+        static_diff: float = SKIP_STATIC_DIFF,
+        min_empty_run: int = SKIP_MIN_EMPTY_RUN,
+    ):
+        self.blank_std = blank_std
+        self.static_diff = static_diff
+        self.min_empty_run = min_empty_run
+
+        self.thumb = None
+        self.reference_thumb = None
+        # 続けて人物を検出しなかったフレーム数
+        self.empty_run = 0
+
+    def make_thumb(self, image: np.ndarray) -> np.ndarray:
+        height, width = image.shape[:2]
+        scale = THUMB_LONG_SIDE / max(height, width)
+        thumb = cv2.resize(
+            image, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA
+        )
+        if thumb.ndim == 3:
+            thumb = cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY)
+        return thumb.astype(np.float32)
+
+    def check(self, image: np.ndarray) -> str:
+        """検出を飛ばす理由 ("blank" / "static")。検出する場合は空文字"""
+        self.thumb = self.make_thumb(image)
+
+        # 人物がいたフレームの直後は飛ばさない (暗転しても検出が途切れるだけで、トラッキング結果が変わる)
+        if self.empty_run < self.min_empty_run:
+            return ""
+
+        if self.thumb.std() < self.blank_std:
+            return "blank"
+
+        if self.reference_thumb is None or self.reference_thumb.shape != self.thumb.shape:
+            return ""
+        if np.max(np.abs(self.thumb - self.reference_thumb)) >= self.static_diff:
+            return ""
+
+        # 誰もいないフレームから変化がない間はずっと飛ばす (少しずつの変化は最後に検出したフレームとの差で拾う)
+        return "static"
+
+    def update(self, people_num: int):
+        """検出したフレームを以降の比較の基準にする"""
+        self.reference_thumb = self.thumb
+        self.empty_run = 0 if people_num else self.empty_run + 1
+
+
+def save_skipped_frames(output_dir_path: str, skipped_frames: dict[int, str]):
+    """飛ばしたフレーム (pkl2json のフレーム番号: 理由) を既存の記録に追記する"""
+    skipped_path = os.path.join(output_dir_path, SKIPPED_FRAMES_FILE_NAME)
+    all_skipped_frames = load_skipped_frames(output_dir_path)
+    all_skipped_frames.update(skipped_frames)
+
+    tmp_path = f"{skipped_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({str(fno): reason for fno, reason in sorted(all_skipped_frames.items())}, f, indent=4)
+    os.replace(tmp_path, skipped_path)
+
+    log.info(f"skipped frames: {len(skipped_frames)} (total {len(all_skipped_frames)})")
+
+
+def load_skipped_frames(output_dir_path: str) -> dict[int, str]:
+    """飛ばしたフレームの記録 (フレーム番号: 理由)。記録がなければ空"""
+    skipped_path = os.path.join(output_dir_path, SKIPPED_FRAMES_FILE_NAME)
+    if not os.path.exists(skipped_path):
+        return {}
+    with open(skipped_path, "r") as f:
+        return {int(fno): reason for fno, reason in json.load(f).items()}
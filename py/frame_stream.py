@@ -0,0 +1,130 @@
+from collections import deque
+import os
+import threading
+
+import cv2
+import numpy as np
+from phalp.utils import get_pylogger
+
+log = get_pylogger(__name__)
+
+# 先読みしておくフレーム数
+FRAME_BUFFER_SIZE = int(os.environ.get("MAT4_FRAME_BUFFER_SIZE", 64))
+
+
+class FrameStream:
+    """動画を別スレッドで先頭から順にデコードして、リングバッファに溜める (読み出しも順番に行うこと)"""
+
+    def __init__(self, video_path: str, start_frame: int, end_frame: int, buffer_size: int = FRAME_BUFFER_SIZE):
+        self.video_path = video_path
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.buffer_size = buffer_size
+
+        self.buffer = deque()
+        self.condition = threading.Condition()
+        self.is_finished = False
+        self.is_closed = False
+        self.thread = threading.Thread(target=self.decode, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def decode(self):
+        cap = cv2.VideoCapture(self.video_path)
+        try:
+            # シークはコーデックによってずれるので、開始フレームまではデコードせずに読み飛ばす
+            for _ in range(self.start_frame):
+                if not cap.grab():
+                    return
+
+            for fno in range(self.start_frame, self.end_frame):
+                ok, frame = cap.read()
+                if not ok:
+                    log.warning(f"[{os.path.basename(self.video_path)}] End of video at {fno}")
+                    return
+
+                with self.condition:
+                    self.condition.wait_for(lambda: len(self.buffer) < self.buffer_size or self.is_closed)
+                    if self.is_closed:
+                        return
+                    self.buffer.append((fno, frame))
+                    self.condition.notify_all()
+        finally:
+            cap.release()
+            with self.condition:
+                self.is_finished = True
+                self.condition.notify_all()
+
+    def read(self, fno: int):
+        """fno のフレーム。それより前のフレームはバッファから捨てる。動画の終端を超えた場合は None"""
+        with self.condition:
+            while True:
+                while self.buffer and self.buffer[0][0] < fno:
+                    self.buffer.popleft()
+                    self.condition.notify_all()
+                if self.buffer and self.buffer[0][0] == fno:
+                    return self.buffer[0][1]
+                if self.is_finished or (self.buffer and self.buffer[0][0] > fno):
+                    return None
+                self.condition.wait()
+
+    def close(self):
+        with self.condition:
+            self.is_closed = True
+            self.buffer.clear()
+            self.condition.notify_all()
+
+
+class StreamIOManager:
+    """PHALP の io_manager の代わりに、動画をフレーム画像に書き出さずに直接読み込む"""
+
+    def __init__(self, cfg, io_manager, buffer_size: int = FRAME_BUFFER_SIZE):
+        self.cfg = cfg
+        self.io_manager = io_manager
+        self.buffer_size = buffer_size
+        self.stream = None
+        self.frame_fnos = {}
+        self.frame_shape = None
+
+    def __getattr__(self, name):
+        # それ以外(書き出しなど)は元の io_manager に任せる
+        return getattr(self.io_manager, name)
+
+    def get_frames_from_source(self) -> dict:
+        source_path = self.cfg.video.source
+        video_name = os.path.splitext(os.path.basename(source_path))[0]
+
+        cap = cv2.VideoCapture(source_path)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.frame_shape = (int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), 3)
+        cap.release()
+
+        # フレーム名は画像に書き出した場合と同じにする (画像は作らない)
+        img_dir_path = os.path.join(self.cfg.video.output_dir, "_DEMO", video_name, "img")
+        list_of_frames = [os.path.join(img_dir_path, f"{fno:06d}.jpg") for fno in range(frame_count)]
+        self.frame_fnos = {frame_name: fno for fno, frame_name in enumerate(list_of_frames)}
+
+        # PHALP はこの範囲だけを読む (start_frame が -1 の場合は全体)
+        start_frame = max(0, self.cfg.phalp.start_frame)
+        end_frame = frame_count if self.cfg.phalp.start_frame == -1 else min(frame_count, self.cfg.phalp.end_frame)
+
+        log.info(f"[{video_name}] Stream frames {start_frame} - {end_frame} / {frame_count}")
+
+        if self.stream:
+            self.stream.close()
+        self.stream = FrameStream(source_path, start_frame, end_frame, self.buffer_size)
+        self.stream.start()
+
+        return {"list_of_frames": list_of_frames, "additional_data": {}, "video_name": video_name}
+
+    def read_frame(self, frame_name):
+        if frame_name not in self.frame_fnos:
+            return self.io_manager.read_frame(frame_name)
+
+        frame = self.stream.read(self.frame_fnos[frame_name])
+        if frame is None:
+            # フレーム数は動画のヘッダの値なので、実際より多い場合がある
+            log.warning(f"Frame not found: {frame_name}")
+            return np.zeros(self.frame_shape, dtype=np.uint8)
+        return frame
@@ -0,0 +1,141 @@
+import os
+
+# 出力先ごとに必要な関節 (種類: 関節名)。2d_joints は平滑化しないので全関節を出力する
+CONSUMER_JOINTS = {
+    # go/pkg/usecase/move_usecase.go (joint2bones)
+    "mat4": {
+        "3d_joints": [
+            "OP Nose",
+            "OP Neck",
+            "OP RShoulder",
+            "OP RElbow",
+            "OP RWrist",
+            "OP LShoulder",
+            "OP LElbow",
+            "OP LWrist",
+            "OP MidHip",
+            "OP RHip",
+            "OP RKnee",
+            "OP RAnkle",
+            "OP LHip",
+            "OP LKnee",
+            "OP LAnkle",
+            "OP REye",
+            "OP LEye",
+            "OP REar",
+            "OP LEar",
+            "OP LBigToe",
+            "OP LSmallToe",
+            "OP LHeel",
+            "OP RBigToe",
+            "OP RSmallToe",
+            "OP RHeel",
+            "Pelvis (MPII)",
+            "Spine (H36M)",
+            "Head (H36M)",
+        ],
+    },
+    # data/vis/visualize.html (order)
+    "visualizer": {
+        "global_3d_joints": [
+            "Top of Head (LSP)",
+            "OP Nose",
+            "OP Neck",
+            "Spine (H36M)",
+            "Pelvis (MPII)",
+            "OP MidHip",
+            "OP LShoulder",
+            "OP LElbow",
+            "OP LWrist",
+            "OP RShoulder",
+            "OP RElbow",
+            "OP RWrist",
+            "OP RHip",
+            "OP RKnee",
+            "OP RAnkle",
+            "OP RBigToe",
+            "OP LHip",
+            "OP LKnee",
+            "OP LAnkle",
+            "OP LBigToe",
+            "OP LEar",
+            "OP LEye",
+            "OP REar",
+            "OP REye",
+        ],
+    },
+    # mediapipe の関節と対応付けるもの
+    "mediapipe": {
+        "3d_joints": [
+            "OP Nose",
+            "OP REye",
+            "OP LEye",
+            "OP REar",
+            "OP LEar",
+            "OP RShoulder",
+            "OP LShoulder",
+            "OP RElbow",
+            "OP LElbow",
+            "OP RWrist",
+            "OP LWrist",
+            "OP RHip",
+            "OP LHip",
+            "OP RKnee",
+            "OP LKnee",
+            "OP RAnkle",
+            "OP LAnkle",
+            "OP RHeel",
+            "OP LHeel",
+            "OP RBigToe",
+            "OP LBigToe",
+        ],
+    },
+}
+
+# 同じ部位の重複定義 (統合先: 統合元)。統合する場合、出力は統合先の名前で、位置は平均
+JOINT_ALIASES = {
+    "OP Nose": ["Nose"],
+    "OP RShoulder": ["Right Shoulder"],
+    "OP RElbow": ["Right Elbow"],
+    "OP RWrist": ["Right Wrist"],
+    "OP LShoulder": ["Left Shoulder"],
+    "OP LElbow": ["Left Elbow"],
+    "OP LWrist": ["Left Wrist"],
+    "OP RHip": ["Right Hip"],
+    "OP RKnee": ["Right Knee"],
+    "OP RAnkle": ["Right Ankle"],
+    "OP LHip": ["Left Hip"],
+    "OP LKnee": ["Left Knee"],
+    "OP LAnkle": ["Left Ankle"],
+    "OP REye": ["Right Eye"],
+    "OP LEye": ["Left Eye"],
+    "OP REar": ["Right Ear"],
+    "OP LEar": ["Left Ear"],
+}
+
+# 重複定義を統合する (既定は統合せず、統合先の関節の値をそのまま出力する)
+FUSE_JOINTS = os.environ.get("MAT4_FUSE_JOINTS", "") == "1"
+
+# 出力する出力先 (カンマ区切り)
+CONSUMERS = [
+    consumer
+    for consumer in os.environ.get("MAT4_JOINT_CONSUMERS", ",".join(CONSUMER_JOINTS.keys())).split(",")
+    if consumer
+]
+
+
+def get_joint_names(type_name: str, consumers: list[str] = CONSUMERS) -> list[str]:
+    """出力先で使う関節名(重複なし)"""
+    joint_names = []
+    for consumer in consumers:
+        for jname in CONSUMER_JOINTS[consumer].get(type_name, []):
+            if jname not in joint_names:
+                joint_names.append(jname)
+    return joint_names
+
+
+def get_joint_sources(joint_name: str, fuse: bool = FUSE_JOINTS) -> list[str]:
+    """統合する元の関節名 (統合しない場合はその関節のみ)"""
+    if not fuse:
+        return [joint_name]
+    return [joint_name] + JOINT_ALIASES.get(joint_name, [])
@@ -0,0 +1,129 @@
+from glob import glob
+import gzip
+import json
+import os
+
+import async_writer
+
+# トラックjsonの出力形式
+# precision: 小数の桁数 (負の場合は丸めない。既定は丸めない)
+# gzip: .json.gz で出力する (読み込みはどちらも可)
+JSON_FORMAT = {
+    "precision": int(os.environ.get("MAT4_JSON_PRECISION", -1)),
+    "gzip": os.environ.get("MAT4_JSON_GZIP", "") == "1",
+}
+
+GZIP_SUFFIX = ".gz"
+
+# 圧縮率より速度を優先
+GZIP_LEVEL = 5
+
+
+def get_path(json_path: str, is_gzip: bool = None) -> str:
+    """出力するファイルのパス (json_path は .json のパス)"""
+    if is_gzip is None:
+        is_gzip = JSON_FORMAT["gzip"]
+    return json_path + GZIP_SUFFIX if is_gzip else json_path
+
+
+def find(json_path: str) -> str:
+    """既存のファイルのパス (.json / .json.gz)。ない場合は None"""
+    for path in (json_path, json_path + GZIP_SUFFIX):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def exists(json_path: str) -> bool:
+    return find(json_path) is not None
+
+
+def glob_json(pattern: str) -> list[str]:
+    """.json / .json.gz のどちらかがあるファイルの .json のパス"""
+    paths = set(glob(pattern)) | {path[: -len(GZIP_SUFFIX)] for path in glob(pattern + GZIP_SUFFIX)}
+    return sorted(paths)
+
+
+def open_file(path: str, mode: str = "r", is_gzip: bool = None):
+    if is_gzip is None:
+        is_gzip = path.endswith(GZIP_SUFFIX)
+    if is_gzip:
+        return gzip.open(path, mode + "t", encoding="utf-8", compresslevel=GZIP_LEVEL)
+    return open(path, mode, encoding="utf-8")
+
+
+def load(json_path: str) -> dict:
+    path = find(json_path)
+    if path is None:
+        raise FileNotFoundError(json_path)
+    with open_file(path, "r") as f:
+        return json.load(f)
+
+
+def round_floats(value, precision: int):
+    if isinstance(value, float):
+        return round(value, precision)
+    if isinstance(value, dict):
+        return {k: round_floats(v, precision) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [round_floats(v, precision) for v in value]
+    return value
+
+
+def encode_value(value, precision: int = None) -> str:
+    if precision is None:
+        precision = JSON_FORMAT["precision"]
+    if 0 <= precision:
+        value = round_floats(value, precision)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def encode_frame(fno, frame_data: dict, precision: int = None) -> str:
+    """フレーム1件分の "fno":{...}"""
+    return f'"{fno}":{encode_value(frame_data, precision)}'
+
+
+def encode_frames(frames: dict, header: dict = {}, precision: int = None):
+    """{**header, "frames": frames} のコンパクトなjsonをフレームごとの断片で返す (ジェネレータ)"""
+    yield "{"
+    for key, value in header.items():
+        yield f"{json.dumps(key)}:{encode_value(value, precision)},"
+    yield '"frames":{'
+    for n, (fno, frame_data) in enumerate(frames.items()):
+        yield f'{"," if n else ""}{encode_frame(fno, frame_data, precision)}'
+    yield "}}"
+
+
+def write_tmp_file(json_path: str, chunks) -> str:
+    """encode_frames の断片を順に一時ファイルに書き出して、一時ファイルのパスを返す (断片はためない)"""
+    path = get_path(json_path)
+
+    # 書き込み途中のファイルを読まれないよう、一時ファイルに書いてから置き換える
+    tmp_path = f"{path}.tmp"
+    with open_file(tmp_path, "w", path.endswith(GZIP_SUFFIX)) as f:
+        for chunk in chunks:
+            f.write(chunk)
+    return tmp_path
+
+
+def replace_tmp_file(json_path: str, tmp_path: str) -> str:
+    """write_tmp_file で書いた一時ファイルで置き換えて、出力したパスを返す"""
+    path = tmp_path[: -len(".tmp")]
+    async_writer.replace_file(tmp_path, path)
+
+    # 形式を変えた場合に古い方が残らないようにする (新しい方を書き終えてから消す)
+    for old_path in (json_path, json_path + GZIP_SUFFIX):
+        if old_path != path and os.path.exists(old_path):
+            os.remove(old_path)
+
+    return path
+
+
+def write_chunks(json_path: str, chunks) -> str:
+    """encode_frames の断片を書き出して、出力したパスを返す"""
+    return replace_tmp_file(json_path, write_tmp_file(json_path, chunks))
+
+
+def dump_frames(json_path: str, frames: dict, header: dict = {}, precision: int = None) -> str:
+    """{**header, "frames": frames} をフレームごとにコンパクトなjsonで書き出して、出力したパスを返す"""
+    return write_chunks(json_path, encode_frames(frames, header, precision))
@@ -4,8 +4,8 @@ import os
 import sys
 import time
 
-import py.exec_pkl2json as exec_pkl2json
 import exec_mediapipe
+import exec_pkl2json
 import exec_smooth
 import exec_track
 
@@ -7,10 +7,28 @@ import joblib
 import numpy as np
 from tqdm import tqdm
 from phalp.utils.trace_io import TraceFrameExtractor
-from py.exec_pkl2json import JOINT_INDEXES
+
+import async_writer
+from exec_pkl2json import JOINT_INDEXES
+import metrics
+
+
+def open_video(video: dict, video_path: str, size: tuple):
+    video["writer"] = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*"mp4v"), 30, size)
+
+
+def write_video(video: dict, frame: np.ndarray):
+    video["writer"].write(frame)
+
+
+def release_video(video: dict):
+    if "writer" in video:
+        video.pop("writer").release()
 
 
 def make_upper_video(video_path, pkl_path):
+    metrics_record = metrics.start(os.path.dirname(pkl_path), "upper_video")
+
     with open(pkl_path, "rb") as f:
         lib_data = joblib.load(f)
 
@@ -165,39 +183,50 @@ def make_upper_video(video_path, pkl_path):
                     sizes.append(size_data[tracked_id][hand][time])
                 max_size = np.max(sizes, axis=0)
 
-            hand_video = cv2.VideoWriter(
-                os.path.join(
-                    os.path.dirname(pkl_path),
-                    f"{video_name}_{tracked_id:02d}_{hand}.mp4",
-                ),
-                cv2.VideoWriter_fourcc(*"mp4v"),
-                30,
-                (max_size[1], max_size[0]),
+            hand_video_path = os.path.join(
+                os.path.dirname(pkl_path),
+                f"{video_name}_{tracked_id:02d}_{hand}.mp4",
             )
-
-            for time in tqdm(
-                range(max(all_data[tracked_id][hand].keys()) + 1),
-                desc=f"{tracked_id:02d}_{hand}",
-            ):
-                if time in all_data[tracked_id][hand]:
-                    frame = np.zeros((max_size[0], max_size[1], 3), dtype=np.uint8)
-                    frame[
-                        : all_data[tracked_id][hand][time].shape[0],
-                        : all_data[tracked_id][hand][time].shape[1],
-                    ] = all_data[tracked_id][hand][time]
-                    hand_video.write(frame)
-                else:
-                    t = time
-                    while t not in all_data[tracked_id][hand]:
-                        t -= 1
-                    frame = np.zeros((max_size[0], max_size[1], 3), dtype=np.uint8)
-                    frame[
-                        : all_data[tracked_id][hand][t].shape[0],
-                        : all_data[tracked_id][hand][t].shape[1],
-                    ] = all_data[tracked_id][hand][t]
-                    hand_video.write(frame)
-
-            hand_video.release()
+            # 拡張子でコンテナが決まるので、一時ファイルも .mp4 にする
+            hand_video_tmp_path = hand_video_path.replace(".mp4", ".tmp.mp4")
+            hand_video = {}
+
+            try:
+                # 作成・エンコード・解放は別スレッドで行い、次のフレームの切り出しと重ねる
+                with async_writer.AsyncWriter(max_size=30) as writer:
+                    writer.submit(open_video, hand_video, hand_video_tmp_path, (max_size[1], max_size[0]))
+                    for time in tqdm(
+                        range(max(all_data[tracked_id][hand].keys()) + 1),
+                        desc=f"{tracked_id:02d}_{hand}",
+                    ):
+                        if time in all_data[tracked_id][hand]:
+                            frame = np.zeros((max_size[0], max_size[1], 3), dtype=np.uint8)
+                            frame[
+                                : all_data[tracked_id][hand][time].shape[0],
+                                : all_data[tracked_id][hand][time].shape[1],
+                            ] = all_data[tracked_id][hand][time]
+                            writer.submit(write_video, hand_video, frame)
+                        else:
+                            t = time
+                            while t not in all_data[tracked_id][hand]:
+                                t -= 1
+                            frame = np.zeros((max_size[0], max_size[1], 3), dtype=np.uint8)
+                            frame[
+                                : all_data[tracked_id][hand][t].shape[0],
+                                : all_data[tracked_id][hand][t].shape[1],
+                            ] = all_data[tracked_id][hand][t]
+                            writer.submit(write_video, hand_video, frame)
+
+                    writer.submit(release_video, hand_video)
+
+                async_writer.replace_file(hand_video_tmp_path, hand_video_path)
+            finally:
+                # 途中で失敗した場合も解放して、一時ファイルを残さない (書き出しスレッドは終了済み)
+                release_video(hand_video)
+                if os.path.exists(hand_video_tmp_path):
+                    os.remove(hand_video_tmp_path)
+
+    metrics.finish(metrics_record, len(lib_data))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+import cProfile
+from contextlib import contextmanager
+from datetime import datetime
+import fcntl
+import json
+import os
+import resource
+import time
+
+METRICS_FILE_NAME = "metrics.json"
+
+# cProfileを取るステージ (カンマ区切り、allで全ステージ)
+PROFILE_STAGES = set(filter(None, os.environ.get("MAT4_PROFILE", "").split(",")))
+
+
+def read_io_bytes() -> tuple[int, int]:
+    # Linux以外では取れないので0
+    try:
+        with open("/proc/self/io", "r") as f:
+            io = dict(line.split(": ") for line in f.read().splitlines())
+        return int(io["rchar"]), int(io["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def is_profile(stage: str) -> bool:
+    return "all" in PROFILE_STAGES or stage in PROFILE_STAGES
+
+
+def start(output_dir_path: str, stage: str, track: str = None) -> dict:
+    read_bytes, write_bytes = read_io_bytes()
+
+    record = {
+        "output_dir_path": output_dir_path,
+        "stage": stage,
+        "track": track,
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "frames": 0,
+        "_wall": time.perf_counter(),
+        "_cpu": time.process_time(),
+        "_read_bytes": read_bytes,
+        "_write_bytes": write_bytes,
+        "_profile": None,
+    }
+
+    if is_profile(stage):
+        record["_profile"] = cProfile.Profile()
+        record["_profile"].enable()
+
+    return record
+
+
+def finish(record: dict, frames: int = None) -> dict:
+    wall_seconds = time.perf_counter() - record.pop("_wall")
+    cpu_seconds = time.process_time() - record.pop("_cpu")
+    read_bytes, write_bytes = read_io_bytes()
+    profile = record.pop("_profile")
+
+    if frames is not None:
+        record["frames"] = frames
+
+    record["wall_seconds"] = round(wall_seconds, 3)
+    record["cpu_seconds"] = round(cpu_seconds, 3)
+    record["fps"] = round(record["frames"] / wall_seconds, 3) if wall_seconds > 0 else 0.0
+    # プロセス開始からのピーク (Linuxでは KB 単位)
+    record["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    record["read_bytes"] = read_bytes - record.pop("_read_bytes")
+    record["write_bytes"] = write_bytes - record.pop("_write_bytes")
+
+    output_dir_path = record.pop("output_dir_path")
+
+    if profile:
+        profile.disable()
+        profile_name = f"profile_{record['stage']}" + (f"_{record['track']}" if record["track"] else "")
+        profile.dump_stats(os.path.join(output_dir_path, f"{profile_name}.prof"))
+
+    append(output_dir_path, record)
+
+    return record
+
+
+@contextmanager
+def measure(output_dir_path: str, stage: str, track: str = None):
+    record = start(output_dir_path, stage, track)
+    try:
+        yield record
+    finally:
+        finish(record)
+
+
+def append(output_dir_path: str, record: dict):
+    metrics_path = os.path.join(output_dir_path, METRICS_FILE_NAME)
+
+    # 複数ワーカーから同時に書き込まれるのでロックを取る
+    with open(f"{metrics_path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        records = []
+        if os.path.exists(metrics_path):
+            with open(metrics_path, "r") as f:
+                try:
+                    records = json.load(f)["records"]
+                except (json.JSONDecodeError, KeyError):
+                    records = []
+        records.append(record)
+
+        tmp_path = f"{metrics_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"records": records}, f, indent=4)
+        os.replace(tmp_path, metrics_path)
@@ -0,0 +1,143 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from phalp.utils import get_pylogger
+
+log = get_pylogger(__name__)
+
+# 変換結果のキャッシュ置き場 (空文字の場合はキャッシュしない)
+CACHE_DIR = os.environ.get(
+    "MAT4_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "mmd-auto-trace-4")
+)
+
+# キャッシュの上限サイズ。超えたら使われていない順に消す
+CACHE_MAX_BYTES = int(float(os.environ.get("MAT4_CACHE_MAX_GB", 20)) * 1024**3)
+
+
+def update_file_hash(sha1, file_path: str):
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(chunk)
+
+
+def get_key(stage: str, input_paths: list[str], params, code_paths: list[str]) -> str:
+    """入力ファイルの内容、ステージ、パラメータ、処理コードの内容から求めるキー"""
+    sha1 = hashlib.sha1()
+    sha1.update(stage.encode())
+    for input_path in input_paths:
+        sha1.update(os.path.basename(input_path).encode())
+        update_file_hash(sha1, input_path)
+    sha1.update(repr(params).encode())
+    for code_path in code_paths:
+        update_file_hash(sha1, code_path)
+    return sha1.hexdigest()
+
+
+def get_cache_dir(cache_dir: str = None) -> str:
+    # 実行中に CACHE_DIR を変えた場合も反映されるよう、呼び出し時に読む
+    return CACHE_DIR if cache_dir is None else cache_dir
+
+
+def get_entry_dir(key: str, cache_dir: str = None) -> str:
+    return os.path.join(get_cache_dir(cache_dir), key[:2], key)
+
+
+def materialize(src_path: str, dst_path: str):
+    # 同じファイルシステムならハードリンク、それ以外はコピー (既存の出力はアトミックに置き換える)
+    tmp_path = f"{dst_path}.cache.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+
+
+def restore(key: str, output_dir_path: str, names: dict = {}, cache_dir: str = None) -> list[str]:
+    """キャッシュがあれば出力先に展開して、展開したパスを返す。names でファイル名を変えられる"""
+    cache_dir = get_cache_dir(cache_dir)
+    if not cache_dir:
+        return []
+
+    entry_dir = get_entry_dir(key, cache_dir)
+    if not os.path.isdir(entry_dir):
+        return []
+
+    output_paths = []
+    try:
+        for name in sorted(os.listdir(entry_dir)):
+            output_path = os.path.join(output_dir_path, names.get(name, name))
+            materialize(os.path.join(entry_dir, name), output_path)
+            output_paths.append(output_path)
+        # 使った順に残すため更新日時を更新
+        os.utime(entry_dir)
+    except OSError as e:
+        # 展開中に他のプロセスに消された
+        log.warning(f"Cache restore failed: {entry_dir}: {e}")
+        for output_path in output_paths:
+            os.remove(output_path)
+        return []
+
+    log.info(f"Cache hit: {key} ({len(output_paths)} files)")
+
+    return output_paths
+
+
+def store(key: str, file_paths: dict, cache_dir: str = None, max_bytes: int = CACHE_MAX_BYTES):
+    """出力ファイル (キャッシュ内の名前: パス) をキャッシュに保存する"""
+    cache_dir = get_cache_dir(cache_dir)
+    if not cache_dir or not file_paths:
+        return
+
+    entry_dir = get_entry_dir(key, cache_dir)
+    if os.path.isdir(entry_dir):
+        return
+
+    os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+
+    # 書き込み途中のエントリが見えないよう、一時ディレクトリに作ってから置き換える
+    tmp_dir = tempfile.mkdtemp(prefix=f"{key}.", dir=os.path.dirname(entry_dir))
+    try:
+        for name, file_path in file_paths.items():
+            # 出力が後で書き換えられてもキャッシュに影響しないようコピーする
+            shutil.copyfile(file_path, os.path.join(tmp_dir, name))
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # 他のプロセスが同じエントリを保存済み
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+
+    evict(cache_dir, max_bytes)
+
+
+def get_entry_size(entry_dir: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+
+
+def evict(cache_dir: str = None, max_bytes: int = CACHE_MAX_BYTES):
+    """上限サイズを超えた分を使われていない順に消す"""
+    cache_dir = get_cache_dir(cache_dir)
+    # 複数ワーカーから同時に消さないようロックを取る
+    with open(os.path.join(cache_dir, "evict.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        entries = []
+        for prefix_entry in os.scandir(cache_dir):
+            if not prefix_entry.is_dir():
+                continue
+            for entry in os.scandir(prefix_entry.path):
+                if entry.is_dir() and "." not in entry.name:
+                    entries.append((entry.stat().st_mtime, get_entry_size(entry.path), entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for mtime, size, entry_dir in sorted(entries):
+            if total_bytes <= max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_bytes -= size
+            log.info(f"Cache evicted: {entry_dir} (unused for {(time.time() - mtime) / 3600:.1f}h)")
@@ -0,0 +1,102 @@
+import fcntl
+import json
+import os
+
+import numpy as np
+
+# 過去の実行実績(ステージ別の [フレーム数, 秒数])
+THROUGHPUT_PATH = os.environ.get(
+    "MAT4_THROUGHPUT_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "throughput.json"),
+)
+
+# ステージ別に保持する実績数
+MAX_SAMPLES = 50
+
+# 見積もりに対する安全率
+SAFETY_FACTOR = 1.2
+
+
+def load_throughput(throughput_path: str = THROUGHPUT_PATH) -> dict:
+    if not os.path.exists(throughput_path):
+        return {}
+    with open(throughput_path, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+
+def record_throughput(stage: str, frames: int, seconds: float, throughput_path: str = THROUGHPUT_PATH):
+    if frames <= 0:
+        return
+
+    os.makedirs(os.path.dirname(throughput_path), exist_ok=True)
+
+    # 複数ワーカーから同時に書き込まれるのでロックを取る
+    with open(f"{throughput_path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        throughput = load_throughput(throughput_path)
+        samples = throughput.get(stage, [])
+        samples.append([int(frames), float(seconds)])
+        throughput[stage] = samples[-MAX_SAMPLES:]
+
+        tmp_path = f"{throughput_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(throughput, f)
+        os.replace(tmp_path, throughput_path)
+
+
+def estimate_seconds(throughput: dict, stage: str, frames: int):
+    """実績から 秒数 = 固定費 + フレーム数 * 単価 で見積もる。実績がない場合はNone"""
+    samples = np.array(throughput.get(stage, []), dtype=np.float64)
+    if not len(samples):
+        return None
+
+    frame_counts, seconds = samples[:, 0], samples[:, 1]
+
+    if len(np.unique(frame_counts)) < 2:
+        # フレーム数が1種類しかない場合は単価のみ
+        return float(np.sum(seconds) / np.sum(frame_counts) * frames * SAFETY_FACTOR)
+
+    rate, overhead = np.polyfit(frame_counts, seconds, 1)
+    if rate <= 0:
+        rate = np.sum(seconds) / np.sum(frame_counts)
+        overhead = 0.0
+
+    return float((max(0.0, overhead) + rate * frames) * SAFETY_FACTOR)
+
+
+def order_tasks(tasks: dict, order: str = "longest") -> list:
+    """tasks(キー: フレーム数)のキーを実行順に並べる (longest 長いものから / shortest 短いものから)"""
+    return sorted(tasks.keys(), key=lambda k: tasks[k], reverse=(order == "longest"))
+
+
+def next_task(
+    tasks: dict,
+    stage: str,
+    remaining_seconds: float,
+    throughput: dict,
+    order: str = "longest",
+):
+    """tasks(キー: フレーム数)から、残り時間内に終わる次のタスクのキーを返す (1件目も同じく判定する)
+
+    order: longest 長いものから / shortest 短いものから(時間内に終わる件数を優先)
+    """
+    for key in order_tasks(tasks, order):
+        seconds = estimate_seconds(throughput, stage, tasks[key])
+        if seconds is None or seconds <= remaining_seconds:
+            return key
+
+    return None
+
+
+def find_oversized_tasks(tasks: dict, stage: str, limit_seconds: float, throughput: dict) -> dict:
+    """制限時間の全体を使っても終わらない見込みのタスク (キー: 見積もり秒数)"""
+    oversized_tasks = {}
+    for key, frames in tasks.items():
+        seconds = estimate_seconds(throughput, stage, frames)
+        if seconds is not None and limit_seconds < seconds:
+            oversized_tasks[key] = seconds
+    return oversized_tasks
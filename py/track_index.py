@@ -0,0 +1,77 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+
+import numpy as np
+
+# 出力ディレクトリのトラック一覧 (go/pkg/utils/track_index.go と同じ形式)
+INDEX_FILE_NAME = "tracks.json"
+
+
+def get_index_path(output_dir_path: str) -> str:
+    return os.path.join(output_dir_path, INDEX_FILE_NAME)
+
+
+def get_track_name(json_path: str) -> str:
+    # {start_time:05d}_{tracked_id:02d}_xxx.json
+    return "_".join(os.path.basename(json_path).split("_")[:2])
+
+
+def load(output_dir_path: str) -> dict:
+    """トラック名ごとの情報。インデックスがない場合は空"""
+    index_path = get_index_path(output_dir_path)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, "r") as f:
+        try:
+            return json.load(f)["tracks"]
+        except (json.JSONDecodeError, KeyError):
+            return {}
+
+
+@contextmanager
+def edit(output_dir_path: str):
+    index_path = get_index_path(output_dir_path)
+
+    # 複数ワーカー(とmat4)から同時に書き込まれるのでロックを取る
+    with open(f"{index_path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        tracks = load(output_dir_path)
+        yield tracks
+
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"tracks": dict(sorted(tracks.items()))}, f, indent=4)
+        os.replace(tmp_path, index_path)
+
+
+def register_track(
+    output_dir_path: str, tracked_id: int, start_time: int, frames: dict, status: str, json_path: str = None
+):
+    """pkl2json で出力したトラックを登録する"""
+    fnos = [int(fno) for fno in frames.keys()]
+    confs = [frame_data.get("conf", 0.0) for frame_data in frames.values()]
+
+    with edit(output_dir_path) as tracks:
+        tracks[f"{start_time:05d}_{tracked_id:02d}"] = {
+            "tracked_id": tracked_id,
+            "start_time": start_time,
+            "start_fno": min(fnos),
+            "end_fno": max(fnos),
+            # 平滑化で欠損を埋めた後のフレーム数
+            "frames": max(fnos) - min(fnos) + 1,
+            "observed_frames": len(fnos),
+            "mean_conf": float(np.mean(confs)),
+            "stages": {"pkl2json": status},
+            "paths": {"pkl2json": os.path.basename(json_path)} if json_path else {},
+        }
+
+
+def set_stage(output_dir_path: str, json_path: str, stage: str, status: str, output_path: str = None):
+    with edit(output_dir_path) as tracks:
+        track = tracks.setdefault(get_track_name(json_path), {"stages": {}, "paths": {}})
+        track["stages"][stage] = status
+        if output_path:
+            track["paths"][stage] = os.path.basename(output_path)